@@ -6,7 +6,15 @@ import os
 import requests
 import hmac
 import hashlib
-from flask import Flask, request, jsonify
+import sqlite3
+import threading
+import atexit
+import sys
+import time
+import tracemalloc
+from collections import Counter, OrderedDict
+from functools import wraps
+from flask import Flask, Response, request, jsonify
 from datetime import datetime
 from dotenv import load_dotenv
 
@@ -25,8 +33,167 @@ MATTERMOST_WEBHOOK_URL = os.getenv('MATTERMOST_WEBHOOK_URL', '')  # 新規追加
 MATTERMOST_API_URL = os.getenv('MATTERMOST_API_URL', '')  # 新規追加
 MATTERMOST_API_TOKEN = os.getenv('MATTERMOST_API_TOKEN', '')  # 新規追加
 
-# スレッド情報を保存するための簡易データベース（実際の運用では永続化が必要）
-issue_thread_mapping = {}
+# Incoming Webhook通知のまとめ送信設定（WEBHOOK_BATCH_WINDOW=0 で即時送信）
+WEBHOOK_BATCH_WINDOW = float(os.getenv('WEBHOOK_BATCH_WINDOW', '2'))
+WEBHOOK_BATCH_MAX = int(os.getenv('WEBHOOK_BATCH_MAX', '20'))
+
+# /issue で作成したIssueの opened Webhook を「新規Issue」として再通知しないための記録期間（秒）
+ECHO_TTL = float(os.getenv('ECHO_TTL', '120'))
+ECHO_MAX_ENTRIES = int(os.getenv('ECHO_MAX_ENTRIES', '10000'))
+
+# 管理用エンドポイント（プロファイリング）のトークン（空なら無効）
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN', '')
+PROFILE_MAX_SECONDS = float(os.getenv('PROFILE_MAX_SECONDS', '60'))
+PROFILE_SAMPLE_INTERVAL = float(os.getenv('PROFILE_SAMPLE_INTERVAL', '0.005'))
+
+# スレッド情報の保存先（複数レプリカで共有する場合は同じファイルを指定）
+DB_PATH = os.getenv('DB_PATH', 'bidirectional_bridge.db')
+
+def get_db_connection():
+    """スレッド情報DBへの接続を取得"""
+    conn = sqlite3.connect(DB_PATH, timeout=30)
+    conn.execute('PRAGMA busy_timeout = 30000')
+    return conn
+
+def _migration_001_initial_schema(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS issue_thread_mapping (
+            issue_key TEXT PRIMARY KEY,
+            mapping TEXT
+        )
+    ''')
+
+# (バージョン, 説明, 適用関数)
+MIGRATIONS = [
+    (1, 'initial schema', _migration_001_initial_schema)
+]
+
+def run_migrations():
+    """未適用のマイグレーションを1つずつトランザクションで適用し、現在のバージョンを返す"""
+    conn = get_db_connection()
+    try:
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT,
+                applied_at TEXT
+            )
+        ''')
+        conn.commit()
+        
+        for version, description, migrate in MIGRATIONS:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                current_version = cursor.execute('SELECT MAX(version) FROM schema_version').fetchone()[0] or 0
+                if current_version >= version:
+                    conn.rollback()
+                    continue
+                migrate(cursor)
+                cursor.execute('INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)',
+                               (version, description, datetime.now().isoformat()))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            logger.info(f"Applied schema migration {version} ({description})")
+        
+        return conn.execute('SELECT MAX(version) FROM schema_version').fetchone()[0] or 0
+    finally:
+        conn.close()
+
+def save_issue_thread_mapping(issue_key, thread_info):
+    """issueとスレッドの関連付けを保存"""
+    conn = get_db_connection()
+    conn.execute('INSERT OR REPLACE INTO issue_thread_mapping (issue_key, mapping) VALUES (?, ?)',
+                 (issue_key, json.dumps(thread_info)))
+    conn.commit()
+    conn.close()
+
+def get_issue_thread_mapping(issue_key):
+    """issueに関連付けられたスレッド情報を取得"""
+    conn = get_db_connection()
+    row = conn.execute('SELECT mapping FROM issue_thread_mapping WHERE issue_key = ?', (issue_key,)).fetchone()
+    conn.close()
+    return json.loads(row[0]) if row else None
+
+def get_all_issue_thread_mappings():
+    conn = get_db_connection()
+    rows = conn.execute('SELECT issue_key, mapping FROM issue_thread_mapping').fetchall()
+    conn.close()
+    return {issue_key: json.loads(mapping) for issue_key, mapping in rows}
+
+class EchoSuppressor:
+    """ブリッジが作成したIssueを短時間記録する件数上限付きTTLキャッシュ
+    
+    スレッドの関連付けはMattermostへの投稿後に保存されるため、それより先に届いた
+    opened Webhook もこの記録で判定できる。作成前の (リポジトリ, タイトル) の記録は一度
+    一致したら消費し、作成後は resolve() でIssue番号の記録に置き換える。同じタイトルで
+    人間が作成したIssueは抑止しない。記録はプロセス内にのみ保持する。
+    """
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.suppressed = 0
+    
+    def _put(self, key, count):
+        self.entries[key] = (time.monotonic() + self.ttl, count)
+        self.entries.move_to_end(key)
+        self._evict()
+    
+    def _consume(self, key):
+        entry = self.entries.get(key)
+        if not entry:
+            return False
+        if entry[1] > 1:
+            self.entries[key] = (entry[0], entry[1] - 1)
+        else:
+            del self.entries[key]
+        return True
+    
+    def record(self, repo, title):
+        key = (repo.lower(), 'title', title.strip())
+        with self.lock:
+            self._evict()
+            entry = self.entries.get(key)
+            self._put(key, entry[1] + 1 if entry else 1)
+    
+    def resolve(self, repo, title, number):
+        """作成結果で記録を確定（失敗時は number=None で取り消す）"""
+        title_key = (repo.lower(), 'title', title.strip())
+        with self.lock:
+            self._evict()
+            if number is None:
+                self._consume(title_key)
+                return
+            number_key = (repo.lower(), 'number', str(number))
+            if number_key not in self.entries:
+                self._consume(title_key)
+            self._put(number_key, 1)
+    
+    def match(self, repo, title, number):
+        number_key = (repo.lower(), 'number', str(number))
+        with self.lock:
+            self._evict()
+            if number_key not in self.entries:
+                if not self._consume((repo.lower(), 'title', (title or '').strip())):
+                    return False
+                self._put(number_key, 1)
+            self.suppressed += 1
+            return True
+    
+    def _evict(self):
+        now = time.monotonic()
+        while self.entries:
+            key, (expires_at, _) = next(iter(self.entries.items()))
+            if expires_at > now and len(self.entries) <= self.max_entries:
+                break
+            del self.entries[key]
+
+echo_suppressor = EchoSuppressor(ECHO_TTL, ECHO_MAX_ENTRIES)
 
 class ForgejoAPI:
     def __init__(self, base_url, token):
@@ -80,12 +247,23 @@ class MattermostAPI:
             logger.error(f"Failed to post message: {e}")
             return None
 
+# send_webhook_notification の戻り値（失敗時は False）
+WEBHOOK_SENT = 'sent'
+WEBHOOK_QUEUED = 'queued'
+
 def send_webhook_notification(message, channel=None, username="Forgejo Bot", icon_url="https://forgejo.org/favicon.ico"):
-    """Mattermost Incoming Webhookを使用してメッセージを送信"""
+    """Mattermost Incoming Webhookを使用してメッセージを送信
+    
+    まとめ送信が有効ならキューに追加して WEBHOOK_QUEUED を返す（送信結果はまとめ送信時にログ出力）。
+    """
     if not MATTERMOST_WEBHOOK_URL:
         logger.warning("MATTERMOST_WEBHOOK_URL not configured")
         return False
     
+    if WEBHOOK_BATCH_WINDOW > 0:
+        notification_batcher.add(message, channel, username, icon_url)
+        return WEBHOOK_QUEUED
+    
     payload = {
         'text': message,
         'username': username,
@@ -95,6 +273,10 @@ def send_webhook_notification(message, channel=None, username="Forgejo Bot", ico
     if channel:
         payload['channel'] = channel
     
+    return WEBHOOK_SENT if post_webhook_payload(payload) else False
+
+def post_webhook_payload(payload):
+    """Incoming Webhookにペイロードを送信"""
     try:
         response = requests.post(MATTERMOST_WEBHOOK_URL, json=payload)
         response.raise_for_status()
@@ -103,6 +285,85 @@ def send_webhook_notification(message, channel=None, username="Forgejo Bot", ico
         logger.error(f"Failed to send webhook notification: {e}")
         return False
 
+class WebhookNotificationBatcher:
+    """同じチャンネル宛ての通知を短時間まとめ、1つのペイロード（複数attachments）で送信"""
+    def __init__(self, window, max_items):
+        self.window = window
+        self.max_items = max_items
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.timers = {}
+        self.sent_notifications = 0
+        self.sent_requests = 0
+        self.failed_notifications = 0
+    
+    def add(self, message, channel, username, icon_url):
+        key = (channel, username, icon_url)
+        with self.lock:
+            self.pending.setdefault(key, []).append(message)
+            if len(self.pending[key]) >= self.max_items:
+                flush_now = True
+            else:
+                flush_now = False
+                if key not in self.timers:
+                    timer = threading.Timer(self.window, self.flush, args=(key,))
+                    timer.daemon = True
+                    self.timers[key] = timer
+                    timer.start()
+        
+        if flush_now:
+            self.flush(key)
+    
+    def flush(self, key):
+        with self.lock:
+            messages = self.pending.pop(key, [])
+            timer = self.timers.pop(key, None)
+        if timer:
+            timer.cancel()
+        if not messages:
+            return
+        
+        channel, username, icon_url = key
+        payload = {'username': username, 'icon_url': icon_url}
+        if channel:
+            payload['channel'] = channel
+        
+        if len(messages) == 1:
+            payload['text'] = messages[0]
+        else:
+            payload['text'] = f"📦 {len(messages)}件の通知"
+            payload['attachments'] = [{'fallback': message, 'text': message} for message in messages]
+        
+        success = post_webhook_payload(payload)
+        with self.lock:
+            if success:
+                self.sent_notifications += len(messages)
+                self.sent_requests += 1
+            else:
+                self.failed_notifications += len(messages)
+        if success:
+            logger.info(f"Sent {len(messages)} batched webhook notifications")
+        else:
+            logger.error(f"Failed to send {len(messages)} batched webhook notifications")
+    
+    def flush_all(self):
+        with self.lock:
+            keys = list(self.pending)
+        for key in keys:
+            self.flush(key)
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'pending': sum(len(messages) for messages in self.pending.values()),
+                'sent_notifications': self.sent_notifications,
+                'sent_requests': self.sent_requests,
+                'failed_notifications': self.failed_notifications
+            }
+
+notification_batcher = WebhookNotificationBatcher(WEBHOOK_BATCH_WINDOW, WEBHOOK_BATCH_MAX)
+atexit.register(notification_batcher.flush_all)
+
 def verify_token(request_token):
     """Mattermostから送信されたトークンを検証"""
     if MATTERMOST_TOKEN and request_token != MATTERMOST_TOKEN:
@@ -151,7 +412,7 @@ def root():
     return jsonify({
         'message': 'Mattermost-Forgejo Bridge Server',
         'status': 'running',
-        'endpoints': ['/webhook', '/health', '/debug']
+        'endpoints': ['/webhook', '/health', '/debug', '/admin/profile/cpu', '/admin/profile/memory']
     })
 
 @app.route('/webhook', methods=['GET', 'POST'])
@@ -250,7 +511,9 @@ def handle_slash_command(data):
         
         # Forgejo APIでIssueを作成
         forgejo = ForgejoAPI(FORGEJO_URL, FORGEJO_TOKEN)
+        echo_suppressor.record(f"{owner}/{repo}", title)
         issue = forgejo.create_issue(owner, repo, title, body)
+        echo_suppressor.resolve(f"{owner}/{repo}", title, issue['number'] if issue else None)
         
         if issue:
             logger.info(f"Created issue #{issue['number']}: {title}")
@@ -269,7 +532,7 @@ def handle_slash_command(data):
             
             # issueとスレッドの関連付けを保存
             issue_key = f"{owner}/{repo}#{issue['number']}"
-            issue_thread_mapping[issue_key] = {
+            save_issue_thread_mapping(issue_key, {
                 'channel_id': channel_id,
                 'username': username,
                 'channel_name': channel_name,
@@ -277,7 +540,7 @@ def handle_slash_command(data):
                 'created_at': datetime.now().isoformat(),
                 'issue_url': issue['html_url'],
                 'root_message_id': root_message_id  # 新規追加
-            }
+            })
             
             logger.info(f"Saved thread mapping for {issue_key} with root_id: {root_message_id}")
             
@@ -347,7 +610,7 @@ def handle_issue_comment_event(data, action):
     issue_key = f"{owner}/{repo_name}#{issue_number}"
     
     # スレッド情報の取得
-    thread_info = issue_thread_mapping.get(issue_key)
+    thread_info = get_issue_thread_mapping(issue_key)
     
     message = f"💬 **New Comment on Issue**\n\n**Repository:** {owner}/{repo_name}\n**Issue #{issue_number}:** {issue_title}\n**Comment by:** @{sender_name}\n\n**Comment:**\n{comment_body}\n\n**URL:** {comment_url}"
     
@@ -373,8 +636,10 @@ def handle_issue_comment_event(data, action):
                 logger.error(f"Failed to post message for {issue_key}")
     else:
         # 通常の通知
-        success = send_webhook_notification(message)
-        if success:
+        result = send_webhook_notification(message)
+        if result == WEBHOOK_QUEUED:
+            logger.info(f"Queued webhook notification for {issue_key}")
+        elif result:
             logger.info(f"Sent webhook notification for {issue_key}")
         else:
             logger.error(f"Failed to send webhook notification for {issue_key}")
@@ -397,13 +662,13 @@ def handle_issue_event(data, action):
     issue_key = f"{owner}/{repo_name}#{issue_number}"
     
     # スレッド情報の取得
-    thread_info = issue_thread_mapping.get(issue_key)
+    thread_info = get_issue_thread_mapping(issue_key)
     
     message = ""
     
     if action == 'opened':
         # 外部からissueが作成された場合（Mattermostからではない）
-        if not thread_info:
+        if not thread_info and not echo_suppressor.match(repository.get('full_name') or f"{owner}/{repo_name}", issue_title, issue_number):
             message = f"🆕 **New Issue Created**\n\n**Repository:** {owner}/{repo_name}\n**Issue #{issue_number}:** {issue_title}\n**Created by:** @{sender_name}\n**URL:** {issue_url}"
             send_webhook_notification(message)
         return jsonify({'status': 'processed'}), 200
@@ -438,8 +703,10 @@ def handle_issue_event(data, action):
                     logger.error(f"Failed to post message for {issue_key}")
         else:
             # 通常の通知
-            success = send_webhook_notification(message)
-            if success:
+            result = send_webhook_notification(message)
+            if result == WEBHOOK_QUEUED:
+                logger.info(f"Queued webhook notification for {issue_key}")
+            elif result:
                 logger.info(f"Sent webhook notification for {issue_key}")
             else:
                 logger.error(f"Failed to send webhook notification for {issue_key}")
@@ -471,14 +738,150 @@ def handle_pull_request_event(data, action):
             message = f"❌ **Pull Request Closed**\n\n**Repository:** {owner}/{repo_name}\n**PR #{pr_number}:** {pr_title}\n**Closed by:** @{sender_name}\n**URL:** {pr_url}"
     
     if message:
-        success = send_webhook_notification(message)
-        if success:
+        result = send_webhook_notification(message)
+        if result == WEBHOOK_QUEUED:
+            logger.info(f"Queued PR notification for {owner}/{repo_name}#{pr_number}")
+        elif result:
             logger.info(f"Sent PR notification for {owner}/{repo_name}#{pr_number}")
         else:
             logger.error(f"Failed to send PR notification for {owner}/{repo_name}#{pr_number}")
     
     return jsonify({'status': 'processed'}), 200
 
+def require_admin_token(f):
+    """Authorization: Bearer <ADMIN_TOKEN> を要求するデコレーター"""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        if not ADMIN_TOKEN:
+            return jsonify({'error': 'ADMIN_TOKEN is not configured'}), 403
+        auth_header = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(auth_header.encode('utf-8'), f"Bearer {ADMIN_TOKEN}".encode('utf-8')):
+            return jsonify({'error': 'Unauthorized'}), 401
+        return f(*args, **kwargs)
+    return decorated
+
+# 同時に実行できるCPUプロファイルは1つだけ
+cpu_profile_lock = threading.Lock()
+
+def thread_is_running(native_id):
+    """スレッドがCPU上で実行中（実行可能状態）か /proc から判定"""
+    try:
+        with open(f"/proc/self/task/{native_id}/stat") as f:
+            # comm に空白や括弧を含むことがあるため、最後の ')' の直後を状態として読む
+            return f.read().rsplit(')', 1)[1].split()[0] == 'R'
+    except (OSError, IndexError):
+        return False
+
+def collect_cpu_samples(seconds, interval, cpu_only=True):
+    """スレッドのスタックを一定間隔でサンプリングし、折りたたみ形式の件数を返す
+    
+    cpu_only のときは実行中のスレッドだけを数える（ロック・ソケット待ちのスレッドは除外）。
+    """
+    own_thread_id = threading.get_ident()
+    samples = Counter()
+    deadline = time.monotonic() + seconds
+    
+    while time.monotonic() < deadline:
+        native_ids = {thread.ident: thread.native_id for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_thread_id:
+                continue
+            if cpu_only and not thread_is_running(native_ids.get(thread_id)):
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            samples[';'.join(reversed(stack))] += 1
+        time.sleep(interval)
+    
+    return samples
+
+@app.route('/admin/profile/cpu', methods=['GET'])
+@require_admin_token
+def profile_cpu():
+    """?seconds=N の間サンプリングし、flamegraph.pl 用の折りたたみスタックを返す
+    
+    既定（mode=cpu）は実行中のスレッドのみ。mode=wall で待機中を含む全スレッドの
+    ウォールクロックプロファイルになる。
+    """
+    try:
+        seconds = min(max(float(request.args.get('seconds', 10)), 0.1), PROFILE_MAX_SECONDS)
+    except ValueError:
+        return jsonify({'error': 'Invalid seconds'}), 400
+    
+    mode = request.args.get('mode', 'cpu')
+    if mode not in ('cpu', 'wall'):
+        return jsonify({'error': 'Invalid mode (cpu or wall)'}), 400
+    if mode == 'cpu' and not os.path.isdir('/proc/self/task'):
+        return jsonify({'error': 'CPU mode requires /proc; use mode=wall'}), 400
+    
+    if not cpu_profile_lock.acquire(blocking=False):
+        return jsonify({'error': 'Another CPU profile is running'}), 409
+    try:
+        logger.info(f"Starting {mode} profile for {seconds}s")
+        samples = collect_cpu_samples(seconds, PROFILE_SAMPLE_INTERVAL, cpu_only=(mode == 'cpu'))
+    finally:
+        cpu_profile_lock.release()
+    
+    body = ''.join(f"{stack} {count}\n" for stack, count in samples.most_common())
+    return Response(body, mimetype='text/plain', headers={'X-Profile-Mode': mode})
+
+# 前回のスナップショット（差分の基準）
+memory_profile_state = {'snapshot': None, 'taken_at': None}
+
+def format_memory_stats(stats, limit):
+    return [{
+        'location': str(stat.traceback),
+        'size_kb': round(stat.size / 1024, 1),
+        'size_diff_kb': round(getattr(stat, 'size_diff', 0) / 1024, 1),
+        'count': stat.count,
+        'count_diff': getattr(stat, 'count_diff', 0)
+    } for stat in stats[:limit]]
+
+@app.route('/admin/profile/memory', methods=['GET', 'DELETE'])
+@require_admin_token
+def profile_memory():
+    """tracemallocのスナップショットと前回からの差分（上位の割り当て元）を返す
+    
+    初回のGETで追跡を開始し、以降のGETごとにスナップショットを取る。
+    DELETEで追跡を停止する（停止中は追加の負荷なし）。
+    """
+    if request.method == 'DELETE':
+        tracemalloc.stop()
+        memory_profile_state.update(snapshot=None, taken_at=None)
+        return jsonify({'status': 'stopped'})
+    
+    try:
+        frames = int(request.args.get('frames', 1))
+        limit = int(request.args.get('top', 20))
+    except ValueError:
+        return jsonify({'error': 'Invalid frames or top'}), 400
+    if not 1 <= frames <= 100 or limit < 1:
+        return jsonify({'error': 'frames must be 1-100 and top must be positive'}), 400
+    
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+        memory_profile_state.update(snapshot=tracemalloc.take_snapshot(), taken_at=datetime.now().isoformat())
+        return jsonify({'status': 'started', 'message': 'Call again to get a snapshot diff'})
+    
+    snapshot = tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__)
+    ])
+    previous = memory_profile_state['snapshot']
+    previous_taken_at = memory_profile_state['taken_at']
+    memory_profile_state.update(snapshot=snapshot, taken_at=datetime.now().isoformat())
+    
+    current, peak = tracemalloc.get_traced_memory()
+    return jsonify({
+        'traced_current_kb': round(current / 1024, 1),
+        'traced_peak_kb': round(peak / 1024, 1),
+        'top': format_memory_stats(snapshot.statistics('lineno'), limit),
+        'diff_since': previous_taken_at,
+        'diff': format_memory_stats(snapshot.compare_to(previous, 'lineno'), limit) if previous else []
+    })
+
 @app.route('/health', methods=['GET'])
 def health():
     """ヘルスチェックエンドポイント"""
@@ -506,7 +909,8 @@ def debug_endpoint():
         'form': dict(request.form),
         'json': request.get_json(silent=True),
         'data': request.get_data().decode('utf-8', errors='ignore'),
-        'issue_thread_mapping': issue_thread_mapping
+        'issue_thread_mapping': get_all_issue_thread_mappings(),
+        'webhook_batching': notification_batcher.stats()
     }
     
     logger.info(f"Debug info: {debug_info}")
@@ -525,6 +929,11 @@ def debug_endpoint():
     })
 
 if __name__ == '__main__':
+    # python mattermost_forgejo_bidirectional_bridge.py migrate でマイグレーションのみ実行
+    if sys.argv[1:] == ['migrate']:
+        logger.info(f"Schema is at version {run_migrations()}")
+        exit(0)
+    
     if not FORGEJO_TOKEN:
         logger.error("FORGEJO_TOKEN environment variable is required")
         exit(1)
@@ -545,4 +954,5 @@ if __name__ == '__main__':
     logger.info(f"Forgejo URL: {FORGEJO_URL}")
     logger.info(f"Debug mode: {debug}")
     
+    run_migrations()
     app.run(host='0.0.0.0', port=port, debug=debug)
@@ -1,16 +1,36 @@
 #!/usr/bin/env python3
 
+import math
+import logging
+import logging.handlers
+import random
 import json
 import os
 import requests
 import hmac
 import hashlib
+import re
+import socket
+import ssl
+import sys
+import atexit
 import base64
+import bisect
+import contextvars
+import gzip
+import mmap
+import queue
 import urllib.parse
 from flask import Flask, request, jsonify, redirect, session, url_for
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 from functools import wraps
 from loguru import logger
 
@@ -28,13 +48,655 @@ MATTERMOST_TOKEN = os.getenv('MATTERMOST_TOKEN', '')
 MATTERMOST_WEBHOOK_URL = os.getenv('MATTERMOST_WEBHOOK_URL', '')
 MATTERMOST_API_URL = os.getenv('MATTERMOST_API_URL', '')
 MATTERMOST_API_TOKEN = os.getenv('MATTERMOST_API_TOKEN', '')
+MATTERMOST_OUTGOING_TOKEN = os.getenv('MATTERMOST_OUTGOING_TOKEN', '')
 BASE_URL = os.getenv('BASE_URL', 'http://localhost:5005')
 
-# データベース初期化
-def init_db():
-    conn = sqlite3.connect('bridge.db')
-    cursor = conn.cursor()
+# Mattermostのスレッド返信をForgejoコメントとして同期する設定
+COMMENT_MIRROR_ENABLED = os.getenv('COMMENT_MIRROR_ENABLED', 'true').lower() == 'true'
+COMMENT_MIRROR_WINDOW = float(os.getenv('COMMENT_MIRROR_WINDOW', '3'))
+COMMENT_MIRROR_MAX = int(os.getenv('COMMENT_MIRROR_MAX', '10'))
+
+# Mattermost WebSocketイベントストリームの常時接続（スラッシュコマンド以外の投稿・リアクションに反応）
+MATTERMOST_WEBSOCKET_ENABLED = os.getenv('MATTERMOST_WEBSOCKET_ENABLED', 'false').lower() == 'true'
+MATTERMOST_WEBSOCKET_URL = os.getenv('MATTERMOST_WEBSOCKET_URL', '')
+MATTERMOST_WEBSOCKET_PING_INTERVAL = float(os.getenv('MATTERMOST_WEBSOCKET_PING_INTERVAL', '30'))
+MATTERMOST_WEBSOCKET_BACKOFF_MAX = float(os.getenv('MATTERMOST_WEBSOCKET_BACKOFF_MAX', '60'))
+
+# ブリッジ自身の操作（Issue作成・コメント投稿）で発生したWebhookをMattermostへ再投稿しないエコー抑止
+ECHO_SUPPRESSION_ENABLED = os.getenv('ECHO_SUPPRESSION_ENABLED', 'true').lower() == 'true'
+ECHO_TTL = float(os.getenv('ECHO_TTL', '120'))
+ECHO_MAX_ENTRIES = int(os.getenv('ECHO_MAX_ENTRIES', '10000'))
+
+# ファンアウト配信設定（1イベントを複数チャンネルへ並列配信）
+FANOUT_CHANNEL_IDS = [c.strip() for c in os.getenv('FANOUT_CHANNEL_IDS', '').split(',') if c.strip()]
+FANOUT_MAX_WORKERS = int(os.getenv('FANOUT_MAX_WORKERS', '8'))
+FANOUT_TIMEOUT = float(os.getenv('FANOUT_TIMEOUT', '10'))
+
+# 長文コメントの表示上限（Mattermostの投稿サイズを一定に保つ）
+RENDER_MAX_BYTES = int(os.getenv('RENDER_MAX_BYTES', '4000'))
+RENDER_MAX_LINES = int(os.getenv('RENDER_MAX_LINES', '40'))
+
+# ステータスカードモード（Issue/PRごとに1つの投稿をその場で更新）
+STATUS_CARD_MODE = os.getenv('STATUS_CARD_MODE', 'false').lower() == 'true'
+STATUS_CARD_MIN_INTERVAL = float(os.getenv('STATUS_CARD_MIN_INTERVAL', '5'))
+# /issue 以外で作成されたIssue/PRのカードを投稿するチャンネル（空なら FANOUT_CHANNEL_IDS の先頭）
+STATUS_CARD_CHANNEL_ID = os.getenv('STATUS_CARD_CHANNEL_ID', '')
+
+# ダイジェスト配信設定（購読チャンネルには個別通知の代わりに定期サマリーを投稿）
+DIGEST_CHECK_INTERVAL = float(os.getenv('DIGEST_CHECK_INTERVAL', '60'))
+DIGEST_MAX_BYTES = int(os.getenv('DIGEST_MAX_BYTES', '15000'))
+DIGEST_SCHEDULES = {'hourly': 3600, 'daily': 86400}
+
+# イベントストア設定（日付ごとのテーブルに正規化イベントを保存）
+EVENT_STORE_ENABLED = os.getenv('EVENT_STORE_ENABLED', 'true').lower() == 'true'
+EVENT_FLUSH_INTERVAL = float(os.getenv('EVENT_FLUSH_INTERVAL', '1'))
+EVENT_FLUSH_BATCH = int(os.getenv('EVENT_FLUSH_BATCH', '500'))
+EVENT_RETENTION_DAYS = int(os.getenv('EVENT_RETENTION_DAYS', '30'))
+EVENTS_PAGE_SIZE = int(os.getenv('EVENTS_PAGE_SIZE', '100'))
+
+# 管理用エンドポイントのトークン（空なら管理用エンドポイントは無効）
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN', '')
+
+# Webhookキャプチャ設定（空なら記録しない）
+WEBHOOK_CAPTURE_PATH = os.getenv('WEBHOOK_CAPTURE_PATH', '')
+WEBHOOK_CAPTURE_MAX_BYTES = int(os.getenv('WEBHOOK_CAPTURE_MAX_BYTES', str(50 * 1024 * 1024)))
+WEBHOOK_CAPTURE_BACKUPS = int(os.getenv('WEBHOOK_CAPTURE_BACKUPS', '5'))
+
+# 優先レーン設定（スラッシュコマンドをWebhook処理より優先）
+PRIORITY_LANES_ENABLED = os.getenv('PRIORITY_LANES_ENABLED', 'true').lower() == 'true'
+LANE_WORKERS = int(os.getenv('LANE_WORKERS', '8'))
+LANE_INTERACTIVE_WEIGHT = float(os.getenv('LANE_INTERACTIVE_WEIGHT', '8'))
+LANE_WEBHOOK_WEIGHT = float(os.getenv('LANE_WEBHOOK_WEIGHT', '1'))
+LANE_INTERACTIVE_RESERVED = int(os.getenv('LANE_INTERACTIVE_RESERVED', '2'))
+
+# Issue単位で順序を保つイベント処理パーティション数
+EVENT_PARTITIONS = int(os.getenv('EVENT_PARTITIONS', '8'))
+
+# Webhook取り込みスプール設定（空なら同期処理）
+SPOOL_DIR = os.getenv('SPOOL_DIR', '')
+SPOOL_SEGMENT_BYTES = int(os.getenv('SPOOL_SEGMENT_BYTES', str(16 * 1024 * 1024)))
+SPOOL_CONSUMERS = int(os.getenv('SPOOL_CONSUMERS', '4'))
+SPOOL_BATCH_SIZE = int(os.getenv('SPOOL_BATCH_SIZE', '64'))
+SPOOL_FSYNC = os.getenv('SPOOL_FSYNC', 'false').lower() == 'true'
+SPOOL_MAX_ATTEMPTS = int(os.getenv('SPOOL_MAX_ATTEMPTS', '5'))
+SPOOL_RETRY_BACKOFF = float(os.getenv('SPOOL_RETRY_BACKOFF', '1'))
+
+# 既存Issueの一括取り込み設定（/issue track）
+BACKFILL_PAGE_SIZE = int(os.getenv('BACKFILL_PAGE_SIZE', '50'))
+BACKFILL_MAX_CONCURRENCY = int(os.getenv('BACKFILL_MAX_CONCURRENCY', '4'))
+
+# Forgejo GETレスポンスの条件付きキャッシュ（ETag / Last-Modified）
+FORGEJO_CACHE_ENABLED = os.getenv('FORGEJO_CACHE_ENABLED', 'true').lower() == 'true'
+FORGEJO_CACHE_MAX_BYTES = int(os.getenv('FORGEJO_CACHE_MAX_BYTES', str(16 * 1024 * 1024)))
+FORGEJO_CACHE_MAX_ENTRY_BYTES = int(os.getenv('FORGEJO_CACHE_MAX_ENTRY_BYTES', str(256 * 1024)))
+
+# ユーザーごとのアクセス可能リポジトリ索引
+REPO_PAGE_SIZE = int(os.getenv('REPO_PAGE_SIZE', '50'))
+REPO_INDEX_TTL = float(os.getenv('REPO_INDEX_TTL', '600'))
+AUTOCOMPLETE_LIMIT = int(os.getenv('AUTOCOMPLETE_LIMIT', '25'))
+# /autocomplete 専用のトークン（スラッシュコマンドのトークンとは別にする。空なら無効）
+AUTOCOMPLETE_TOKEN = os.getenv('AUTOCOMPLETE_TOKEN', '')
+
+# Issue作成前の重複候補チェック
+DUPLICATE_CHECK_ENABLED = os.getenv('DUPLICATE_CHECK_ENABLED', 'true').lower() == 'true'
+DUPLICATE_THRESHOLD = float(os.getenv('DUPLICATE_THRESHOLD', '0.6'))
+DUPLICATE_INDEX_MAX_PER_REPO = int(os.getenv('DUPLICATE_INDEX_MAX_PER_REPO', '2000'))
+
+# マルチテナント設定（JSONファイルで複数のForgejo/Mattermostの組を定義）
+TENANTS_FILE = os.getenv('TENANTS_FILE', '')
+TENANT_POOL_SIZE = int(os.getenv('TENANT_POOL_SIZE', '10'))
+TENANT_RATE_LIMIT = float(os.getenv('TENANT_RATE_LIMIT', '0'))
+DEFAULT_TENANT = 'default'
+
+class RateLimiter:
+    """トークンバケット方式のレート制限（rateが0なら無制限）"""
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_seconds = (1 - self.tokens) / self.rate
+            time.sleep(wait_seconds)
+
+class Tenant:
+    """1組のForgejoインスタンスとMattermostチームの設定
+    
+    テナントごとに専用のHTTP接続プール・レート制限・シークレットを持つ。
+    """
+    def __init__(self, name, config):
+        self.name = name
+        self.forgejo_url = config.get('forgejo_url', '').rstrip('/')
+        self.forgejo_client_id = config.get('forgejo_client_id', '')
+        self.forgejo_client_secret = config.get('forgejo_client_secret', '')
+        self.webhook_secret = config.get('webhook_secret', '')
+        self.mattermost_token = config.get('mattermost_token', '')
+        self.mattermost_api_url = config.get('mattermost_api_url', '')
+        self.mattermost_api_token = config.get('mattermost_api_token', '')
+        self.mattermost_outgoing_token = config.get('mattermost_outgoing_token', '')
+        self.mattermost_websocket_url = config.get('mattermost_websocket_url') or re.sub(
+            r'^http', 'ws', self.mattermost_api_url.rstrip('/')) + '/api/v4/websocket'
+        self.team_domains = set(config.get('team_domains', []))
+        self.fanout_channel_ids = config.get('fanout_channel_ids', [])
+        self.status_card_channel_id = config.get('status_card_channel_id') or \
+            (self.fanout_channel_ids[0] if self.fanout_channel_ids else '')
+        
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=TENANT_POOL_SIZE, pool_maxsize=TENANT_POOL_SIZE)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.rate_limiter = RateLimiter(config.get('rate_limit', TENANT_RATE_LIMIT))
+    
+    def request(self, method, url, **kwargs):
+        """テナントの接続プールとレート制限を使ってHTTPリクエストを送信"""
+        if current_span_var.get() is None:
+            self.rate_limiter.acquire()
+            return self.session.request(method, url, **kwargs)
+        
+        with trace_span(f"HTTP {method}", SPAN_KIND_CLIENT, **{
+            'http.method': method,
+            'http.url': url.split('?', 1)[0],
+            'bridge.tenant': self.name
+        }) as span:
+            self.rate_limiter.acquire()
+            response = self.session.request(method, url, **kwargs)
+            span['attributes']['http.status_code'] = response.status_code
+            return response
+    
+    def scope(self, key):
+        """DBや索引のキーをテナントごとに分離（既定テナントは従来のキーのまま）"""
+        if self.name == DEFAULT_TENANT:
+            return key
+        return f"{self.name}:{key}"
+    
+    def unscope(self, key):
+        """scope() したキーを元に戻す（他テナントのキーならNone）"""
+        if self.name == DEFAULT_TENANT:
+            return None if ':' in key else key
+        prefix = f"{self.name}:"
+        return key[len(prefix):] if key.startswith(prefix) else None
+    
+    @property
+    def mattermost_api_configured(self):
+        return bool(self.mattermost_api_url and self.mattermost_api_token)
+
+class TenantRegistry:
+    """team_domain と Webhook送信元からテナントを引くレジストリ"""
+    def __init__(self):
+        self.tenants = {}
+        self.by_team_domain = {}
+    
+    def add(self, tenant):
+        self.tenants[tenant.name] = tenant
+        for team_domain in tenant.team_domains:
+            self.by_team_domain[team_domain] = tenant
+    
+    @property
+    def default(self):
+        return self.tenants[DEFAULT_TENANT]
+    
+    def get(self, name):
+        return self.tenants.get(name)
+    
+    def for_team_domain(self, team_domain):
+        return self.by_team_domain.get(team_domain, self.default)
+    
+    def for_forgejo_payload(self, data):
+        """Webhookペイロードのリポジトリ URL からForgejoインスタンスを判定"""
+        html_url = (data.get('repository') or {}).get('html_url', '')
+        for tenant in self.tenants.values():
+            if tenant.forgejo_url and html_url.startswith(tenant.forgejo_url + '/'):
+                return tenant
+        return self.default
+
+def load_tenants():
+    """環境変数の既定テナントと TENANTS_FILE のテナントを読み込む"""
+    registry = TenantRegistry()
+    registry.add(Tenant(DEFAULT_TENANT, {
+        'forgejo_url': FORGEJO_URL,
+        'forgejo_client_id': FORGEJO_CLIENT_ID,
+        'forgejo_client_secret': FORGEJO_CLIENT_SECRET,
+        'webhook_secret': WEBHOOK_SECRET,
+        'mattermost_token': MATTERMOST_TOKEN,
+        'mattermost_api_url': MATTERMOST_API_URL,
+        'mattermost_api_token': MATTERMOST_API_TOKEN,
+        'mattermost_outgoing_token': MATTERMOST_OUTGOING_TOKEN,
+        'mattermost_websocket_url': MATTERMOST_WEBSOCKET_URL,
+        'fanout_channel_ids': FANOUT_CHANNEL_IDS,
+        'status_card_channel_id': STATUS_CARD_CHANNEL_ID
+    }))
+    
+    if TENANTS_FILE:
+        with open(TENANTS_FILE, encoding='utf-8') as f:
+            for config in json.load(f):
+                registry.add(Tenant(config['name'], config))
+        logger.info(f"Loaded {len(registry.tenants) - 1} tenants from {TENANTS_FILE}")
+    
+    return registry
+
+tenant_registry = load_tenants()
+current_tenant_var = contextvars.ContextVar('current_tenant', default=None)
+
+def current_tenant():
+    """処理中のリクエストのテナント（未設定なら既定テナント）"""
+    return current_tenant_var.get() or tenant_registry.default
+
+def set_current_tenant(tenant):
+    current_tenant_var.set(tenant)
+
+def submit_with_tenant(executor, fn, *args, **kwargs):
+    """現在のテナントを引き継いでバックグラウンド実行（呼び出し元が結果を待つ処理向け）"""
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+def detached_context():
+    """テナントは引き継ぎ、リクエストのトレースからは切り離したコンテキスト
+    
+    リクエストより長く続く処理のスパンが、書き出し済みのトレースに追加されないようにする。
+    """
+    context = contextvars.copy_context()
+    context.run(current_span_var.set, None)
+    return context
+
+def submit_detached(executor, fn, *args, **kwargs):
+    """リクエストの完了を待たずに続くバックグラウンド処理を実行"""
+    return executor.submit(detached_context().run, fn, *args, **kwargs)
+
+# リクエストトレース設定（空なら記録しない）
+TRACE_FILE = os.getenv('TRACE_FILE', '')
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', '0.1'))
+TRACE_MAX_BYTES = int(os.getenv('TRACE_MAX_BYTES', str(50 * 1024 * 1024)))
+TRACE_BACKUPS = int(os.getenv('TRACE_BACKUPS', '5'))
+TRACE_SERVICE_NAME = os.getenv('TRACE_SERVICE_NAME', 'mattermost-forgejo-bridge')
+
+# OpenTelemetryのSpanKind / StatusCode
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+SPAN_KIND_CLIENT = 3
+SPAN_STATUS_OK = 1
+SPAN_STATUS_ERROR = 2
+
+current_span_var = contextvars.ContextVar('current_span', default=None)
+
+def _build_trace_writer():
+    """トレース1件をOTLP/JSONの1行として書き出すロガー（サイズでローテーション）"""
+    if not TRACE_FILE:
+        return None
+    directory = os.path.dirname(TRACE_FILE)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    trace_writer = logging.getLogger('bridge.traces')
+    trace_writer.propagate = False
+    trace_writer.setLevel(logging.INFO)
+    handler = logging.handlers.RotatingFileHandler(
+        TRACE_FILE, maxBytes=TRACE_MAX_BYTES, backupCount=TRACE_BACKUPS, encoding='utf-8'
+    )
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    trace_writer.addHandler(handler)
+    return trace_writer
+
+trace_writer = _build_trace_writer()
+
+def _otlp_attributes(attributes):
+    converted = []
+    for key, value in attributes.items():
+        if isinstance(value, bool):
+            converted.append({'key': key, 'value': {'boolValue': value}})
+        elif isinstance(value, int):
+            converted.append({'key': key, 'value': {'intValue': str(value)}})
+        elif isinstance(value, float):
+            converted.append({'key': key, 'value': {'doubleValue': value}})
+        else:
+            converted.append({'key': key, 'value': {'stringValue': str(value)}})
+    return converted
+
+def export_trace(spans):
+    """スパン一覧をOTLP/JSON（ResourceSpans）形式で書き出し"""
+    trace_writer.info(json.dumps({'resourceSpans': [{
+        'resource': {'attributes': _otlp_attributes({'service.name': TRACE_SERVICE_NAME, 'service.instance.id': REPLICA_ID})},
+        'scopeSpans': [{
+            'scope': {'name': __name__},
+            'spans': [{
+                'traceId': span['trace_id'],
+                'spanId': span['span_id'],
+                'parentSpanId': span['parent_span_id'],
+                'name': span['name'],
+                'kind': span['kind'],
+                'startTimeUnixNano': str(span['start']),
+                'endTimeUnixNano': str(span['end']),
+                'attributes': _otlp_attributes(span['attributes']),
+                'status': span['status']
+            } for span in spans if span['end']]
+        }]
+    }]}, ensure_ascii=False))
+
+def _start_span(name, kind, attributes, parent):
+    span = {
+        'trace_id': parent['trace_id'] if parent else os.urandom(16).hex(),
+        'span_id': os.urandom(8).hex(),
+        'parent_span_id': parent['span_id'] if parent else '',
+        'name': name,
+        'kind': kind,
+        'start': time.time_ns(),
+        'end': None,
+        'attributes': dict(attributes),
+        'status': {'code': SPAN_STATUS_OK},
+        'spans': parent['spans'] if parent else []
+    }
+    span['spans'].append(span)
+    return span
+
+def _end_span(span, error=None):
+    span['end'] = time.time_ns()
+    if error is not None:
+        span['status'] = {'code': SPAN_STATUS_ERROR, 'message': str(error)}
+
+@contextmanager
+def start_trace(name, **attributes):
+    """リクエスト全体のルートスパンを開始（先頭でサンプリングを決定）"""
+    if not trace_writer or random.random() >= TRACE_SAMPLE_RATE:
+        token = current_span_var.set(None)
+        try:
+            yield None
+        finally:
+            current_span_var.reset(token)
+        return
+    
+    span = _start_span(name, SPAN_KIND_SERVER, attributes, None)
+    token = current_span_var.set(span)
+    error = None
+    try:
+        yield span
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        current_span_var.reset(token)
+        _end_span(span, error)
+        try:
+            export_trace(span['spans'])
+        except Exception as e:
+            logger.error(f"Failed to export trace: {e}")
+
+@contextmanager
+def trace_span(name, kind=SPAN_KIND_INTERNAL, **attributes):
+    """サンプリング対象のリクエスト内で子スパンを記録（対象外なら何もしない）"""
+    parent = current_span_var.get()
+    if parent is None:
+        yield None
+        return
+    
+    span = _start_span(name, kind, attributes, parent)
+    token = current_span_var.set(span)
+    error = None
+    try:
+        yield span
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        current_span_var.reset(token)
+        _end_span(span, error)
+
+def traced(name):
+    """関数呼び出しを子スパンとして記録するデコレーター"""
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            if current_span_var.get() is None:
+                return f(*args, **kwargs)
+            with trace_span(name):
+                return f(*args, **kwargs)
+        return decorated
+    return decorator
+
+def trace_request(f):
+    """Flaskのビュー関数をルートスパン付きで実行"""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        with start_trace(f"{request.method} {request.path}", **{
+            'http.method': request.method,
+            'http.target': request.path,
+            'http.request.content_type': request.content_type or ''
+        }) as span:
+            response = f(*args, **kwargs)
+            if span is not None:
+                status = response[1] if isinstance(response, tuple) else getattr(response, 'status_code', 200)
+                span['attributes']['http.status_code'] = status
+                if current_tenant_var.get():
+                    span['attributes']['bridge.tenant'] = current_tenant().name
+            return response
+    return decorated
+
+# 共有状態ストアとリーダー選出の設定（複数レプリカ構成用）
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'sqlite')
+DB_PATH = os.getenv('DB_PATH', 'bridge.db')
+# 空文字（.env.example をそのままコピーした場合）でも既定値を使う。全レプリカが同じIDだと全員がリーダーになる
+REPLICA_ID = os.getenv('REPLICA_ID') or f"{socket.gethostname()}-{os.getpid()}"
+LEADER_LEASE_TTL = float(os.getenv('LEADER_LEASE_TTL', '30'))
+# 定期ジョブ内のHTTP呼び出しのタイムアウト（秒）
+LEADER_JOB_HTTP_TIMEOUT = float(os.getenv('LEADER_JOB_HTTP_TIMEOUT', '10'))
+TOKEN_PURGE_INTERVAL = float(os.getenv('TOKEN_PURGE_INTERVAL', '3600'))
+
+class SQLiteStateBackend:
+    """SQLiteファイルを共有状態ストアとして使うバックエンド（既定）
+    
+    同じファイルを参照する全レプリカで、トークン・マッピング・リーダーリースを共有する。
+    """
+    def __init__(self, path):
+        self.path = path
+    
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute('PRAGMA busy_timeout = 30000')
+        return conn
+    
+    def configure(self, conn):
+        # 複数プロセスからの同時アクセスに備えてWALを有効化（トランザクション外で実行）
+        conn.execute('PRAGMA journal_mode = WAL')
+    
+    def init_schema(self, cursor):
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS leader_lease (
+                name TEXT PRIMARY KEY,
+                holder TEXT,
+                expires_at REAL
+            )
+        ''')
+    
+    def try_acquire_lease(self, name, holder, ttl):
+        """リースを取得・更新できればTrue（期限切れか自分が保持者の場合のみ）"""
+        conn = self.connect()
+        try:
+            now = time.time()
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute('''
+                INSERT INTO leader_lease (name, holder, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at
+                WHERE leader_lease.holder = excluded.holder OR leader_lease.expires_at < ?
+            ''', (name, holder, now + ttl, now))
+            acquired = cursor.rowcount > 0
+            conn.commit()
+            return acquired
+        finally:
+            conn.close()
+    
+    def release_lease(self, name, holder):
+        conn = self.connect()
+        try:
+            conn.execute('DELETE FROM leader_lease WHERE name = ? AND holder = ?', (name, holder))
+            conn.commit()
+        finally:
+            conn.close()
+    
+    def lease_holder(self, name):
+        conn = self.connect()
+        try:
+            row = conn.execute('SELECT holder, expires_at FROM leader_lease WHERE name = ?', (name,)).fetchone()
+            if row and row[1] >= time.time():
+                return row[0]
+            return None
+        finally:
+            conn.close()
+
+# バックエンドが抽象化するのは接続の作成とリーダーリースのみ。各処理は get_db_connection() の
+# 接続にSQLite方言のSQL（INSERT OR REPLACE など）を直接発行するため、登録できるのは
+# SQLite互換の接続を返すバックエンドに限られる
+STATE_BACKENDS = {
+    'sqlite': SQLiteStateBackend
+}
+
+state_backend = STATE_BACKENDS[STATE_BACKEND](DB_PATH)
+
+def get_db_connection():
+    """共有状態ストアへの接続を取得"""
+    return state_backend.connect()
+
+# SQLite書き込みのグループコミット設定
+DB_WRITE_QUEUE_ENABLED = os.getenv('DB_WRITE_QUEUE_ENABLED', 'true').lower() == 'true'
+DB_GROUP_COMMIT_DELAY = float(os.getenv('DB_GROUP_COMMIT_DELAY', '0.005'))
+DB_GROUP_COMMIT_MAX = int(os.getenv('DB_GROUP_COMMIT_MAX', '256'))
+
+class SQLiteWriteQueue:
+    """全スレッドの書き込みを1つの書き込みスレッドに集め、まとめてコミットする
+    
+    最初の書き込みから最大 max_delay 秒（または max_batch 件）待って1トランザクションで
+    コミットするため、同時に発生した書き込みは1回のfsyncで済む。書き込みごとに
+    SAVEPOINTを切るので、1件の失敗が同じグループの他の書き込みを巻き込まない。
+    """
+    def __init__(self, max_delay, max_batch):
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.commits = 0
+        self.writes = 0
+    
+    def submit(self, statements):
+        """(sql, params) のリストを1単位として投入し、コミット後に完了するFutureを返す"""
+        future = Future()
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='sqlite-writer', daemon=True)
+                self.thread.start()
+        self.queue.put((statements, future))
+        return future
+    
+    def _run(self):
+        conn = get_db_connection()
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.max_delay
+            stop = False
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            self._commit(conn, batch)
+            if stop:
+                break
+        conn.close()
+    
+    def _commit(self, conn, batch):
+        outcomes = []
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for statements, future in batch:
+                conn.execute('SAVEPOINT write_item')
+                try:
+                    rowcount = 0
+                    for sql, params in statements:
+                        rowcount += max(conn.execute(sql, params).rowcount, 0)
+                    conn.execute('RELEASE write_item')
+                    outcomes.append((future, rowcount, None))
+                except sqlite3.Error as e:
+                    conn.execute('ROLLBACK TO write_item')
+                    conn.execute('RELEASE write_item')
+                    outcomes.append((future, None, e))
+            conn.commit()
+        except sqlite3.Error as e:
+            conn.rollback()
+            logger.error(f"Group commit of {len(batch)} writes failed: {e}")
+            outcomes = [(future, None, e) for _, future in batch]
+        
+        with self.lock:
+            self.commits += 1
+            self.writes += len(batch)
+        for future, rowcount, error in outcomes:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(rowcount)
+    
+    def close(self):
+        """未コミットの書き込みを反映してから書き込みスレッドを止める"""
+        with self.lock:
+            thread = self.thread
+        if thread:
+            self.queue.put(None)
+            thread.join(timeout=10)
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'queued': self.queue.qsize(),
+                'commits': self.commits,
+                'writes': self.writes,
+                'writes_per_commit': round(self.writes / self.commits, 2) if self.commits else 0
+            }
+
+db_write_queue = SQLiteWriteQueue(DB_GROUP_COMMIT_DELAY, DB_GROUP_COMMIT_MAX) if DB_WRITE_QUEUE_ENABLED else None
+
+if db_write_queue:
+    atexit.register(db_write_queue.close)
+
+def db_write(statements, wait=True):
+    """書き込みを実行（wait=Trueならコミット完了まで待って影響行数を返す）"""
+    if not db_write_queue:
+        conn = get_db_connection()
+        try:
+            rowcount = sum(max(conn.execute(sql, params).rowcount, 0) for sql, params in statements)
+            conn.commit()
+            return rowcount
+        finally:
+            conn.close()
     
+    future = db_write_queue.submit(statements)
+    if not wait:
+        future.add_done_callback(_log_write_error)
+        return None
+    return future.result()
+
+def _log_write_error(future):
+    if future.exception() is not None:
+        logger.error(f"Queued database write failed: {future.exception()}")
+
+# スキーママイグレーション（起動時に明示的に run_migrations() を呼ぶ）
+def _migration_001_initial_schema(cursor):
     # ユーザートークンテーブル
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS user_tokens (
@@ -63,10 +725,170 @@ def init_db():
         )
     ''')
     
-    conn.commit()
-    conn.close()
+    # ステータスカードテーブル
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS issue_status_cards (
+            issue_key TEXT PRIMARY KEY,
+            post_id TEXT,
+            channel_id TEXT,
+            title TEXT,
+            issue_url TEXT,
+            state TEXT,
+            assignees TEXT,
+            labels TEXT,
+            last_activity TEXT,
+            updated_at TIMESTAMP
+        )
+    ''')
+    
+    # ダイジェスト購読と集計テーブル（イベントごとに件数を加算していく）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS digest_channels (
+            tenant TEXT,
+            channel_id TEXT,
+            schedule TEXT,
+            last_sent_at REAL,
+            PRIMARY KEY (tenant, channel_id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS digest_subscriptions (
+            tenant TEXT,
+            channel_id TEXT,
+            repo TEXT,
+            PRIMARY KEY (tenant, channel_id, repo)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS digest_rollup (
+            tenant TEXT,
+            channel_id TEXT,
+            repo TEXT,
+            kind TEXT,
+            number INTEGER,
+            title TEXT,
+            url TEXT,
+            count INTEGER,
+            PRIMARY KEY (tenant, channel_id, repo, kind, number)
+        )
+    ''')
+    
+    # リポジトリ統計（Webhookごとに加算で更新する集計値）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS repo_stats (
+            tenant TEXT,
+            repo TEXT,
+            open_count INTEGER DEFAULT 0,
+            closed_count INTEGER DEFAULT 0,
+            seeded INTEGER DEFAULT 0,
+            PRIMARY KEY (tenant, repo)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS repo_weekly_stats (
+            tenant TEXT,
+            repo TEXT,
+            week TEXT,
+            opened INTEGER DEFAULT 0,
+            closed INTEGER DEFAULT 0,
+            PRIMARY KEY (tenant, repo, week)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS repo_close_durations (
+            tenant TEXT,
+            repo TEXT,
+            bucket INTEGER,
+            count INTEGER DEFAULT 0,
+            PRIMARY KEY (tenant, repo, bucket)
+        )
+    ''')
+    
+    state_backend.init_schema(cursor)
+
+def _migration_002_lookup_indexes(cursor):
+    # 期限切れトークン削除とダイジェスト対象チャンネルの検索用
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_tokens_expires_at ON user_tokens (expires_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_digest_subscriptions_repo ON digest_subscriptions (tenant, repo)')
+
+def _migration_003_root_message_index(cursor):
+    # スレッド返信から追跡中のIssueを逆引きするため
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_issue_thread_mapping_root ON issue_thread_mapping (root_message_id)')
+
+# (バージョン, 説明, オンライン実行するか, 適用関数)
+# オンラインのマイグレーション（インデックス作成など）は起動後にバックグラウンドで適用する
+MIGRATIONS = [
+    (1, 'initial schema', False, _migration_001_initial_schema),
+    (2, 'lookup indexes for token purge and digests', True, _migration_002_lookup_indexes),
+    (3, 'reverse lookup index on root_message_id', True, _migration_003_root_message_index)
+]
+
+def get_schema_version(conn):
+    row = conn.execute('SELECT MAX(version) FROM schema_version').fetchone()
+    return row[0] or 0
+
+def apply_migration(conn, migration):
+    """1つのマイグレーションを1トランザクションで適用（他のプロセスが適用済みなら何もしない）"""
+    version, description, online, migrate = migration
+    cursor = conn.cursor()
+    cursor.execute('BEGIN IMMEDIATE')
+    try:
+        if get_schema_version(conn) >= version:
+            conn.rollback()
+            return False
+        started = time.monotonic()
+        migrate(cursor)
+        cursor.execute('INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)',
+                       (version, description, datetime.now().isoformat()))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    logger.info(f"Applied schema migration {version} ({description}) in {time.monotonic() - started:.2f}s")
+    return True
+
+def _apply_online_migrations(migrations):
+    conn = get_db_connection()
+    try:
+        for migration in migrations:
+            apply_migration(conn, migration)
+    except Exception as e:
+        logger.error(f"Online schema migration failed: {e}")
+    finally:
+        conn.close()
 
-init_db()
+def run_migrations(background=True):
+    """未適用のマイグレーションを順に適用し、現在のスキーマバージョンを返す
+    
+    最初のオンラインマイグレーションより前のものは同期的に適用する。それ以降は
+    background=True ならバックグラウンドスレッドで適用し、リクエスト処理を止めない。
+    """
+    conn = get_db_connection()
+    try:
+        state_backend.configure(conn)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT,
+                applied_at TEXT
+            )
+        ''')
+        conn.commit()
+        
+        current_version = get_schema_version(conn)
+        pending = [migration for migration in MIGRATIONS if migration[0] > current_version]
+        while pending and not (background and pending[0][2]):
+            apply_migration(conn, pending.pop(0))
+        current_version = get_schema_version(conn)
+    finally:
+        conn.close()
+    
+    if pending:
+        logger.info(f"Applying {len(pending)} online schema migrations in background")
+        threading.Thread(target=_apply_online_migrations, args=(pending,),
+                         name='schema-migrations', daemon=True).start()
+    
+    return current_version
 
 class ForgejoOAuth2API:
     def __init__(self, base_url, client_id, client_secret):
@@ -99,13 +921,89 @@ class ForgejoOAuth2API:
         headers = {'Accept': 'application/json'}
         
         try:
-            response = requests.post(url, data=data, headers=headers)
+            response = current_tenant().request('POST', url, data=data, headers=headers)
             response.raise_for_status()
             return response.json()
         except requests.exceptions.RequestException as e:
             logger.error(f"Failed to exchange code for token: {e}")
             return None
 
+class CachedResponse:
+    """304応答時にキャッシュ済みの本文を返すためのレスポンス"""
+    def __init__(self, entry):
+        self.status_code = 200
+        self.content = entry['body']
+        self.headers = entry['headers']
+    
+    def json(self):
+        return json.loads(self.content)
+    
+    def raise_for_status(self):
+        pass
+
+class ConditionalGetCache:
+    """ETag / Last-Modified 検証子付きのLRUレスポンスキャッシュ
+    
+    エントリごとのサイズ上限と、全体のバイト数上限（LRUで追い出し）を持つ。
+    """
+    def __init__(self, max_bytes, max_entry_bytes):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry:
+                self.entries.move_to_end(key)
+            return entry
+    
+    def put(self, key, response):
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if not (etag or last_modified) or len(response.content) > self.max_entry_bytes:
+            return
+        
+        entry = {
+            'etag': etag,
+            'last_modified': last_modified,
+            'body': response.content,
+            'headers': {k: v for k, v in response.headers.items() if k in ('ETag', 'Last-Modified', 'X-Total-Count', 'Link')}
+        }
+        with self.lock:
+            self._remove(key)
+            self.entries[key] = entry
+            self.total_bytes += len(entry['body'])
+            while self.total_bytes > self.max_bytes and self.entries:
+                self._remove(next(iter(self.entries)))
+    
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry:
+            self.total_bytes -= len(entry['body'])
+    
+    def record(self, hit):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.total_bytes,
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+forgejo_response_cache = ConditionalGetCache(FORGEJO_CACHE_MAX_BYTES, FORGEJO_CACHE_MAX_ENTRY_BYTES)
+
 class ForgejoAPI:
     def __init__(self, base_url, access_token):
         self.base_url = base_url.rstrip('/')
@@ -114,25 +1012,81 @@ class ForgejoAPI:
             'Authorization': f'Bearer {access_token}',
             'Content-Type': 'application/json'
         }
+        # キャッシュはトークンごとに分離（見えるリポジトリがユーザーで異なるため）
+        self.cache_scope = hashlib.sha256(access_token.encode('utf-8')).hexdigest()[:16]
+        self.tenant = current_tenant()
+    
+    def _get(self, url, params=None):
+        """条件付きGET（If-None-Match / If-Modified-Since）でキャッシュを再検証"""
+        if not FORGEJO_CACHE_ENABLED:
+            return self.tenant.request('GET', url, headers=self.headers, params=params)
+        
+        key = (self.cache_scope, url, tuple(sorted((params or {}).items())))
+        entry = forgejo_response_cache.get(key)
+        
+        headers = dict(self.headers)
+        if entry:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+        
+        response = self.tenant.request('GET', url, headers=headers, params=params)
+        
+        if response.status_code == 304 and entry:
+            forgejo_response_cache.record(hit=True)
+            return CachedResponse(entry)
+        
+        forgejo_response_cache.record(hit=False)
+        if response.status_code == 200:
+            forgejo_response_cache.put(key, response)
+        return response
     
     def get_user_info(self):
         """ユーザー情報を取得"""
         url = f"{self.base_url}/api/v1/user"
         try:
-            response = requests.get(url, headers=self.headers)
+            response = self._get(url)
             response.raise_for_status()
             return response.json()
         except requests.exceptions.RequestException as e:
             logger.error(f"Failed to get user info: {e}")
             return None
     
-    def get_user_repos(self):
-        """ユーザーがアクセスできるリポジトリ一覧を取得"""
+    def _get_user_repos_page(self, page, limit):
+        """1ページ分のリポジトリと総件数（X-Total-Count がなければNone）を取得"""
         url = f"{self.base_url}/api/v1/user/repos"
+        response = self._get(url, params={'page': page, 'limit': limit})
+        response.raise_for_status()
+        total_count = response.headers.get('X-Total-Count')
+        return response.json(), int(total_count) if total_count else None
+    
+    def iter_user_repos(self, page_size=None):
+        """ユーザーがアクセスできるリポジトリを全ページ順に返すジェネレーター
+        
+        現在のページを処理している間に次のページを先読みする。サーバー側の
+        MAX_RESPONSE_ITEMS で1ページの件数が page_size より少なくなることがあるため、
+        件数の不足ではなく X-Total-Count（なければ空ページ）で終端を判定する。
+        """
+        page_size = page_size or REPO_PAGE_SIZE
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            page = 1
+            fetched = 0
+            future = submit_with_tenant(executor, self._get_user_repos_page, page, page_size)
+            while future:
+                repos, total_count = future.result()
+                future = None
+                fetched += len(repos)
+                if repos and (total_count is None or fetched < total_count):
+                    page += 1
+                    future = submit_with_tenant(executor, self._get_user_repos_page, page, page_size)
+                for repo in repos:
+                    yield repo
+    
+    def get_user_repos(self):
+        """ユーザーがアクセスできるリポジトリ一覧を取得（全ページ）"""
         try:
-            response = requests.get(url, headers=self.headers)
-            response.raise_for_status()
-            return response.json()
+            return list(self.iter_user_repos())
         except requests.exceptions.RequestException as e:
             logger.error(f"Failed to get user repos: {e}")
             return None
@@ -141,177 +1095,2821 @@ class ForgejoAPI:
         """特定リポジトリへのアクセス権限をチェック"""
         url = f"{self.base_url}/api/v1/repos/{owner}/{repo}"
         try:
-            response = requests.get(url, headers=self.headers)
+            response = self._get(url)
             return response.status_code == 200
         except requests.exceptions.RequestException:
             return False
     
-    def create_issue(self, owner, repo, title, body):
-        """Issue作成"""
-        url = f"{self.base_url}/api/v1/repos/{owner}/{repo}/issues"
-        data = {
-            'title': title,
-            'body': body
-        }
+    def get_repo_issues_page(self, owner, repo, page, limit, state='open'):
+        """リポジトリのIssue一覧を1ページ分取得（総件数も返す）"""
+        url = f"{self.base_url}/api/v1/repos/{owner}/{repo}/issues"
+        params = {'state': state, 'type': 'issues', 'page': page, 'limit': limit}
+        try:
+            response = self.tenant.request('GET', url, headers=self.headers, params=params)
+            response.raise_for_status()
+            total_count = int(response.headers.get('X-Total-Count', 0) or 0)
+            return response.json(), total_count
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Failed to get issues page {page} for {owner}/{repo}: {e}")
+            return None, 0
+    
+    def get_all_repo_issues(self, owner, repo, state='open'):
+        """全ページのIssueを並列数を制限して取得
+        
+        サーバー側の MAX_RESPONSE_ITEMS で件数が切り詰められることがあるため、
+        1ページ目の実際の件数をページ幅として総ページ数を求める。
+        """
+        first_page, total_count = self.get_repo_issues_page(owner, repo, 1, BACKFILL_PAGE_SIZE, state)
+        if first_page is None:
+            return None
+        
+        issues = list(first_page)
+        if not first_page:
+            return issues
+        
+        if not total_count:
+            # X-Total-Count がなければ空ページまで順に取得
+            page = 1
+            while True:
+                page += 1
+                page_issues = self.get_repo_issues_page(owner, repo, page, BACKFILL_PAGE_SIZE, state)[0]
+                if page_issues is None:
+                    return None
+                if not page_issues:
+                    return issues
+                issues.extend(page_issues)
+        
+        total_pages = -(-total_count // len(first_page))
+        if total_pages <= 1:
+            return issues
+        
+        with ThreadPoolExecutor(max_workers=BACKFILL_MAX_CONCURRENCY) as executor:
+            futures = [
+                submit_with_tenant(executor, self.get_repo_issues_page, owner, repo, page, BACKFILL_PAGE_SIZE, state)
+                for page in range(2, total_pages + 1)
+            ]
+            for future in futures:
+                page_issues = future.result()[0]
+                if page_issues is None:
+                    return None
+                issues.extend(page_issues)
+        
+        return issues
+    
+    def create_issue(self, owner, repo, title, body):
+        """Issue作成"""
+        url = f"{self.base_url}/api/v1/repos/{owner}/{repo}/issues"
+        data = {
+            'title': title,
+            'body': body
+        }
+        
+        try:
+            response = self.tenant.request('POST', url, json=data, headers=self.headers)
+            response.raise_for_status()
+            return response.json()
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Failed to create issue: {e}")
+            return None
+    
+    def create_issue_comment(self, owner, repo, issue_number, body):
+        """Issueにコメントを投稿"""
+        url = f"{self.base_url}/api/v1/repos/{owner}/{repo}/issues/{issue_number}/comments"
+        
+        try:
+            response = self.tenant.request('POST', url, json={'body': body}, headers=self.headers)
+            response.raise_for_status()
+            return response.json()
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Failed to comment on {owner}/{repo}#{issue_number}: {e}")
+            return None
+    
+    def set_issue_reaction(self, owner, repo, issue_number, content, added=True):
+        """Issueにリアクションを付与（added=Falseなら取り消し）"""
+        url = f"{self.base_url}/api/v1/repos/{owner}/{repo}/issues/{issue_number}/reactions"
+        
+        try:
+            response = self.tenant.request('POST' if added else 'DELETE', url, json={'content': content}, headers=self.headers)
+            response.raise_for_status()
+            return True
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Failed to update reaction on {owner}/{repo}#{issue_number}: {e}")
+            return False
+
+class MattermostAPI:
+    def __init__(self, api_url, token):
+        self.api_url = api_url.rstrip('/')
+        self.token = token
+        self.headers = {
+            'Authorization': f'Bearer {token}',
+            'Content-Type': 'application/json'
+        }
+        self.tenant = current_tenant()
+    
+    def post_message(self, channel_id, message, root_id=None, timeout=None):
+        """メッセージ投稿"""
+        url = f"{self.api_url}/api/v4/posts"
+        data = {
+            'channel_id': channel_id,
+            'message': message,
+            # ブリッジ自身の投稿をForgejoへ同期し返さないための目印
+            'props': {'from_forgejo_bridge': 'true'}
+        }
+        
+        if root_id:
+            data['root_id'] = root_id
+            
+        try:
+            response = self.tenant.request('POST', url, json=data, headers=self.headers, timeout=timeout)
+            response.raise_for_status()
+            return response.json()
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Failed to post message: {e}")
+            return None
+    
+    def patch_post(self, post_id, message):
+        """既存の投稿を部分更新"""
+        url = f"{self.api_url}/api/v4/posts/{post_id}/patch"
+        data = {'message': message}
+        
+        try:
+            response = self.tenant.request('PUT', url, json=data, headers=self.headers)
+            response.raise_for_status()
+            return response.json()
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Failed to patch post {post_id}: {e}")
+            return None
+    
+    def get_post(self, post_id):
+        """投稿を取得"""
+        url = f"{self.api_url}/api/v4/posts/{post_id}"
+        
+        try:
+            response = self.tenant.request('GET', url, headers=self.headers)
+            response.raise_for_status()
+            return response.json()
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Failed to get post {post_id}: {e}")
+            return None
+
+# ファンアウト用の共有ワーカープール（並列数の上限を全体で共有）
+fanout_executor = ThreadPoolExecutor(max_workers=FANOUT_MAX_WORKERS, thread_name_prefix='fanout')
+
+def build_delivery_targets(thread_info):
+    """イベント通知の配信先一覧を作成（追跡スレッド + FANOUT_CHANNEL_IDS）"""
+    targets = []
+    if thread_info:
+        targets.append({
+            'channel_id': thread_info['channel_id'],
+            'root_id': thread_info.get('root_message_id')
+        })
+    
+    for channel_id in current_tenant().fanout_channel_ids:
+        # 同じチャンネルへの二重投稿を防ぐ
+        if any(target['channel_id'] == channel_id for target in targets):
+            continue
+        targets.append({'channel_id': channel_id, 'root_id': None})
+    
+    return targets
+
+def fan_out_messages(mattermost, targets, message):
+    """複数の配信先へ並列にメッセージを投稿し、配信先ごとの結果を返す
+    
+    遅いチャンネルが他の配信をブロックしないよう、全体を FANOUT_TIMEOUT 秒で打ち切る。
+    """
+    futures = {}
+    for target in targets:
+        future = submit_with_tenant(
+            fanout_executor,
+            mattermost.post_message,
+            target['channel_id'],
+            message,
+            root_id=target.get('root_id'),
+            timeout=FANOUT_TIMEOUT
+        )
+        futures[future] = target
+    
+    done, not_done = wait(futures, timeout=FANOUT_TIMEOUT)
+    
+    results = []
+    for future, target in futures.items():
+        outcome = {'channel_id': target['channel_id'], 'root_id': target.get('root_id'), 'post': None, 'error': None}
+        if future in not_done:
+            future.cancel()
+            outcome['error'] = 'timeout'
+        elif future.exception() is not None:
+            outcome['error'] = str(future.exception())
+        elif future.result() is None:
+            outcome['error'] = 'post failed'
+        else:
+            outcome['post'] = future.result()
+        results.append(outcome)
+    
+    failed = [r for r in results if r['error']]
+    if failed:
+        logger.error(f"Fan-out delivery failed for {len(failed)}/{len(results)} targets: {failed}")
+    else:
+        logger.info(f"Fan-out delivered to {len(results)} targets")
+    
+    return results
+
+def deliver_event_message(message, thread_info, repo=None):
+    """イベント通知を追跡スレッドと追加チャンネルへ配信（ダイジェスト購読チャンネルは除く）"""
+    tenant = current_tenant()
+    if not tenant.mattermost_api_configured:
+        return []
+    
+    targets = build_delivery_targets(thread_info)
+    if targets and repo:
+        digest_channel_ids = get_digest_channels_for_repo(repo)
+        targets = [target for target in targets if target['channel_id'] not in digest_channel_ids]
+    if not targets:
+        return []
+    
+    mattermost = MattermostAPI(tenant.mattermost_api_url, tenant.mattermost_api_token)
+    return fan_out_messages(mattermost, targets, message)
+
+def _truncate_utf8(text, max_bytes):
+    """UTF-8のバイト数上限で文字境界を壊さずに切り詰め"""
+    encoded = text.encode('utf-8')
+    if len(encoded) <= max_bytes:
+        return text
+    return encoded[:max_bytes].decode('utf-8', errors='ignore')
+
+# 切り詰め後に閉じ記号と「…」を付けるための余白（バイト）
+RENDER_CLOSING_RESERVE = 16
+
+def _iter_lines(text):
+    """本文をコピーせずに1行ずつ返すジェネレーター"""
+    start = 0
+    while start < len(text):
+        end = text.find('\n', start)
+        if end == -1:
+            yield text[start:]
+            return
+        yield text[start:end]
+        start = end + 1
+
+def _fence_marker(line):
+    stripped = line.lstrip()
+    for fence in ('```', '~~~'):
+        if stripped.startswith(fence):
+            return fence
+    return None
+
+def _scan_inline_spans(text):
+    """行内のインラインコード・強調・リンクを走査し、空白位置ごとの開いている要素を返す
+    
+    戻り値は (空白位置, その時点のスタック) のリストと、行末時点のスタック。
+    スタックの要素は (記号, 開始位置)。リンクは '[' と '(' で表す。
+    """
+    stack = []
+    boundaries = []
+    i = 0
+    while i < len(text):
+        char = text[i]
+        top = stack[-1][0] if stack else None
+        
+        if char == '\\':
+            i += 2
+            continue
+        
+        if char == '`':
+            end = i
+            while end < len(text) and text[end] == '`':
+                end += 1
+            marker = text[i:end]
+            if top == marker:
+                stack.pop()
+            elif top is None or not top.startswith('`'):
+                stack.append((marker, i))
+            i = end
+            continue
+        
+        # コードとリンクURLの中は記号を解釈しない
+        if top is not None and (top.startswith('`') or top == '('):
+            if top == '(' and char == ')':
+                stack.pop()
+            elif char.isspace() and top == '(':
+                boundaries.append((i, list(stack)))
+            i += 1
+            continue
+        
+        if char.isspace():
+            boundaries.append((i, list(stack)))
+        elif char == '[':
+            stack.append(('[', i))
+        elif char == ']' and top == '[':
+            link_start = stack.pop()[1]
+            if text[i + 1:i + 2] == '(':
+                stack.append(('(', link_start))
+                i += 1
+        elif char in '*_~':
+            marker = text[i:i + 2] if text[i:i + 2] in ('**', '__', '~~') else char
+            if marker == '~':
+                i += 1
+                continue
+            before = text[i - 1] if i > 0 else ' '
+            after = text[i + len(marker):i + len(marker) + 1] or ' '
+            # snake_case のような単語内の '_' は強調として扱わない
+            intraword = marker[0] == '_' and before.isalnum() and after.isalnum()
+            if not intraword:
+                if top == marker and not before.isspace():
+                    stack.pop()
+                elif not after.isspace() and marker not in [entry[0] for entry in stack]:
+                    stack.append((marker, i))
+            i += len(marker)
+            continue
+        i += 1
+    return boundaries, stack
+
+def _truncate_markdown_line(line, max_bytes):
+    """1行をバイト数上限で切り詰め、開いたままのインライン要素を閉じる
+    
+    開いている要素のない最後の空白で切るのを優先し、なければ最後の空白で切って
+    強調・インラインコードを閉じる。途中のリンクはリンクの直前で切る。
+    """
+    partial = _truncate_utf8(line, max_bytes)
+    boundaries, stack = _scan_inline_spans(partial)
+    
+    cut = len(partial)
+    if boundaries:
+        closed = [boundary for boundary in boundaries if not boundary[1]]
+        cut, stack = closed[-1] if closed else boundaries[-1]
+    
+    for index, (marker, start) in enumerate(stack):
+        if marker in ('[', '('):
+            cut, stack = start, stack[:index]
+            break
+    
+    text = partial[:cut].rstrip()
+    if not text:
+        return ''
+    closers = ''.join(marker for marker, _ in reversed(stack))
+    return text + closers + '…'
+
+@traced('render_bounded_markdown')
+def render_bounded_markdown(body, continue_url=None, max_bytes=None, max_lines=None):
+    """Markdown本文をバイト数・行数の上限で切り詰めて描画
+    
+    本文は1行ずつ読み進め、上限に達した時点で打ち切る。行の途中で切る場合は
+    強調・リンクの外側の空白で切り、開いたままの要素とコードブロックを閉じて、
+    末尾に「続きを読む」リンクを付ける。
+    """
+    max_bytes = RENDER_MAX_BYTES if max_bytes is None else max_bytes
+    max_lines = RENDER_MAX_LINES if max_lines is None else max_lines
+    
+    rendered = []
+    used_bytes = 0
+    open_fence = None
+    truncated = False
+    
+    for line_count, line in enumerate(_iter_lines(body or '')):
+        line_bytes = len(line.encode('utf-8')) + 1
+        
+        if line_count >= max_lines:
+            truncated = True
+            break
+        
+        fence = _fence_marker(line)
+        if used_bytes + line_bytes > max_bytes:
+            budget = max(max_bytes - used_bytes - 1 - RENDER_CLOSING_RESERVE, 0)
+            if open_fence is not None or fence:
+                # コードブロック内やフェンス行は記法を解釈せずそのまま切る
+                partial = _truncate_utf8(line, budget).rstrip()
+                if partial:
+                    rendered.append(partial)
+                    if open_fence is None and fence:
+                        open_fence = fence
+            else:
+                partial = _truncate_markdown_line(line, budget)
+                if partial:
+                    rendered.append(partial)
+            truncated = True
+            break
+        
+        if fence:
+            if open_fence is None:
+                open_fence = fence
+            elif open_fence == fence:
+                open_fence = None
+        
+        rendered.append(line)
+        used_bytes += line_bytes
+    
+    if truncated:
+        if open_fence is not None:
+            rendered.append(open_fence)
+        if continue_url:
+            rendered.append('')
+            rendered.append(f"*… [続きを読む]({continue_url})*")
+        else:
+            rendered.append('')
+            rendered.append('*… (省略されました)*')
+    
+    return '\n'.join(rendered)
+
+class AccessibleRepoIndex:
+    """Mattermostユーザーごとのアクセス可能リポジトリ索引
+    
+    索引にあるリポジトリはForgejoに問い合わせずにアクセス可と判断する。
+    古くなった索引は参照時にバックグラウンドで再構築する。
+    補完用に小文字化した "owner/repo" のソート済み配列も持ち、二分探索で前方一致検索する。
+    """
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.users = {}
+        self.refreshing = set()
+        self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='repo-index')
+    
+    def refresh(self, user_id, access_token):
+        """Forgejoから全リポジトリを取得して索引を作り直す"""
+        tenant = current_tenant()
+        user_id = tenant.scope(user_id)
+        try:
+            repos = set()
+            names = {}
+            forgejo_api = ForgejoAPI(tenant.forgejo_url, access_token)
+            for repo in forgejo_api.iter_user_repos():
+                full_name = repo.get('full_name', '')
+                repos.add(full_name.lower())
+                names[full_name.lower()] = full_name
+            with self.lock:
+                self.users[user_id] = {
+                    'repos': repos,
+                    'sorted': sorted(names.items()),
+                    'refreshed_at': time.monotonic()
+                }
+            logger.info(f"Indexed {len(repos)} accessible repos for user {user_id}")
+            return repos
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Failed to refresh repo index for user {user_id}: {e}")
+            return None
+        finally:
+            with self.lock:
+                self.refreshing.discard(user_id)
+    
+    def refresh_async(self, user_id, access_token):
+        """索引の再構築をバックグラウンドで開始（実行中なら何もしない）"""
+        with self.lock:
+            if current_tenant().scope(user_id) in self.refreshing:
+                return
+            self.refreshing.add(current_tenant().scope(user_id))
+        submit_detached(self.executor, self.refresh, user_id, access_token)
+    
+    def contains(self, user_id, access_token, owner, repo):
+        """索引にリポジトリがあればTrue、不明ならNone（古い索引は裏で更新）"""
+        with self.lock:
+            entry = self.users.get(current_tenant().scope(user_id))
+        
+        if not entry:
+            self.refresh_async(user_id, access_token)
+            return None
+        if time.monotonic() - entry['refreshed_at'] > self.ttl:
+            self.refresh_async(user_id, access_token)
+        
+        return True if f"{owner}/{repo}".lower() in entry['repos'] else None
+    
+    def add(self, user_id, owner, repo):
+        """APIで確認できたリポジトリを索引に追加"""
+        full_name = f"{owner}/{repo}"
+        with self.lock:
+            entry = self.users.get(current_tenant().scope(user_id))
+            if entry and full_name.lower() not in entry['repos']:
+                entry['repos'].add(full_name.lower())
+                bisect.insort(entry['sorted'], (full_name.lower(), full_name))
+    
+    def has_index(self, user_id):
+        with self.lock:
+            return current_tenant().scope(user_id) in self.users
+    
+    def complete(self, user_id, prefix, limit):
+        """小文字化した前方一致で "owner/repo" の候補を返す"""
+        prefix = prefix.lower()
+        with self.lock:
+            entry = self.users.get(current_tenant().scope(user_id))
+            if not entry:
+                return []
+            sorted_names = entry['sorted']
+            position = bisect.bisect_left(sorted_names, (prefix,))
+            matches = []
+            while position < len(sorted_names) and len(matches) < limit:
+                lower_name, full_name = sorted_names[position]
+                if not lower_name.startswith(prefix):
+                    break
+                matches.append(full_name)
+                position += 1
+            return matches
+    
+    def complete_owners(self, user_id, prefix, limit):
+        """前方一致するオーナー名を重複なしで返す"""
+        prefix = prefix.lower()
+        with self.lock:
+            entry = self.users.get(current_tenant().scope(user_id))
+            if not entry:
+                return []
+            sorted_names = entry['sorted']
+            position = bisect.bisect_left(sorted_names, (prefix,))
+            owners = []
+            while position < len(sorted_names) and len(owners) < limit:
+                lower_name, full_name = sorted_names[position]
+                if not lower_name.startswith(prefix):
+                    break
+                owner = full_name.split('/', 1)[0]
+                if not owners or owners[-1] != owner:
+                    owners.append(owner)
+                # 同じオーナーの残りのリポジトリは読み飛ばす
+                position = bisect.bisect_left(sorted_names, (owner.lower() + '0',), position)
+            return owners
+    
+    def forget(self, user_id):
+        with self.lock:
+            self.users.pop(current_tenant().scope(user_id), None)
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'users': len(self.users),
+                'repos': sum(len(entry['repos']) for entry in self.users.values())
+            }
+
+repo_index = AccessibleRepoIndex(REPO_INDEX_TTL)
+
+def has_repo_access(user_id, user_token, owner, repo):
+    """リポジトリへのアクセス権限を確認（索引にあればAPI呼び出しを省略）"""
+    if repo_index.contains(user_id, user_token['access_token'], owner, repo):
+        return True
+    
+    forgejo_api = ForgejoAPI(current_tenant().forgejo_url, user_token['access_token'])
+    if forgejo_api.check_repo_access(owner, repo):
+        repo_index.add(user_id, owner, repo)
+        return True
+    return False
+
+def title_ngrams(title, n=3):
+    """タイトルを正規化して文字n-gramの集合に変換（日本語にも対応）"""
+    normalized = re.sub(r'\s+', ' ', title.lower()).strip()
+    if len(normalized) < n:
+        return {normalized} if normalized else set()
+    return {normalized[i:i + n] for i in range(len(normalized) - n + 1)}
+
+class DuplicateIssueIndex:
+    """リポジトリごとの最近のIssueタイトル索引（文字3-gramのJaccard類似度）
+    
+    n-gramからIssue番号への転置索引を持ち、候補だけを比較するため
+    Forgejoの検索APIを呼ばずに数ミリ秒で判定できる。
+    """
+    def __init__(self, max_per_repo, threshold):
+        self.max_per_repo = max_per_repo
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        self.repos = {}
+    
+    def _repo(self, repo_key):
+        repo = self.repos.get(repo_key)
+        if repo is None:
+            repo = {'issues': OrderedDict(), 'postings': {}}
+            self.repos[repo_key] = repo
+        return repo
+    
+    def _remove(self, repo, number):
+        issue = repo['issues'].pop(number, None)
+        if not issue:
+            return
+        for gram in issue['grams']:
+            postings = repo['postings'].get(gram)
+            if postings:
+                postings.discard(number)
+                if not postings:
+                    del repo['postings'][gram]
+    
+    def add(self, repo_key, number, title, url):
+        grams = title_ngrams(title)
+        if not grams:
+            return
+        with self.lock:
+            repo = self._repo(current_tenant().scope(repo_key.lower()))
+            self._remove(repo, number)
+            repo['issues'][number] = {'title': title, 'url': url, 'grams': grams}
+            for gram in grams:
+                repo['postings'].setdefault(gram, set()).add(number)
+            while len(repo['issues']) > self.max_per_repo:
+                self._remove(repo, next(iter(repo['issues'])))
+    
+    def remove(self, repo_key, number):
+        with self.lock:
+            repo = self.repos.get(current_tenant().scope(repo_key.lower()))
+            if repo:
+                self._remove(repo, number)
+    
+    def find_similar(self, repo_key, title, limit=3):
+        """類似度がしきい値以上のIssueを類似度の高い順に返す"""
+        grams = title_ngrams(title)
+        with self.lock:
+            repo = self.repos.get(current_tenant().scope(repo_key.lower()))
+            if not repo or not grams:
+                return []
+            
+            shared = {}
+            for gram in grams:
+                for number in repo['postings'].get(gram, ()):
+                    shared[number] = shared.get(number, 0) + 1
+            
+            matches = []
+            for number, count in shared.items():
+                issue = repo['issues'][number]
+                similarity = count / (len(grams) + len(issue['grams']) - count)
+                if similarity >= self.threshold:
+                    matches.append({
+                        'number': number,
+                        'title': issue['title'],
+                        'url': issue['url'],
+                        'similarity': similarity
+                    })
+        
+        matches.sort(key=lambda match: match['similarity'], reverse=True)
+        return matches[:limit]
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'repos': len(self.repos),
+                'issues': sum(len(repo['issues']) for repo in self.repos.values())
+            }
+
+duplicate_index = DuplicateIssueIndex(DUPLICATE_INDEX_MAX_PER_REPO, DUPLICATE_THRESHOLD)
+
+@traced('sqlite.get_user_token')
+def get_user_token(mattermost_user_id):
+    """DBからユーザートークンを取得（期限切れチェック付き）"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute('''
+        SELECT forgejo_access_token, forgejo_username, expires_at 
+        FROM user_tokens 
+        WHERE mattermost_user_id = ?
+    ''', (current_tenant().scope(mattermost_user_id),))
+    
+    result = cursor.fetchone()
+    conn.close()
+    
+    if result:
+        access_token, forgejo_username, expires_at = result
+        
+        # 期限切れチェックを実装
+        if expires_at:
+            try:
+                expire_time = datetime.fromisoformat(expires_at)
+                if datetime.now() >= expire_time:
+                    logger.warning(f"Token expired for user {mattermost_user_id} at {expires_at}")
+                    return None  # 期限切れは無効
+            except ValueError:
+                logger.error(f"Invalid date format for expires_at: {expires_at}")
+                return None
+        
+        return {
+            'access_token': access_token,
+            'forgejo_username': forgejo_username
+        }
+    return None
+
+def delete_user_token(mattermost_user_id):
+    """指定ユーザーのトークンを削除"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute('''
+        DELETE FROM user_tokens 
+        WHERE mattermost_user_id = ?
+    ''', (current_tenant().scope(mattermost_user_id),))
+    
+    deleted_count = cursor.rowcount
+    conn.commit()
+    conn.close()
+    
+    if deleted_count > 0:
+        logger.info(f"Deleted expired token for user {mattermost_user_id}")
+    
+    return deleted_count > 0
+
+def save_user_token(mattermost_user_id, mattermost_username, token_data, forgejo_username, wait=True):
+    """ユーザートークンをDBに保存"""
+    expires_at = datetime.now() + timedelta(seconds=token_data.get('expires_in', 3600))
+    
+    db_write([('''
+        INSERT OR REPLACE INTO user_tokens 
+        (mattermost_user_id, mattermost_username, forgejo_access_token, 
+         forgejo_refresh_token, forgejo_username, expires_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+    ''', (
+        current_tenant().scope(mattermost_user_id),
+        mattermost_username,
+        token_data.get('access_token'),
+        token_data.get('refresh_token'),
+        forgejo_username,
+        expires_at
+    ))], wait=wait)
+
+def save_issue_thread_mapping(issue_key, channel_id, username, channel_name, 
+                             team_domain, issue_url, root_message_id=None, wait=True):
+    """Issue-スレッドマッピングをDBに保存"""
+    db_write([('''
+        INSERT OR REPLACE INTO issue_thread_mapping 
+        (issue_key, channel_id, mattermost_username, channel_name, 
+         team_domain, created_at, issue_url, root_message_id)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (
+        current_tenant().scope(issue_key), channel_id, username, channel_name,
+        team_domain, datetime.now().isoformat(), issue_url, root_message_id
+    ))], wait=wait)
+
+def save_issue_thread_mappings_bulk(mappings):
+    """複数のIssue-スレッドマッピングを1トランザクションで保存
+    
+    既存のマッピング（/issueで作成したスレッド）は上書きしない。
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    created_at = datetime.now().isoformat()
+    tenant = current_tenant()
+    cursor.executemany('''
+        INSERT OR IGNORE INTO issue_thread_mapping 
+        (issue_key, channel_id, mattermost_username, channel_name, 
+         team_domain, created_at, issue_url, root_message_id)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', [
+        (tenant.scope(m['issue_key']), m['channel_id'], m['username'], m['channel_name'],
+         m['team_domain'], created_at, m['issue_url'], m.get('root_message_id'))
+        for m in mappings
+    ])
+    
+    inserted_count = cursor.rowcount
+    conn.commit()
+    conn.close()
+    
+    return inserted_count
+
+def set_issue_thread_root_message(issue_key, root_message_id):
+    """親投稿のないマッピング（/issue trackで作成）に親投稿IDだけを設定（設定できたらTrue）"""
+    return db_write([('''
+        UPDATE issue_thread_mapping SET root_message_id = ?
+        WHERE issue_key = ? AND root_message_id IS NULL
+    ''', (root_message_id, current_tenant().scope(issue_key)))]) > 0
+
+@traced('sqlite.get_issue_thread_mapping')
+def get_issue_thread_mapping(issue_key):
+    """Issue-スレッドマッピングを取得"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute('''
+        SELECT channel_id, mattermost_username, channel_name, team_domain, 
+               created_at, issue_url, root_message_id
+        FROM issue_thread_mapping 
+        WHERE issue_key = ?
+    ''', (current_tenant().scope(issue_key),))
+    
+    result = cursor.fetchone()
+    conn.close()
+    
+    if result:
+        return {
+            'channel_id': result[0],
+            'username': result[1],
+            'channel_name': result[2],
+            'team_domain': result[3],
+            'created_at': result[4],
+            'issue_url': result[5],
+            'root_message_id': result[6]
+        }
+    return None
+
+def save_status_card(issue_key, card):
+    """ステータスカードの状態をDBに保存"""
+    db_write([('''
+        INSERT OR REPLACE INTO issue_status_cards 
+        (issue_key, post_id, channel_id, title, issue_url, state, 
+         assignees, labels, last_activity, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+    ''', (
+        current_tenant().scope(issue_key), card.get('post_id'), card.get('channel_id'), card.get('title'),
+        card.get('issue_url'), card.get('state'), json.dumps(card.get('assignees', [])),
+        json.dumps(card.get('labels', [])), card.get('last_activity')
+    ))])
+
+def get_status_card(issue_key):
+    """ステータスカードの状態を取得"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute('''
+        SELECT post_id, channel_id, title, issue_url, state, 
+               assignees, labels, last_activity
+        FROM issue_status_cards 
+        WHERE issue_key = ?
+    ''', (current_tenant().scope(issue_key),))
+    
+    result = cursor.fetchone()
+    conn.close()
+    
+    if result:
+        return {
+            'post_id': result[0],
+            'channel_id': result[1],
+            'title': result[2],
+            'issue_url': result[3],
+            'state': result[4],
+            'assignees': json.loads(result[5] or '[]'),
+            'labels': json.loads(result[6] or '[]'),
+            'last_activity': result[7]
+        }
+    return None
+
+def build_status_card(issue, last_activity):
+    """Forgejoのissue/PRペイロードからカードの状態を作成"""
+    state = issue.get('state', 'open')
+    if issue.get('merged'):
+        state = 'merged'
+    
+    return {
+        'title': issue.get('title', ''),
+        'issue_url': issue.get('html_url', ''),
+        'state': state,
+        'assignees': [a.get('login', '') for a in (issue.get('assignees') or [])],
+        'labels': [l.get('name', '') for l in (issue.get('labels') or [])],
+        'last_activity': last_activity
+    }
+
+@traced('render_status_card')
+def render_status_card(issue_key, card):
+    """ステータスカードの本文を描画"""
+    state_icons = {'open': '🟢 Open', 'closed': '🔴 Closed', 'merged': '🟣 Merged'}
+    assignees = ', '.join(f"@{a}" for a in card['assignees']) or '-'
+    labels = ', '.join(f"`{l}`" for l in card['labels']) or '-'
+    
+    return f'''📋 **{issue_key}: {card['title']}**
+
+**State:** {state_icons.get(card['state'], card['state'])}
+**Assignees:** {assignees}
+**Labels:** {labels}
+**Last activity:** {card['last_activity']}
+**URL:** {card['issue_url']}
+
+*This card is updated in place. Comments are posted as replies.*'''
+
+class StatusCardUpdater:
+    """ステータスカードの更新をカードごとにレート制限して反映
+    
+    最小間隔内に来た更新は保留し、間隔が空いた時点で最新状態を1回だけ反映する。
+    """
+    def __init__(self, min_interval):
+        self.min_interval = min_interval
+        self.lock = threading.Lock()
+        self.last_patched = {}
+        self.pending = {}
+    
+    def update(self, issue_key):
+        scoped_key = current_tenant().scope(issue_key)
+        with self.lock:
+            if scoped_key in self.pending:
+                return
+            elapsed = time.monotonic() - self.last_patched.get(scoped_key, float('-inf'))
+            if elapsed < self.min_interval:
+                # タイマースレッドにも現在のテナントを引き継ぐ
+                timer = threading.Timer(
+                    self.min_interval - elapsed,
+                    detached_context().run,
+                    args=(self._flush, issue_key, scoped_key)
+                )
+                timer.daemon = True
+                self.pending[scoped_key] = timer
+                timer.start()
+                return
+            self.last_patched[scoped_key] = time.monotonic()
+        self._patch(issue_key)
+    
+    def _flush(self, issue_key, scoped_key):
+        with self.lock:
+            self.pending.pop(scoped_key, None)
+            self.last_patched[scoped_key] = time.monotonic()
+        self._patch(issue_key)
+    
+    def _patch(self, issue_key):
+        card = get_status_card(issue_key)
+        if not card or not card['post_id']:
+            return
+        
+        tenant = current_tenant()
+        mattermost = MattermostAPI(tenant.mattermost_api_url, tenant.mattermost_api_token)
+        if mattermost.patch_post(card['post_id'], render_status_card(issue_key, card)):
+            logger.info(f"Updated status card for {issue_key}")
+
+status_card_updater = StatusCardUpdater(STATUS_CARD_MIN_INTERVAL)
+
+def update_status_card(issue_key, issue, last_activity):
+    """カードの状態を保存し、レート制限付きで投稿を更新"""
+    card = get_status_card(issue_key)
+    if not card:
+        return False
+    
+    if issue:
+        updated = build_status_card(issue, last_activity)
+        updated['title'] = updated['title'] or card['title']
+        updated['issue_url'] = updated['issue_url'] or card['issue_url']
+        card.update(updated)
+    else:
+        card['last_activity'] = last_activity
+    save_status_card(issue_key, card)
+    status_card_updater.update(issue_key)
+    return True
+
+def create_status_card(issue_key, item, last_activity):
+    """カードのないIssue/PRに、最初に届いたWebhookからカードを作成（作成したらTrue）"""
+    tenant = current_tenant()
+    mattermost = MattermostAPI(tenant.mattermost_api_url, tenant.mattermost_api_token)
+    card = build_status_card(item, last_activity)
+    thread_info = get_issue_thread_mapping(issue_key)
+    
+    if thread_info and thread_info.get('root_message_id'):
+        # 追跡中のスレッドがあれば、その親投稿をカードに置き換える
+        card['channel_id'] = thread_info['channel_id']
+        card['post_id'] = thread_info['root_message_id']
+        if not mattermost.patch_post(card['post_id'], render_status_card(issue_key, card)):
+            return False
+    elif thread_info:
+        # 親投稿のない追跡（/issue track）は、追跡中のチャンネルにカードを投稿して親投稿にする
+        post = mattermost.post_message(thread_info['channel_id'], render_status_card(issue_key, card))
+        if not post:
+            return False
+        card['channel_id'] = thread_info['channel_id']
+        card['post_id'] = post['id']
+        if not set_issue_thread_root_message(issue_key, card['post_id']):
+            logger.warning(f"Thread mapping for {issue_key} changed while creating its status card")
+    else:
+        if not tenant.status_card_channel_id:
+            return False
+        post = mattermost.post_message(tenant.status_card_channel_id, render_status_card(issue_key, card))
+        if not post:
+            return False
+        card['channel_id'] = tenant.status_card_channel_id
+        card['post_id'] = post['id']
+        # 以降のコメントはカードへの返信として投稿する（同時に作成された既存のマッピングは上書きしない）
+        save_issue_thread_mappings_bulk([{
+            'issue_key': issue_key, 'channel_id': card['channel_id'], 'username': '',
+            'channel_name': '', 'team_domain': '', 'issue_url': card['issue_url'],
+            'root_message_id': card['post_id']
+        }])
+    
+    save_status_card(issue_key, card)
+    logger.info(f"Created status card for {issue_key}")
+    return True
+
+def status_cards_enabled():
+    """ステータスカードモードが利用可能か"""
+    return STATUS_CARD_MODE and current_tenant().mattermost_api_configured
+
+@traced('sqlite.get_issue_key_by_root_message')
+def get_issue_key_by_root_message(root_message_id):
+    """スレッドの親投稿IDから追跡中のIssueキーを逆引き"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT issue_key FROM issue_thread_mapping WHERE root_message_id = ?', (root_message_id,))
+    rows = cursor.fetchall()
+    conn.close()
+    
+    tenant = current_tenant()
+    for (issue_key,) in rows:
+        unscoped_key = tenant.unscope(issue_key)
+        if unscoped_key:
+            return unscoped_key
+    return None
+
+class CommentMirrorBatcher:
+    """スレッド返信をIssue・ユーザーごとに短時間まとめ、1件のForgejoコメントとして投稿"""
+    def __init__(self, window, max_items):
+        self.window = window
+        self.max_items = max_items
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.timers = {}
+        self.mirrored_replies = 0
+        self.posted_comments = 0
+    
+    def add(self, issue_key, user_id, message):
+        key = (current_tenant().name, issue_key, user_id)
+        with self.lock:
+            self.pending.setdefault(key, []).append(message)
+            flush_now = len(self.pending[key]) >= self.max_items
+            if not flush_now and key not in self.timers:
+                # タイマースレッドにも現在のテナントを引き継ぐ
+                timer = threading.Timer(self.window, detached_context().run, args=(self.flush, key))
+                timer.daemon = True
+                self.timers[key] = timer
+                timer.start()
+        
+        if flush_now:
+            self.flush(key)
+    
+    def flush(self, key):
+        with self.lock:
+            messages = self.pending.pop(key, [])
+            timer = self.timers.pop(key, None)
+        if timer:
+            timer.cancel()
+        if not messages:
+            return
+        
+        tenant_name, issue_key, user_id = key
+        user_token = get_user_token(user_id)
+        if not user_token:
+            logger.warning(f"Dropped {len(messages)} replies to {issue_key}: user {user_id} is not connected")
+            return
+        
+        repo_full_name, issue_number = issue_key.rsplit('#', 1)
+        owner, repo = repo_full_name.split('/', 1)
+        forgejo_api = ForgejoAPI(current_tenant().forgejo_url, user_token['access_token'])
+        body = '\n\n'.join(messages)
+        # 返ってくるコメントWebhookで同じ内容をスレッドに再投稿しない（Webhookが先に届く場合に備え投稿前に記録）
+        if echo_suppressor:
+            echo_suppressor.record(issue_key, 'created', body)
+        comment = forgejo_api.create_issue_comment(owner, repo, issue_number, body)
+        if echo_suppressor:
+            echo_suppressor.resolve(issue_key, 'created', body, comment.get('id') if comment else None)
+        if comment:
+            with self.lock:
+                self.mirrored_replies += len(messages)
+                self.posted_comments += 1
+            logger.info(f"Mirrored {len(messages)} thread replies to {issue_key} as @{user_token['forgejo_username']}")
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'pending': sum(len(messages) for messages in self.pending.values()),
+                'mirrored_replies': self.mirrored_replies,
+                'posted_comments': self.posted_comments
+            }
+
+comment_mirror_batcher = CommentMirrorBatcher(COMMENT_MIRROR_WINDOW, COMMENT_MIRROR_MAX)
+
+def handle_mattermost_post(post):
+    """追跡スレッドへの返信ならForgejoコメントとして同期（同期対象ならTrue）"""
+    root_id = post.get('root_id')
+    message = (post.get('message') or '').strip()
+    if not COMMENT_MIRROR_ENABLED or not root_id or not message:
+        return False
+    
+    # ブリッジ自身が投稿した通知は同期しない
+    if (post.get('props') or {}).get('from_forgejo_bridge') == 'true':
+        return False
+    
+    issue_key = get_issue_key_by_root_message(root_id)
+    if not issue_key:
+        return False
+    
+    comment_mirror_batcher.add(issue_key, post.get('user_id', ''), message)
+    return True
+
+# Mattermostの絵文字名 → Forgejoのリアクション
+REACTION_EMOJI_MAP = {
+    '+1': '+1', 'thumbsup': '+1',
+    '-1': '-1', 'thumbsdown': '-1',
+    'laughing': 'laugh', 'smile': 'laugh',
+    'tada': 'hooray', 'hooray': 'hooray',
+    'confused': 'confused',
+    'heart': 'heart',
+    'rocket': 'rocket',
+    'eyes': 'eyes'
+}
+
+def handle_mattermost_reaction(reaction, added=True):
+    """追跡スレッドの親投稿へのリアクションをIssueのリアクションとして同期"""
+    content = REACTION_EMOJI_MAP.get(reaction.get('emoji_name', ''))
+    if not COMMENT_MIRROR_ENABLED or not content:
+        return False
+    
+    issue_key = get_issue_key_by_root_message(reaction.get('post_id', ''))
+    if not issue_key:
+        return False
+    
+    user_token = get_user_token(reaction.get('user_id', ''))
+    if not user_token:
+        return False
+    
+    repo_full_name, issue_number = issue_key.rsplit('#', 1)
+    owner, repo = repo_full_name.split('/', 1)
+    forgejo_api = ForgejoAPI(current_tenant().forgejo_url, user_token['access_token'])
+    return forgejo_api.set_issue_reaction(owner, repo, issue_number, content, added)
+
+# ダイジェストの見出し（表示順）
+DIGEST_SECTIONS = [
+    ('issue_opened', '🆕 Issues opened'),
+    ('issue_closed', '✅ Issues closed'),
+    ('issue_commented', '💬 Issues commented'),
+    ('pr_merged', '🔀 PRs merged')
+]
+
+def normalize_repo_name(full_name):
+    """Forgejoのオーナー名・リポジトリ名は大文字小文字を区別しないため、保存・照合用に小文字にそろえる"""
+    return full_name.lower()
+
+def subscribe_digest(channel_id, schedule, repos):
+    """チャンネルをダイジェスト配信に登録"""
+    tenant_name = current_tenant().name
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT INTO digest_channels (tenant, channel_id, schedule, last_sent_at) VALUES (?, ?, ?, ?)
+        ON CONFLICT(tenant, channel_id) DO UPDATE SET schedule = excluded.schedule
+    ''', (tenant_name, channel_id, schedule, time.time()))
+    cursor.executemany('''
+        INSERT OR IGNORE INTO digest_subscriptions (tenant, channel_id, repo) VALUES (?, ?, ?)
+    ''', [(tenant_name, channel_id, normalize_repo_name(repo)) for repo in repos])
+    conn.commit()
+    conn.close()
+
+def unsubscribe_digest(channel_id):
+    """チャンネルのダイジェスト配信を解除（未送信の集計も破棄）"""
+    tenant_name = current_tenant().name
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    for table in ('digest_channels', 'digest_subscriptions', 'digest_rollup'):
+        cursor.execute(f'DELETE FROM {table} WHERE tenant = ? AND channel_id = ?', (tenant_name, channel_id))
+    conn.commit()
+    conn.close()
+
+def get_digest_repos(channel_id):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT repo FROM digest_subscriptions WHERE tenant = ? AND channel_id = ? ORDER BY repo
+    ''', (current_tenant().name, channel_id))
+    repos = [row[0] for row in cursor.fetchall()]
+    conn.close()
+    return repos
+
+def get_digest_channels_for_repo(repo):
+    """リポジトリをダイジェスト購読しているチャンネルIDの集合を取得"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT channel_id FROM digest_subscriptions WHERE tenant = ? AND repo = ?
+    ''', (current_tenant().name, normalize_repo_name(repo)))
+    channel_ids = {row[0] for row in cursor.fetchall()}
+    conn.close()
+    return channel_ids
+
+def record_digest_event(repo, kind, number, title, url):
+    """購読中の全チャンネルの集計行にイベントを1件加算（コミットは待たない）"""
+    db_write([('''
+        INSERT INTO digest_rollup (tenant, channel_id, repo, kind, number, title, url, count)
+        SELECT tenant, channel_id, repo, ?, ?, ?, ?, 1 FROM digest_subscriptions
+        WHERE tenant = ? AND repo = ?
+        ON CONFLICT(tenant, channel_id, repo, kind, number)
+        DO UPDATE SET count = count + 1, title = excluded.title, url = excluded.url
+    ''', (kind, number, title, url, current_tenant().name, normalize_repo_name(repo)))], wait=False)
+
+def take_digest_rollup(tenant_name, channel_id):
+    """チャンネルの集計行を取り出して削除"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('BEGIN IMMEDIATE')
+    cursor.execute('''
+        SELECT repo, kind, number, title, url, count FROM digest_rollup
+        WHERE tenant = ? AND channel_id = ? ORDER BY repo, kind, number
+    ''', (tenant_name, channel_id))
+    rows = cursor.fetchall()
+    cursor.execute('DELETE FROM digest_rollup WHERE tenant = ? AND channel_id = ?', (tenant_name, channel_id))
+    conn.commit()
+    conn.close()
+    return rows
+
+def restore_digest_rollup(tenant_name, channel_id, rows):
+    """投稿に失敗した集計行を戻す（その間に加算された分と合算）"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.executemany('''
+        INSERT INTO digest_rollup (tenant, channel_id, repo, kind, number, title, url, count)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(tenant, channel_id, repo, kind, number) DO UPDATE SET count = count + excluded.count
+    ''', [(tenant_name, channel_id) + tuple(row) for row in rows])
+    conn.commit()
+    conn.close()
+
+@traced('render_digest')
+def render_digest(schedule, since, rows):
+    """集計行からリポジトリごとのダイジェスト投稿を作成"""
+    by_repo = OrderedDict()
+    for repo, kind, number, title, url, count in rows:
+        by_repo.setdefault(repo, {}).setdefault(kind, []).append((number, title, url, count))
+    
+    lines = [f"📰 **{schedule.capitalize()} digest** (since {datetime.fromtimestamp(since).strftime('%Y-%m-%d %H:%M')})"]
+    for repo, kinds in by_repo.items():
+        lines.append('')
+        lines.append(f"#### {repo}")
+        for kind, label in DIGEST_SECTIONS:
+            items = kinds.get(kind)
+            if not items:
+                continue
+            lines.append(f"**{label} ({len(items)})**")
+            for number, title, url, count in items:
+                suffix = f" ({count} comments)" if kind == 'issue_commented' else ''
+                lines.append(f"- [#{number} {title}]({url}){suffix}")
+    
+    return render_bounded_markdown('\n'.join(lines), max_bytes=DIGEST_MAX_BYTES, max_lines=len(lines))
+
+def send_due_digests():
+    """配信時刻を過ぎたチャンネルにダイジェストを投稿（リーダーのみ実行）"""
+    now = time.time()
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT tenant, channel_id, schedule, last_sent_at FROM digest_channels')
+    channels = cursor.fetchall()
+    conn.close()
+    
+    for tenant_name, channel_id, schedule, last_sent_at in channels:
+        if now - (last_sent_at or 0) < DIGEST_SCHEDULES.get(schedule, DIGEST_SCHEDULES['daily']):
+            continue
+        tenant = tenant_registry.get(tenant_name)
+        if not tenant or not tenant.mattermost_api_configured:
+            continue
+        set_current_tenant(tenant)
+        
+        rows = take_digest_rollup(tenant_name, channel_id)
+        if rows:
+            mattermost = MattermostAPI(tenant.mattermost_api_url, tenant.mattermost_api_token)
+            if not mattermost.post_message(channel_id, render_digest(schedule, last_sent_at or now, rows),
+                                           timeout=LEADER_JOB_HTTP_TIMEOUT):
+                logger.error(f"Failed to post digest to {channel_id}, keeping {len(rows)} rollup rows")
+                restore_digest_rollup(tenant_name, channel_id, rows)
+                continue
+            logger.info(f"Posted {schedule} digest with {len(rows)} items to {channel_id}")
+        
+        conn = get_db_connection()
+        conn.execute('UPDATE digest_channels SET last_sent_at = ? WHERE tenant = ? AND channel_id = ?',
+                     (now, tenant_name, channel_id))
+        conn.commit()
+        conn.close()
+
+def handle_digest_command(text, user_id, user_token, channel_id):
+    """チャンネルのダイジェスト配信を設定"""
+    parts = text.split()
+    usage = '❌ **Error**: Usage: `/issue digest <hourly|daily> <owner>/<repo> ...` または `/issue digest off`'
+    
+    if len(parts) == 1:
+        repos = get_digest_repos(channel_id)
+        return jsonify({
+            'response_type': 'ephemeral',
+            'text': f"📰 **Digest:** {', '.join(repos)}" if repos else usage
+        })
+    
+    if parts[1] == 'off':
+        unsubscribe_digest(channel_id)
+        return jsonify({
+            'response_type': 'ephemeral',
+            'text': '✅ このチャンネルのダイジェスト配信を解除しました。個別通知に戻ります。'
+        })
+    
+    repos = parts[2:]
+    if parts[1] not in DIGEST_SCHEDULES or not repos or any(repo.count('/') != 1 for repo in repos):
+        return jsonify({'response_type': 'ephemeral', 'text': usage})
+    
+    for repo in repos:
+        owner, name = repo.split('/')
+        if not has_repo_access(user_id, user_token, owner, name):
+            return jsonify({
+                'response_type': 'ephemeral',
+                'text': f"❌ **Error**: リポジトリ `{repo}` にアクセスできません。"
+            })
+    
+    subscribe_digest(channel_id, parts[1], repos)
+    return jsonify({
+        'response_type': 'ephemeral',
+        'text': f'''✅ **Digest: {parts[1]}**
+
+**対象:** {', '.join(repos)}
+
+これらのリポジトリのイベントは個別に投稿せず、{parts[1]}のサマリーとしてまとめて投稿します。'''
+    })
+
+def normalize_forgejo_event(data):
+    """Forgejo Webhookペイロードをイベントストアの1行に正規化"""
+    repository = data.get('repository') or {}
+    if 'comment' in data and 'issue' in data:
+        kind, item = 'issue_comment', data['issue']
+        url = (data.get('comment') or {}).get('html_url', '')
+    elif 'issue' in data:
+        kind, item = 'issues', data['issue']
+        url = item.get('html_url', '')
+    elif 'pull_request' in data:
+        kind, item = 'pull_request', data['pull_request']
+        url = item.get('html_url', '')
+    else:
+        return None
+    
+    return (
+        time.time(),
+        current_tenant().name,
+        kind,
+        data.get('action', ''),
+        f"{(repository.get('owner') or {}).get('login', '')}/{repository.get('name', '')}",
+        item.get('number'),
+        (data.get('sender') or {}).get('login', ''),
+        item.get('title', ''),
+        url
+    )
+
+EVENT_COLUMNS = ['ts', 'tenant', 'kind', 'action', 'repo', 'number', 'sender', 'title', 'url']
+
+class EventStore:
+    """正規化イベントを日付ごとのテーブル（events_YYYYMMDD）に追記するストア
+    
+    書き込みはバッファしてトランザクション単位でまとめて挿入する。保持期間を過ぎた
+    データはテーブルごとDROPするため、行単位の削除は発生しない。
+    """
+    PARTITION_PATTERN = re.compile(r'events_\d{8}')
+    
+    def __init__(self, flush_interval, flush_batch, retention_days):
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self.retention_days = retention_days
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.pending = []
+        self.known_partitions = set()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.appended = 0
+        self.written = 0
+    
+    @staticmethod
+    def partition_name(ts):
+        return 'events_' + datetime.fromtimestamp(ts).strftime('%Y%m%d')
+    
+    def append(self, data):
+        """Webhookペイロードを正規化してバッファに追加"""
+        row = normalize_forgejo_event(data)
+        if row is None:
+            return
+        with self.lock:
+            self.pending.append(row)
+            self.appended += 1
+            if len(self.pending) >= self.flush_batch:
+                self.wakeup.set()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='event-store', daemon=True)
+                self.thread.start()
+    
+    def _run(self):
+        while True:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Failed to flush event store: {e}")
+    
+    def _ensure_partition(self, cursor, partition):
+        """パーティションを作成（作成文を実行したらTrue。既知扱いにするのはコミット後）"""
+        if partition in self.known_partitions:
+            return False
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS {partition} (
+                id INTEGER PRIMARY KEY,
+                ts REAL,
+                tenant TEXT,
+                kind TEXT,
+                action TEXT,
+                repo TEXT,
+                number INTEGER,
+                sender TEXT,
+                title TEXT,
+                url TEXT
+            )
+        ''')
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS {partition}_repo ON {partition} (tenant, repo, ts)')
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS {partition}_issue ON {partition} (tenant, repo, number)')
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS {partition}_ts ON {partition} (ts)')
+        return True
+    
+    def flush(self):
+        """バッファ中のイベントをパーティションごとに一括挿入"""
+        with self.lock:
+            rows, self.pending = self.pending, []
+        if not rows:
+            return 0
+        
+        by_partition = {}
+        for row in rows:
+            by_partition.setdefault(self.partition_name(row[0]), []).append(row)
+        
+        with self.flush_lock:
+            conn = get_db_connection()
+            try:
+                cursor = conn.cursor()
+                cursor.execute('BEGIN IMMEDIATE')
+                created = []
+                for partition, partition_rows in by_partition.items():
+                    if self._ensure_partition(cursor, partition):
+                        created.append(partition)
+                    cursor.executemany(f'''
+                        INSERT INTO {partition} ({', '.join(EVENT_COLUMNS)})
+                        VALUES ({', '.join('?' for _ in EVENT_COLUMNS)})
+                    ''', partition_rows)
+                conn.commit()
+                self.known_partitions.update(created)
+            except Exception:
+                conn.rollback()
+                # 他のレプリカがDROPしたテーブルを既知のままにしないよう、次回は作成から確認し直す
+                self.known_partitions.clear()
+                with self.lock:
+                    self.pending[:0] = rows
+                raise
+            finally:
+                conn.close()
+        
+        with self.lock:
+            self.written += len(rows)
+        return len(rows)
+    
+    def partitions(self):
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'events_%'")
+        names = sorted(row[0] for row in cursor.fetchall() if self.PARTITION_PATTERN.fullmatch(row[0]))
+        conn.close()
+        return names
+    
+    def drop_expired(self):
+        """保持期間を過ぎたパーティションをDROP（リーダーのみ実行）"""
+        cutoff = self.partition_name(time.time() - self.retention_days * 86400)
+        expired = [partition for partition in self.partitions() if partition < cutoff]
+        if not expired:
+            return
+        
+        with self.flush_lock:
+            conn = get_db_connection()
+            for partition in expired:
+                conn.execute(f'DROP TABLE IF EXISTS {partition}')
+                self.known_partitions.discard(partition)
+            conn.commit()
+            conn.close()
+        logger.info(f"Dropped {len(expired)} expired event partitions: {expired}")
+    
+    def query(self, repo=None, since=None, cursor=None, limit=EVENTS_PAGE_SIZE):
+        """イベントを古い順に取得し、(events, next_cursor) を返す
+        
+        cursor は "<パーティション>:<id>" 形式で、前ページの最後のイベントを指す。
+        """
+        after_partition, after_id = None, 0
+        if cursor:
+            after_partition, _, after_id = cursor.partition(':')
+            if not self.PARTITION_PATTERN.fullmatch(after_partition) or not after_id.isdigit():
+                raise ValueError('Invalid cursor')
+            after_id = int(after_id)
+        
+        since = since or 0
+        first_partition = self.partition_name(since) if since else None
+        conditions = ['tenant = ?', 'ts >= ?', 'id > ?']
+        params = [current_tenant().name, since]
+        if repo:
+            conditions.append('repo = ?')
+            params.append(repo)
+        
+        events = []
+        next_cursor = None
+        conn = get_db_connection()
+        try:
+            for partition in self.partitions():
+                if first_partition and partition < first_partition:
+                    continue
+                if after_partition and partition < after_partition:
+                    continue
+                start_id = after_id if partition == after_partition else 0
+                rows = conn.execute(f'''
+                    SELECT id, {', '.join(EVENT_COLUMNS)} FROM {partition}
+                    WHERE {' AND '.join(conditions)} ORDER BY id LIMIT ?
+                ''', params[:2] + [start_id] + params[2:] + [limit - len(events)]).fetchall()
+                for row in rows:
+                    event = dict(zip(EVENT_COLUMNS, row[1:]))
+                    event['timestamp'] = datetime.fromtimestamp(event.pop('ts')).isoformat()
+                    events.append(event)
+                if len(events) >= limit:
+                    next_cursor = f"{partition}:{rows[-1][0]}"
+                    break
+        finally:
+            conn.close()
+        
+        return events, next_cursor
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'pending': len(self.pending),
+                'appended': self.appended,
+                'written': self.written,
+                'retention_days': self.retention_days
+            }
+
+event_store = EventStore(EVENT_FLUSH_INTERVAL, EVENT_FLUSH_BATCH, EVENT_RETENTION_DAYS) if EVENT_STORE_ENABLED else None
+
+if event_store:
+    atexit.register(event_store.flush)
+
+def require_admin_token(f):
+    """Authorization: Bearer <ADMIN_TOKEN> を要求するデコレーター"""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        if not ADMIN_TOKEN:
+            return jsonify({'error': 'ADMIN_TOKEN is not configured'}), 403
+        auth_header = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(auth_header.encode('utf-8'), f"Bearer {ADMIN_TOKEN}".encode('utf-8')):
+            return jsonify({'error': 'Unauthorized'}), 401
+        return f(*args, **kwargs)
+    return decorated
+
+def parse_since(value):
+    """since パラメータ（UNIX秒またはISO 8601）をUNIX秒に変換"""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+# クローズまでの時間のヒストグラム（対数バケット、1バケットあたり約19%の幅）
+CLOSE_DURATION_BUCKET_BASE = 2 ** 0.25
+
+def parse_forgejo_time(value):
+    """Forgejoの日時文字列（ISO 8601、末尾Z可）をUNIX秒に変換"""
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+    except ValueError:
+        return None
+
+def close_duration_bucket(seconds):
+    return int(math.log(max(seconds, 1), CLOSE_DURATION_BUCKET_BASE))
+
+def record_issue_stats(repo, action, issue):
+    """issuesイベント1件分をリポジトリ統計に反映（定数回の更新のみ）"""
+    if action == 'opened':
+        deltas = (1, 0, 'opened')
+    elif action == 'closed':
+        deltas = (-1, 1, 'closed')
+    elif action == 'reopened':
+        deltas = (1, -1, None)
+    else:
+        return
+    
+    tenant_name = current_tenant().name
+    repo = normalize_repo_name(repo)
+    open_delta, closed_delta, weekly_column = deltas
+    statements = [('''
+        INSERT INTO repo_stats (tenant, repo, open_count, closed_count) VALUES (?, ?, MAX(?, 0), MAX(?, 0))
+        ON CONFLICT(tenant, repo) DO UPDATE SET
+            open_count = MAX(open_count + ?, 0),
+            closed_count = MAX(closed_count + ?, 0)
+    ''', (tenant_name, repo, open_delta, closed_delta, open_delta, closed_delta))]
+    
+    if weekly_column:
+        statements.append((f'''
+            INSERT INTO repo_weekly_stats (tenant, repo, week, {weekly_column}) VALUES (?, ?, ?, 1)
+            ON CONFLICT(tenant, repo, week) DO UPDATE SET {weekly_column} = {weekly_column} + 1
+        ''', (tenant_name, repo, datetime.now().strftime('%G-W%V'))))
+    
+    if action == 'closed':
+        created_at = parse_forgejo_time(issue.get('created_at'))
+        closed_at = parse_forgejo_time(issue.get('closed_at')) or time.time()
+        if created_at:
+            statements.append(('''
+                INSERT INTO repo_close_durations (tenant, repo, bucket, count) VALUES (?, ?, ?, 1)
+                ON CONFLICT(tenant, repo, bucket) DO UPDATE SET count = count + 1
+            ''', (tenant_name, repo, close_duration_bucket(closed_at - created_at))))
+    
+    # 統計は即時に読み返す必要がないためコミットを待たない
+    db_write(statements, wait=False)
+
+def seed_repo_stats(repo, open_count, closed_count):
+    """初回のみForgejoの総件数で件数を初期化"""
+    conn = get_db_connection()
+    conn.execute('''
+        INSERT INTO repo_stats (tenant, repo, open_count, closed_count, seeded) VALUES (?, ?, ?, ?, 1)
+        ON CONFLICT(tenant, repo) DO UPDATE SET
+            open_count = excluded.open_count, closed_count = excluded.closed_count, seeded = 1
+    ''', (current_tenant().name, normalize_repo_name(repo), open_count, closed_count))
+    conn.commit()
+    conn.close()
+
+def get_repo_stats(repo):
+    """集計済みのリポジトリ統計を取得（未初期化ならNone）"""
+    tenant_name = current_tenant().name
+    repo = normalize_repo_name(repo)
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT open_count, closed_count FROM repo_stats WHERE tenant = ? AND repo = ? AND seeded = 1
+    ''', (tenant_name, repo))
+    counts = cursor.fetchone()
+    if not counts:
+        conn.close()
+        return None
+    
+    cursor.execute('''
+        SELECT opened, closed FROM repo_weekly_stats WHERE tenant = ? AND repo = ? AND week = ?
+    ''', (tenant_name, repo, datetime.now().strftime('%G-W%V')))
+    weekly = cursor.fetchone() or (0, 0)
+    
+    cursor.execute('''
+        SELECT bucket, count FROM repo_close_durations WHERE tenant = ? AND repo = ? ORDER BY bucket
+    ''', (tenant_name, repo))
+    histogram = cursor.fetchall()
+    conn.close()
+    
+    # ヒストグラムから中央値を求める（バケットの幾何平均で近似）
+    median_seconds = None
+    total = sum(count for _, count in histogram)
+    seen = 0
+    for bucket, count in histogram:
+        seen += count
+        if seen * 2 >= total:
+            median_seconds = CLOSE_DURATION_BUCKET_BASE ** (bucket + 0.5)
+            break
+    
+    return {
+        'open': counts[0],
+        'closed': counts[1],
+        'opened_this_week': weekly[0],
+        'closed_this_week': weekly[1],
+        'median_time_to_close': median_seconds,
+        'close_samples': total
+    }
+
+def format_duration(seconds):
+    """秒数を「3日4時間」のような表記に変換"""
+    minutes = int(seconds // 60)
+    days, minutes = divmod(minutes, 1440)
+    hours, minutes = divmod(minutes, 60)
+    if days:
+        return f"{days}日{hours}時間"
+    if hours:
+        return f"{hours}時間{minutes}分"
+    return f"{max(minutes, 1)}分"
+
+def handle_stats_command(text, user_id, user_token):
+    """リポジトリのIssue統計を表示"""
+    parts = text.split()
+    if len(parts) != 2 or parts[1].count('/') != 1:
+        return jsonify({
+            'response_type': 'ephemeral',
+            'text': '❌ **Error**: Usage: `/issue stats <owner>/<repo>`'
+        })
+    
+    repo = parts[1]
+    owner, name = repo.split('/')
+    if not has_repo_access(user_id, user_token, owner, name):
+        return jsonify({
+            'response_type': 'ephemeral',
+            'text': f"❌ **Error**: リポジトリ `{repo}` にアクセスできません。"
+        })
+    
+    stats = get_repo_stats(repo)
+    if stats is None:
+        # 初回だけ件数の総数を取得（以降はWebhookで加算）
+        forgejo_api = ForgejoAPI(current_tenant().forgejo_url, user_token['access_token'])
+        open_page, open_count = forgejo_api.get_repo_issues_page(owner, name, 1, 1, 'open')
+        closed_page, closed_count = forgejo_api.get_repo_issues_page(owner, name, 1, 1, 'closed')
+        if open_page is None or closed_page is None:
+            return jsonify({
+                'response_type': 'ephemeral',
+                'text': f"❌ **Error**: `{repo}` のIssue件数を取得できませんでした。"
+            })
+        seed_repo_stats(repo, open_count, closed_count)
+        stats = get_repo_stats(repo)
+    
+    median = stats['median_time_to_close']
+    median_text = f"約{format_duration(median)}（{stats['close_samples']}件）" if median else 'データなし'
+    
+    return jsonify({
+        'response_type': 'ephemeral',
+        'text': f'''📊 **{repo} Issue統計**
+
+**オープン:** {stats['open']}件
+**クローズ:** {stats['closed']}件
+**今週オープン:** {stats['opened_this_week']}件
+**今週クローズ:** {stats['closed_this_week']}件
+**クローズまでの時間（中央値）:** {median_text}
+
+💡 今週の件数と中央値はWebhookの受信開始以降のイベントから集計しています。'''
+    })
+
+# キャプチャ時に伏せ字にするヘッダー・フィールド
+CAPTURE_REDACTED_HEADERS = {'authorization', 'cookie', 'x-hub-signature', 'x-hub-signature-256',
+                            'x-gitea-signature', 'x-forgejo-signature'}
+CAPTURE_REDACTED_FIELDS = {'token', 'secret'}
+
+class WebhookCaptureWriter:
+    """受信した/webhookリクエストをgzip圧縮のJSONLに追記（サイズでローテーション）"""
+    def __init__(self, path, max_bytes, backups):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.lock = threading.Lock()
+        self.raw_file = None
+        self.gzip_file = None
+    
+    def _open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.raw_file = open(self.path, 'ab')
+        self.gzip_file = gzip.GzipFile(fileobj=self.raw_file, mode='ab')
+    
+    def close(self):
+        with self.lock:
+            self._close()
+    
+    def _close(self):
+        if self.gzip_file:
+            self.gzip_file.close()
+            self.raw_file.close()
+        self.gzip_file = None
+        self.raw_file = None
+    
+    def _rotate(self):
+        self._close()
+        for index in range(self.backups - 1, 0, -1):
+            source = f"{self.path}.{index}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{index + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+    
+    def write(self, record):
+        line = (json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8')
+        with self.lock:
+            if self.gzip_file is None:
+                self._open()
+            self.gzip_file.write(line)
+            self.gzip_file.flush()
+            if self.raw_file.tell() >= self.max_bytes:
+                self._rotate()
+
+webhook_capture_writer = WebhookCaptureWriter(
+    WEBHOOK_CAPTURE_PATH, WEBHOOK_CAPTURE_MAX_BYTES, WEBHOOK_CAPTURE_BACKUPS
+) if WEBHOOK_CAPTURE_PATH else None
+
+if webhook_capture_writer:
+    atexit.register(webhook_capture_writer.close)
+
+def redact_capture_body(content_type, body):
+    """キャプチャ用にリクエストボディの秘密情報を伏せ字にする"""
+    text = body.decode('utf-8', errors='replace')
+    
+    if content_type == 'application/x-www-form-urlencoded':
+        fields = [
+            (key, '***' if key in CAPTURE_REDACTED_FIELDS else value)
+            for key, value in urllib.parse.parse_qsl(text, keep_blank_values=True)
+        ]
+        return urllib.parse.urlencode(fields)
+    
+    try:
+        payload = json.loads(text)
+    except ValueError:
+        return text
+    if isinstance(payload, dict) and CAPTURE_REDACTED_FIELDS & payload.keys():
+        for key in CAPTURE_REDACTED_FIELDS & payload.keys():
+            payload[key] = '***'
+        return json.dumps(payload, ensure_ascii=False)
+    return text
+
+def capture_webhook_request(req):
+    """/webhookリクエストをキャプチャファイルに記録"""
+    try:
+        headers = {
+            key: ('***' if key.lower() in CAPTURE_REDACTED_HEADERS else value)
+            for key, value in req.headers.items()
+        }
+        webhook_capture_writer.write({
+            'captured_at': datetime.now().isoformat(),
+            'method': req.method,
+            'content_type': req.content_type,
+            'headers': headers,
+            'body': redact_capture_body(req.content_type, req.get_data())
+        })
+    except Exception as e:
+        logger.error(f"Failed to capture webhook request: {e}")
+
+class LaneScheduler:
+    """重み付き公平キューイングで各レーンのタスクを共有ワーカープールに割り当てる
+    
+    タスクには仮想終了時刻（現在の仮想時刻とレーンの前回値の大きい方 + 1/重み）を付け、
+    実行可能なレーンのうち最小のものから取り出す。レーンごとの同時実行上限により、
+    Webhookが殺到しても対話レーン用のワーカーは常に空けておける。
+    """
+    def __init__(self, workers, lanes):
+        self.workers = workers
+        self.lanes = lanes
+        self.condition = threading.Condition()
+        self.queues = {name: deque() for name in lanes}
+        self.last_finish = {name: 0.0 for name in lanes}
+        self.running = {name: 0 for name in lanes}
+        self.completed = {name: 0 for name in lanes}
+        self.virtual_time = 0.0
+        self.threads = []
+    
+    def _ensure_workers(self):
+        with self.condition:
+            if self.threads:
+                return
+            for index in range(self.workers):
+                thread = threading.Thread(target=self._worker, name=f"lane-worker-{index}", daemon=True)
+                thread.start()
+                self.threads.append(thread)
+    
+    def submit(self, lane, fn, *args, **kwargs):
+        """レーンにタスクを投入し、Futureを返す（呼び出し元のコンテキストを引き継ぐ）"""
+        self._ensure_workers()
+        future = Future()
+        context = contextvars.copy_context()
+        with self.condition:
+            finish = max(self.virtual_time, self.last_finish[lane]) + 1.0 / self.lanes[lane]['weight']
+            self.last_finish[lane] = finish
+            self.queues[lane].append((finish, future, context, fn, args, kwargs))
+            self.condition.notify()
+        return future
+    
+    def run(self, lane, fn, *args, **kwargs):
+        """レーン経由で実行して結果を待つ（レーン無効時はその場で実行）"""
+        if not PRIORITY_LANES_ENABLED:
+            return fn(*args, **kwargs)
+        return self.submit(lane, fn, *args, **kwargs).result()
+    
+    def _next_task(self):
+        best_lane = None
+        for lane, lane_queue in self.queues.items():
+            if not lane_queue or self.running[lane] >= self.lanes[lane]['max_workers']:
+                continue
+            if best_lane is None or lane_queue[0][0] < self.queues[best_lane][0][0]:
+                best_lane = lane
+        if best_lane is None:
+            return None, None
+        task = self.queues[best_lane].popleft()
+        self.virtual_time = task[0]
+        return best_lane, task
+    
+    def _worker(self):
+        while True:
+            with self.condition:
+                lane, task = self._next_task()
+                while task is None:
+                    self.condition.wait()
+                    lane, task = self._next_task()
+                self.running[lane] += 1
+            
+            finish, future, context, fn, args, kwargs = task
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(context.run(fn, *args, **kwargs))
+                except BaseException as e:
+                    future.set_exception(e)
+            
+            with self.condition:
+                self.running[lane] -= 1
+                self.completed[lane] += 1
+                # 上限で待たされていたレーンを再評価させる
+                self.condition.notify_all()
+    
+    def stats(self):
+        with self.condition:
+            return {
+                lane: {
+                    'queued': len(self.queues[lane]),
+                    'running': self.running[lane],
+                    'completed': self.completed[lane],
+                    'weight': self.lanes[lane]['weight'],
+                    'max_workers': self.lanes[lane]['max_workers']
+                }
+                for lane in self.lanes
+            }
+
+lane_scheduler = LaneScheduler(LANE_WORKERS, {
+    'interactive': {'weight': LANE_INTERACTIVE_WEIGHT, 'max_workers': LANE_WORKERS},
+    'webhook': {'weight': LANE_WEBHOOK_WEIGHT,
+                'max_workers': max(1, LANE_WORKERS - LANE_INTERACTIVE_RESERVED)}
+})
+
+class PartitionedExecutor:
+    """キーごとに固定のパーティション（単一スレッド）で実行するワーカープール
+    
+    同じキーのタスクは投入順に1つずつ実行され、異なるキーは並列に実行される。
+    """
+    def __init__(self, partitions, name):
+        self.name = name
+        self.queues = [queue.Queue() for _ in range(max(1, partitions))]
+        self.completed = [0] * len(self.queues)
+        self.lock = threading.Lock()
+        self.threads = []
+    
+    def _ensure_workers(self):
+        with self.lock:
+            if self.threads:
+                return
+            for index in range(len(self.queues)):
+                thread = threading.Thread(target=self._worker, args=(index,),
+                                          name=f"{self.name}-{index}", daemon=True)
+                thread.start()
+                self.threads.append(thread)
+    
+    def partition_for(self, key):
+        return zlib.crc32(key.encode('utf-8')) % len(self.queues)
+    
+    def submit(self, key, fn, *args, **kwargs):
+        """キーのパーティションにタスクを投入し、Futureを返す"""
+        self._ensure_workers()
+        future = Future()
+        self.queues[self.partition_for(key)].put((future, contextvars.copy_context(), fn, args, kwargs))
+        return future
+    
+    def _worker(self, index):
+        while True:
+            future, context, fn, args, kwargs = self.queues[index].get()
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(context.run(fn, *args, **kwargs))
+                except BaseException as e:
+                    future.set_exception(e)
+            self.completed[index] += 1
+    
+    def stats(self):
+        depths = [q.qsize() for q in self.queues]
+        return {
+            'partitions': len(self.queues),
+            'depths': depths,
+            'max_depth': max(depths),
+            'completed': sum(self.completed)
+        }
+
+def webhook_issue_key(data):
+    """Webhookペイロードから順序付けのキー（テナント付きのIssue/PRキー）を求める"""
+    repository = data.get('repository') or {}
+    full_name = repository.get('full_name') or \
+        f"{(repository.get('owner') or {}).get('login', '')}/{repository.get('name', '')}"
+    item = data.get('issue') or data.get('pull_request') or {}
+    if item.get('number'):
+        return current_tenant().scope(f"{full_name}#{item['number']}")
+    return current_tenant().scope(full_name)
+
+event_partitions = PartitionedExecutor(EVENT_PARTITIONS, 'event-partition')
+
+def process_forgejo_webhook(data):
+    """受理済みのWebhookをwebhookレーンで処理（受理したリクエストのトレースは書き出し済みのため独立したトレースとして記録）"""
+    with start_trace('process webhook', **{'bridge.tenant': current_tenant().name}), app.app_context():
+        return lane_scheduler.run('webhook', handle_forgejo_webhook, data)
+
+def _log_webhook_result(future):
+    if future.exception() is not None:
+        logger.error(f"Queued webhook failed: {future.exception()}")
+        return
+    result = future.result()
+    if isinstance(result, tuple) and result[1] >= 500:
+        logger.error(f"Queued webhook failed with status {result[1]}")
+
+class EchoSuppressor:
+    """ブリッジが行った操作を短時間記録し、その操作で返ってくるWebhookを判定する件数上限付きTTLキャッシュ
+    
+    APIを呼ぶ前に、Issue作成は (リポジトリ, 'opened', タイトル)、コメント投稿は
+    (Issueキー, 'created', 本文) で未確定の操作として記録する。未確定の記録は一度一致したら
+    消費するため、同じ内容の人間の操作は抑止しない。API応答後は resolve() でIssue番号・
+    コメントIDの記録に置き換え、Forgejoの再送はIDで判定する。Forgejoのオーナー名・
+    リポジトリ名は大文字小文字を区別しないため、入力された表記と正規の full_name を同一視する。
+    
+    記録はプロセス内にのみ保持するため、別のレプリカに届いたWebhookは抑止できない。
+    """
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.recorded = 0
+        self.suppressed = 0
+    
+    def _content_key(self, target, action, content):
+        return (current_tenant().scope(target.lower()), action, 'content', (content or '').strip())
+    
+    def _id_key(self, target, action, object_id):
+        return (current_tenant().scope(target.lower()), action, 'id', str(object_id))
+    
+    def _put(self, key, count):
+        self.entries[key] = (time.monotonic() + self.ttl, count)
+        self.entries.move_to_end(key)
+        self._evict()
+    
+    def _consume(self, key):
+        # 未確定の記録を1件消費（消費できたらTrue）
+        entry = self.entries.get(key)
+        if not entry:
+            return False
+        expires_at, count = entry
+        if count > 1:
+            self.entries[key] = (expires_at, count - 1)
+        else:
+            del self.entries[key]
+        return True
+    
+    def record(self, target, action, content):
+        """ブリッジ自身の操作を未確定として記録（APIを呼ぶ前に呼ぶ）"""
+        key = self._content_key(target, action, content)
+        with self.lock:
+            self._evict()
+            entry = self.entries.get(key)
+            self._put(key, entry[1] + 1 if entry else 1)
+            self.recorded += 1
+    
+    def resolve(self, target, action, content, object_id):
+        """API応答後に未確定の記録をIssue番号・コメントIDの記録に置き換える（失敗時は object_id=None で取り消す）"""
+        content_key = self._content_key(target, action, content)
+        with self.lock:
+            self._evict()
+            if object_id is None:
+                self._consume(content_key)
+                return
+            id_key = self._id_key(target, action, object_id)
+            # 先にWebhookが届いていれば、未確定の記録はそのとき消費済み
+            if id_key not in self.entries:
+                self._consume(content_key)
+            self._put(id_key, 1)
+    
+    def match(self, data):
+        """Webhookペイロードが記録済みの操作によるものか判定"""
+        repository = data.get('repository') or {}
+        full_name = repository.get('full_name') or \
+            f"{(repository.get('owner') or {}).get('login', '')}/{repository.get('name', '')}"
+        issue = data.get('issue') or {}
+        action = data.get('action', '')
+        if 'comment' in data and issue:
+            target = f"{full_name}#{issue.get('number', '')}"
+            object_id, content = data['comment'].get('id'), data['comment'].get('body')
+        elif issue and action == 'opened':
+            target = full_name
+            object_id, content = issue.get('number'), issue.get('title')
+        else:
+            return False
+        
+        with self.lock:
+            self._evict()
+            id_key = self._id_key(target, action, object_id)
+            # IDで確定済みの操作は、Forgejoの再送にも対応できるよう期限までは何度でも一致させる
+            if id_key not in self.entries:
+                if object_id is None or not self._consume(self._content_key(target, action, content)):
+                    return False
+                self._put(id_key, 1)
+            self.suppressed += 1
+            return True
+    
+    def _evict(self):
+        # TTLは一定なので先頭ほど先に期限切れになる
+        now = time.monotonic()
+        while self.entries:
+            key, (expires_at, _) = next(iter(self.entries.items()))
+            if expires_at > now and len(self.entries) <= self.max_entries:
+                break
+            del self.entries[key]
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'recorded': self.recorded,
+                'suppressed': self.suppressed
+            }
+
+echo_suppressor = EchoSuppressor(ECHO_TTL, ECHO_MAX_ENTRIES) if ECHO_SUPPRESSION_ENABLED else None
+
+class WebhookSpool:
+    """検証済みWebhookを追記専用のセグメントファイルに溜め、コンシューマープールで順に処理
+    
+    レコードは4バイト長（ビッグエンディアン）+ JSON。読み出し位置は checkpoint に保存し、
+    読み終えたセグメントは削除する。処理は少なくとも1回（再起動時は未確定分を再処理）。
+    失敗したレコードは retry セグメントに退避して読み出し位置を進め、指数バックオフで
+    max_attempts 回まで再試行する。再試行を待つ間、同じIssueの後続レコードはその後ろに
+    並べて順序を保ち、他のIssueの処理は止めない。それでも失敗したら dead-letter セグメントに移す。
+    """
+    CHECKPOINT_FILE = 'checkpoint'
+    DEAD_LETTER_FILE = 'dead-letter.seg'
+    RETRY_FILE = 'retry.seg'
+    
+    def __init__(self, directory, segment_bytes, consumers, batch_size, fsync=False,
+                 max_attempts=5, retry_backoff=1.0):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.batch_size = batch_size
+        self.fsync = fsync
+        self.max_attempts = max(max_attempts, 1)
+        self.retry_backoff = retry_backoff
+        os.makedirs(directory, exist_ok=True)
+        
+        self.lock = threading.Lock()
+        self.available = threading.Condition(self.lock)
+        segments = self._segments()
+        self.write_segment = segments[-1] if segments else 0
+        self.write_file = None
+        self.read_segment, self.read_offset = self._load_checkpoint(segments)
+        self.executor = PartitionedExecutor(consumers, 'spool-consumer')
+        self.consumers = consumers
+        self.thread = None
+        self.appended = 0
+        self.processed = 0
+        self.failed = 0
+        self.retried = 0
+        self.dead_lettered = 0
+        # 再試行待ちのレコード（順序付けのキー → [レコード, 試行済み回数] の列）
+        self.retrying = {}
+    
+    def _segment_path(self, segment):
+        return os.path.join(self.directory, f"{segment:016d}.seg")
+    
+    def _segments(self):
+        return sorted(int(name[:-4]) for name in os.listdir(self.directory)
+                      if name.endswith('.seg') and name[:-4].isdigit())
+    
+    def _load_checkpoint(self, segments):
+        try:
+            with open(os.path.join(self.directory, self.CHECKPOINT_FILE)) as f:
+                segment, offset = f.read().split()
+                return int(segment), int(offset)
+        except (OSError, ValueError):
+            return (segments[0] if segments else 0), 0
+    
+    def _save_checkpoint(self, segment, offset):
+        path = os.path.join(self.directory, self.CHECKPOINT_FILE)
+        with open(f"{path}.tmp", 'w') as f:
+            f.write(f"{segment} {offset}")
+        os.replace(f"{path}.tmp", path)
+        
+        # 読み終えたセグメントを削除
+        for old_segment in self._segments():
+            if old_segment >= segment:
+                break
+            os.remove(self._segment_path(old_segment))
+        
+        self.read_segment, self.read_offset = segment, offset
+    
+    @staticmethod
+    def _frame(record):
+        data = json.dumps(record, ensure_ascii=False).encode('utf-8')
+        return len(data).to_bytes(4, 'big') + data
+    
+    def append(self, record):
+        """レコードを追記（ディスクへの書き込みだけで返る）"""
+        frame = self._frame(record)
+        
+        with self.available:
+            if self.write_file is None:
+                self.write_file = open(self._segment_path(self.write_segment), 'ab')
+            self.write_file.write(frame)
+            self.write_file.flush()
+            if self.fsync:
+                os.fsync(self.write_file.fileno())
+            if self.write_file.tell() >= self.segment_bytes:
+                self.write_file.close()
+                self.write_file = None
+                self.write_segment += 1
+            self.appended += 1
+            self.available.notify()
+        
+        self.start()
+    
+    def _read_segment(self, segment, offset, limit):
+        """セグメントをmmapで読み、offset以降の完全なレコードを最大limit件返す"""
+        records = []
+        try:
+            f = open(self._segment_path(segment), 'rb')
+        except FileNotFoundError:
+            return records, offset
+        
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            if size <= offset:
+                return records, offset
+            with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as view:
+                while offset + 4 <= size and len(records) < limit:
+                    length = int.from_bytes(view[offset:offset + 4], 'big')
+                    if offset + 4 + length > size:
+                        # 書き込み途中のレコード
+                        break
+                    records.append(json.loads(view[offset + 4:offset + 4 + length].decode('utf-8')))
+                    offset += 4 + length
+        return records, offset
+    
+    def _read_batch(self):
+        """チェックポイント以降のレコードを最大batch_size件読み出す"""
+        records = []
+        segment, offset = self.read_segment, self.read_offset
+        while len(records) < self.batch_size:
+            with self.lock:
+                closed = segment < self.write_segment
+            batch, offset = self._read_segment(segment, offset, self.batch_size - len(records))
+            records.extend(batch)
+            if len(records) >= self.batch_size or not closed:
+                break
+            # 書き込みが終わったセグメントを読み切ったので次へ
+            segment, offset = segment + 1, 0
+        return records, segment, offset
+    
+    @staticmethod
+    def _parse(record):
+        """レコードのテナントを現在のテナントにし、ペイロードを返す"""
+        tenant = tenant_registry.get(record.get('tenant')) or tenant_registry.default
+        set_current_tenant(tenant)
+        try:
+            return json.loads(record['body'])
+        except ValueError:
+            return {}
+    
+    def _submit(self, record):
+        """同じIssueのレコードが同じコンシューマーで順に処理されるように投入"""
+        data = self._parse(record)
+        key = webhook_issue_key(data)
+        return self.executor.submit(key, self._process, key, record, data)
+    
+    def _handle(self, data):
+        result = process_forgejo_webhook(data)
+        # ハンドラーは例外を500応答に変換するため、ステータスで失敗を判定
+        status = result[1] if isinstance(result, tuple) else 200
+        if status >= 500:
+            raise RuntimeError(f"handler returned {status}")
+    
+    def _attempt(self, data, attempt):
+        try:
+            self._handle(data)
+        except Exception as e:
+            logger.error(f"Failed to process spooled webhook (attempt {attempt}/{self.max_attempts}): {e}")
+            return False
+        with self.lock:
+            self.processed += 1
+        return True
+    
+    def _process(self, key, record, data):
+        """レコードを処理（同じIssueに再試行待ちがあれば、追い越さないようにその後ろに並べる）"""
+        with self.lock:
+            pending = self.retrying.get(key)
+            if pending is not None:
+                pending.append([record, 0])
+                self._persist_retry(record)
+                return
+        
+        if self._attempt(data, 1):
+            return
+        if self.max_attempts == 1:
+            with self.lock:
+                self.failed += 1
+            self._dead_letter(record)
+            return
+        
+        # 読み出し位置を進められるよう退避し、このパーティションは止めずに後で再試行
+        with self.lock:
+            self.retrying[key] = deque([[record, 1]])
+            self._persist_retry(record)
+        self._schedule_retry(key, 1)
+    
+    def _schedule_retry(self, key, attempts):
+        with self.lock:
+            self.retried += 1
+        delay = min(self.retry_backoff * 2 ** (attempts - 1), 60)
+        timer = threading.Timer(delay, self.executor.submit, args=(key, self._retry, key))
+        timer.daemon = True
+        timer.start()
+    
+    def _retry(self, key):
+        """再試行待ちを先頭から順に処理（元のレコードと同じパーティションで実行される）"""
+        while True:
+            with self.lock:
+                pending = self.retrying[key]
+                entry = pending[0]
+            record, attempts = entry
+            if not self._attempt(self._parse(record), attempts + 1):
+                entry[1] = attempts + 1
+                if entry[1] < self.max_attempts:
+                    self._schedule_retry(key, entry[1])
+                    return
+                with self.lock:
+                    self.failed += 1
+                self._dead_letter(record)
+            
+            with self.lock:
+                pending.popleft()
+                if pending:
+                    continue
+                del self.retrying[key]
+                if not self.retrying:
+                    # 再試行待ちがなくなったら退避ファイルを空にする
+                    open(os.path.join(self.directory, self.RETRY_FILE), 'wb').close()
+                return
+    
+    def _persist_retry(self, record):
+        """再試行待ちのレコードを retry セグメントに追記（self.lock を保持して呼ぶ）"""
+        with open(os.path.join(self.directory, self.RETRY_FILE), 'ab') as f:
+            f.write(self._frame(record))
+            f.flush()
+            os.fsync(f.fileno())
+    
+    def _load_retries(self):
+        """前回の再試行待ちを読み込み、すぐに再試行する（完了済みの分も含め少なくとも1回）"""
+        path = os.path.join(self.directory, self.RETRY_FILE)
+        try:
+            with open(path, 'rb') as f:
+                content = f.read()
+        except FileNotFoundError:
+            return
+        
+        offset = 0
+        with self.lock:
+            while offset + 4 <= len(content):
+                length = int.from_bytes(content[offset:offset + 4], 'big')
+                if offset + 4 + length > len(content):
+                    break
+                record = json.loads(content[offset + 4:offset + 4 + length].decode('utf-8'))
+                offset += 4 + length
+                self.retrying.setdefault(webhook_issue_key(self._parse(record)), deque()).append([record, 0])
+            keys = list(self.retrying)
+        for key in keys:
+            self.executor.submit(key, self._retry, key)
+    
+    def _dead_letter(self, record):
+        """再試行しきれなかったレコードを dead-letter セグメントに退避"""
+        with self.lock:
+            with open(os.path.join(self.directory, self.DEAD_LETTER_FILE), 'ab') as f:
+                f.write(self._frame(record))
+                f.flush()
+                os.fsync(f.fileno())
+            self.dead_lettered += 1
+        logger.error(f"Moved spooled webhook to {self.DEAD_LETTER_FILE} after {self.max_attempts} attempts")
+    
+    def _run(self):
+        self._load_retries()
+        while True:
+            try:
+                with self.lock:
+                    seen = self.appended
+                records, segment, offset = self._read_batch()
+                
+                # バッチ内は異なるIssueを並列に処理し、全件完了してから読み出し位置を確定
+                futures = [self._submit(record) for record in records]
+                wait(futures)
+                if (segment, offset) != (self.read_segment, self.read_offset):
+                    self._save_checkpoint(segment, offset)
+                
+                if not records:
+                    with self.available:
+                        if self.appended == seen:
+                            self.available.wait(1.0)
+            except Exception as e:
+                logger.error(f"Webhook spool consumer error: {e}")
+                time.sleep(1)
+    
+    def start(self):
+        with self.lock:
+            if self.thread:
+                return
+            self.thread = threading.Thread(target=self._run, name='spool-reader', daemon=True)
+        self.thread.start()
+    
+    def close(self):
+        with self.lock:
+            if self.write_file:
+                self.write_file.close()
+                self.write_file = None
+    
+    def stats(self):
+        segments = self._segments()
+        pending_bytes = sum(os.path.getsize(self._segment_path(segment)) for segment in segments
+                            if segment >= self.read_segment) - self.read_offset
+        with self.lock:
+            return {
+                'segments': len(segments),
+                'pending_bytes': max(pending_bytes, 0),
+                'appended': self.appended,
+                'processed': self.processed,
+                'failed': self.failed,
+                'retried': self.retried,
+                'dead_lettered': self.dead_lettered,
+                'retrying': sum(len(pending) for pending in self.retrying.values()),
+                'consumers': self.consumers,
+                'partitions': self.executor.stats()
+            }
+
+webhook_spool = WebhookSpool(
+    SPOOL_DIR, SPOOL_SEGMENT_BYTES, SPOOL_CONSUMERS, SPOOL_BATCH_SIZE, SPOOL_FSYNC,
+    SPOOL_MAX_ATTEMPTS, SPOOL_RETRY_BACKOFF
+) if SPOOL_DIR else None
+
+if webhook_spool:
+    atexit.register(webhook_spool.close)
+
+class WebSocketConnection:
+    """標準ライブラリのみで実装した最小限のWebSocketクライアント（RFC 6455）"""
+    GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+    OP_CONTINUATION, OP_TEXT, OP_BINARY, OP_CLOSE, OP_PING, OP_PONG = 0x0, 0x1, 0x2, 0x8, 0x9, 0xA
+    
+    def __init__(self, url, headers=None, timeout=10):
+        parsed = urllib.parse.urlsplit(url)
+        secure = parsed.scheme == 'wss'
+        host = parsed.hostname
+        port = parsed.port or (443 if secure else 80)
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
         
-        try:
-            response = requests.post(url, json=data, headers=self.headers)
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Failed to create issue: {e}")
-            return None
-
-class MattermostAPI:
-    def __init__(self, api_url, token):
-        self.api_url = api_url.rstrip('/')
-        self.token = token
-        self.headers = {
-            'Authorization': f'Bearer {token}',
-            'Content-Type': 'application/json'
-        }
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        if secure:
+            self.sock = ssl.create_default_context().wrap_socket(self.sock, server_hostname=host)
+        self.buffer = bytearray()
+        self.fragments = []
+        
+        key = base64.b64encode(os.urandom(16)).decode()
+        lines = [
+            f"GET {path} HTTP/1.1",
+            f"Host: {parsed.netloc}",
+            'Upgrade: websocket',
+            'Connection: Upgrade',
+            f"Sec-WebSocket-Key: {key}",
+            'Sec-WebSocket-Version: 13'
+        ]
+        lines += [f"{name}: {value}" for name, value in (headers or {}).items()]
+        self.sock.sendall(('\r\n'.join(lines) + '\r\n\r\n').encode())
+        
+        while b'\r\n\r\n' not in self.buffer:
+            self._recv_more()
+        head, _, rest = bytes(self.buffer).partition(b'\r\n\r\n')
+        self.buffer = bytearray(rest)
+        
+        status_line, *header_lines = head.decode('latin-1').split('\r\n')
+        if status_line.split(' ')[1:2] != ['101']:
+            raise ConnectionError(f"WebSocket handshake failed: {status_line}")
+        response_headers = {}
+        for line in header_lines:
+            name, _, value = line.partition(':')
+            response_headers[name.strip().lower()] = value.strip()
+        expected = base64.b64encode(hashlib.sha1((key + self.GUID).encode()).digest()).decode()
+        if response_headers.get('sec-websocket-accept') != expected:
+            raise ConnectionError('WebSocket handshake failed: invalid Sec-WebSocket-Accept')
     
-    def post_message(self, channel_id, message, root_id=None):
-        """メッセージ投稿"""
-        url = f"{self.api_url}/api/v4/posts"
-        data = {
-            'channel_id': channel_id,
-            'message': message
-        }
+    def _recv_more(self):
+        chunk = self.sock.recv(65536)
+        if not chunk:
+            raise ConnectionError('WebSocket connection closed by peer')
+        self.buffer += chunk
+    
+    def _parse_frame(self):
+        """バッファから1フレームを取り出す（揃っていなければNone、途中のデータは残す）"""
+        if len(self.buffer) < 2:
+            return None
+        fin = self.buffer[0] & 0x80
+        opcode = self.buffer[0] & 0x0F
+        masked = self.buffer[1] & 0x80
+        length = self.buffer[1] & 0x7F
+        offset = 2
+        if length == 126:
+            if len(self.buffer) < 4:
+                return None
+            length = int.from_bytes(self.buffer[2:4], 'big')
+            offset = 4
+        elif length == 127:
+            if len(self.buffer) < 10:
+                return None
+            length = int.from_bytes(self.buffer[2:10], 'big')
+            offset = 10
+        mask = b''
+        if masked:
+            mask = bytes(self.buffer[offset:offset + 4])
+            offset += 4
+        if len(self.buffer) < offset + length:
+            return None
         
-        if root_id:
-            data['root_id'] = root_id
+        payload = bytes(self.buffer[offset:offset + length])
+        del self.buffer[:offset + length]
+        if masked:
+            payload = self._apply_mask(payload, mask)
+        return fin, opcode, payload
+    
+    @staticmethod
+    def _apply_mask(payload, mask):
+        if not payload:
+            return payload
+        repeated = (mask * (len(payload) // 4 + 1))[:len(payload)]
+        return (int.from_bytes(payload, 'big') ^ int.from_bytes(repeated, 'big')).to_bytes(len(payload), 'big')
+    
+    def send(self, payload, opcode=OP_TEXT):
+        """フレームを送信（クライアントからのフレームは必ずマスクする）"""
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        header = bytearray([0x80 | opcode])
+        if len(payload) < 126:
+            header.append(0x80 | len(payload))
+        elif len(payload) < 65536:
+            header.append(0x80 | 126)
+            header += len(payload).to_bytes(2, 'big')
+        else:
+            header.append(0x80 | 127)
+            header += len(payload).to_bytes(8, 'big')
+        mask = os.urandom(4)
+        self.sock.sendall(bytes(header) + mask + self._apply_mask(payload, mask))
+    
+    def ping(self):
+        self.send(b'', self.OP_PING)
+    
+    def recv(self):
+        """テキストメッセージを1件受信（pongはNone、タイムアウトは socket.timeout）"""
+        while True:
+            frame = self._parse_frame()
+            if frame is None:
+                self._recv_more()
+                continue
             
+            fin, opcode, payload = frame
+            if opcode == self.OP_PING:
+                self.send(payload, self.OP_PONG)
+            elif opcode == self.OP_PONG:
+                return None
+            elif opcode == self.OP_CLOSE:
+                raise ConnectionError('WebSocket closed by server')
+            else:
+                self.fragments.append(payload)
+                if fin:
+                    message = b''.join(self.fragments)
+                    self.fragments = []
+                    return message.decode('utf-8')
+    
+    def close(self):
         try:
-            response = requests.post(url, json=data, headers=self.headers)
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Failed to post message: {e}")
-            return None
+            self.send(b'', self.OP_CLOSE)
+        except OSError:
+            pass
+        self.sock.close()
 
-def get_user_token(mattermost_user_id):
-    """DBからユーザートークンを取得（期限切れチェック付き）"""
-    conn = sqlite3.connect('bridge.db')
-    cursor = conn.cursor()
+class MattermostEventConsumer:
+    """Mattermost WebSocketのイベントストリームを購読し、ブリッジのハンドラーへ流す
     
-    cursor.execute('''
-        SELECT forgejo_access_token, forgejo_username, expires_at 
-        FROM user_tokens 
-        WHERE mattermost_user_id = ?
-    ''', (mattermost_user_id,))
+    リーダーのレプリカだけが接続する。切断時は指数バックオフで再接続し、
+    connection_id と sequence_number を渡して取りこぼしたイベントを再送してもらう。
+    """
+    def __init__(self, tenant, ping_interval, backoff_max):
+        self.tenant = tenant
+        self.ping_interval = ping_interval
+        self.backoff_max = backoff_max
+        self.connection_id = ''
+        self.sequence = 0
+        self.connected = False
+        self.connects = 0
+        self.events = 0
+        self.missed = 0
+        self.last_error = None
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.connection = None
     
-    result = cursor.fetchone()
-    conn.close()
+    def start(self):
+        if self.thread:
+            return
+        self.thread = threading.Thread(target=self._run, name=f"mattermost-ws-{self.tenant.name}", daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
     
-    if result:
-        access_token, forgejo_username, expires_at = result
-        
-        # 期限切れチェックを実装
-        if expires_at:
+    def stop(self):
+        self.stop_event.set()
+        if self.connection:
+            self.connection.close()
+    
+    def connect_url(self):
+        """再接続時は前回の接続IDと次に期待するシーケンス番号を付与"""
+        if not self.connection_id:
+            return self.tenant.mattermost_websocket_url
+        query = urllib.parse.urlencode({'connection_id': self.connection_id, 'sequence_number': self.sequence})
+        return f"{self.tenant.mattermost_websocket_url}?{query}"
+    
+    def _run(self):
+        set_current_tenant(self.tenant)
+        attempt = 0
+        while not self.stop_event.is_set():
+            if not leader_scheduler.is_leader:
+                self.stop_event.wait(LEADER_LEASE_TTL / 3)
+                continue
+            
             try:
-                expire_time = datetime.fromisoformat(expires_at)
-                if datetime.now() >= expire_time:
-                    logger.warning(f"Token expired for user {mattermost_user_id} at {expires_at}")
-                    return None  # 期限切れは無効
-            except ValueError:
-                logger.error(f"Invalid date format for expires_at: {expires_at}")
-                return None
+                self.connection = WebSocketConnection(self.connect_url(), {
+                    'Authorization': f"Bearer {self.tenant.mattermost_api_token}"
+                }, timeout=self.ping_interval)
+                self.connected = True
+                self.connects += 1
+                attempt = 0
+                self._consume()
+            except (OSError, ConnectionError, ValueError) as e:
+                self.last_error = str(e)
+                logger.warning(f"Mattermost WebSocket for tenant {self.tenant.name} disconnected: {e}")
+            finally:
+                self.connected = False
+                if self.connection:
+                    self.connection.close()
+                    self.connection = None
+            
+            if self.stop_event.is_set():
+                break
+            # 全レプリカが一斉に再接続しないようジッターを入れる
+            delay = min(self.backoff_max, 2 ** attempt) * random.uniform(0.5, 1.0)
+            attempt += 1
+            self.stop_event.wait(delay)
+    
+    def _consume(self):
+        last_received = time.monotonic()
+        while not self.stop_event.is_set() and leader_scheduler.is_leader:
+            try:
+                message = self.connection.recv()
+            except socket.timeout:
+                if time.monotonic() - last_received > self.ping_interval * 2:
+                    raise ConnectionError('No response to ping')
+                self.connection.ping()
+                continue
+            
+            last_received = time.monotonic()
+            if message is not None:
+                self.handle_message(json.loads(message))
+    
+    def handle_message(self, message):
+        """1件のイベントを処理（シーケンス番号を進め、スレッドごとの順序でハンドラーへ）"""
+        if 'seq_reply' in message:
+            return
         
+        event = message.get('event')
+        seq = message.get('seq')
+        data = message.get('data') or {}
+        
+        if event == 'hello':
+            connection_id = data.get('connection_id', '')
+            if connection_id != self.connection_id:
+                if self.connection_id:
+                    logger.warning(f"Mattermost WebSocket for tenant {self.tenant.name} could not resume; events may have been missed")
+                self.connection_id = connection_id
+                self.sequence = (seq or 0) + 1
+            return
+        
+        if seq is not None:
+            if seq > self.sequence:
+                self.missed += seq - self.sequence
+            self.sequence = seq + 1
+        self.events += 1
+        
+        if event == 'posted':
+            post = json.loads(data.get('post') or '{}')
+            event_partitions.submit(post.get('root_id') or post.get('id', ''),
+                                    self._dispatch, handle_mattermost_post, post)
+        elif event in ('reaction_added', 'reaction_removed'):
+            reaction = json.loads(data.get('reaction') or '{}')
+            event_partitions.submit(reaction.get('post_id', ''),
+                                    self._dispatch, handle_mattermost_reaction, reaction, event == 'reaction_added')
+    
+    @staticmethod
+    def _dispatch(handler, *args):
+        try:
+            handler(*args)
+        except Exception as e:
+            logger.error(f"Mattermost event handler {handler.__name__} failed: {e}")
+    
+    def stats(self):
         return {
-            'access_token': access_token,
-            'forgejo_username': forgejo_username
+            'connected': self.connected,
+            'connects': self.connects,
+            'sequence': self.sequence,
+            'events': self.events,
+            'missed': self.missed,
+            'last_error': self.last_error
         }
-    return None
 
-def delete_user_token(mattermost_user_id):
-    """指定ユーザーのトークンを削除"""
-    conn = sqlite3.connect('bridge.db')
-    cursor = conn.cursor()
+mattermost_event_consumers = [
+    MattermostEventConsumer(tenant, MATTERMOST_WEBSOCKET_PING_INTERVAL, MATTERMOST_WEBSOCKET_BACKOFF_MAX)
+    for tenant in tenant_registry.tenants.values() if tenant.mattermost_api_configured
+] if MATTERMOST_WEBSOCKET_ENABLED else []
+
+def build_connect_url(user_id, username):
+    """OAuth2認証開始URLを作成（既定以外のテナントはテナント名を付与）"""
+    params = {'user_id': user_id, 'username': username}
+    tenant = current_tenant()
+    if tenant.name != DEFAULT_TENANT:
+        params['tenant'] = tenant.name
+    return f"{BASE_URL}/auth/connect?" + urllib.parse.urlencode(params)
+
+class LeaderScheduler:
+    """リースを保持しているレプリカだけが定期ジョブを実行するスケジューラー
     
-    cursor.execute('''
-        DELETE FROM user_tokens 
-        WHERE mattermost_user_id = ?
-    ''', (mattermost_user_id,))
+    リースは LEADER_LEASE_TTL 秒ごとに失効するため、リーダーが停止しても
+    別のレプリカが引き継ぐ。リクエスト処理はどのレプリカでも行える。
+    リースの更新はジョブとは別のスレッドで行い、ジョブが長引いても更新が止まらない。
+    更新が遅れた場合は、ストア上のリースが失効する前にリーダーではなくなったとみなす。
+    """
+    LEASE_NAME = 'background-jobs'
     
-    deleted_count = cursor.rowcount
-    conn.commit()
-    conn.close()
+    def __init__(self, backend, replica_id, lease_ttl):
+        self.backend = backend
+        self.replica_id = replica_id
+        self.lease_ttl = lease_ttl
+        self.jobs = []
+        # 最後に更新できたリースを、ストア上の期限より前（更新間隔1回分の余裕を残す）に手放す時刻
+        self.lease_deadline = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.job_thread = None
     
-    if deleted_count > 0:
-        logger.info(f"Deleted expired token for user {mattermost_user_id}")
+    @property
+    def is_leader(self):
+        return time.monotonic() < self.lease_deadline
     
-    return deleted_count > 0
-
-def save_user_token(mattermost_user_id, mattermost_username, token_data, forgejo_username):
-    """ユーザートークンをDBに保存"""
-    conn = sqlite3.connect('bridge.db')
-    cursor = conn.cursor()
+    def register(self, name, interval, fn):
+        """定期ジョブを登録"""
+        self.jobs.append({'name': name, 'interval': interval, 'fn': fn, 'next_run': 0})
     
-    expires_at = datetime.now() + timedelta(seconds=token_data.get('expires_in', 3600))
+    def start(self):
+        if self.thread:
+            return
+        self.thread = threading.Thread(target=self._run, name='leader-lease', daemon=True)
+        self.thread.start()
+        self.job_thread = threading.Thread(target=self._run_jobs, name='leader-scheduler', daemon=True)
+        self.job_thread.start()
+        atexit.register(self.stop)
     
-    cursor.execute('''
-        INSERT OR REPLACE INTO user_tokens 
-        (mattermost_user_id, mattermost_username, forgejo_access_token, 
-         forgejo_refresh_token, forgejo_username, expires_at, updated_at)
-        VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
-    ''', (
-        mattermost_user_id,
-        mattermost_username,
-        token_data.get('access_token'),
-        token_data.get('refresh_token'),
-        forgejo_username,
-        expires_at
-    ))
+    def stop(self):
+        self.stop_event.set()
+        if self.is_leader:
+            self.lease_deadline = 0
+            self.backend.release_lease(self.LEASE_NAME, self.replica_id)
     
-    conn.commit()
-    conn.close()
-
-def save_issue_thread_mapping(issue_key, channel_id, username, channel_name, 
-                             team_domain, issue_url, root_message_id=None):
-    """Issue-スレッドマッピングをDBに保存"""
-    conn = sqlite3.connect('bridge.db')
-    cursor = conn.cursor()
+    def _run(self):
+        """リースの取得・更新（LEADER_LEASE_TTL の1/3ごと）"""
+        was_leader = False
+        while not self.stop_event.is_set():
+            started = time.monotonic()
+            try:
+                if self.backend.try_acquire_lease(self.LEASE_NAME, self.replica_id, self.lease_ttl):
+                    self.lease_deadline = started + self.lease_ttl * 2 / 3
+                else:
+                    self.lease_deadline = 0
+            except Exception as e:
+                logger.error(f"Leader lease renewal failed: {e}")
+            if self.is_leader != was_leader:
+                was_leader = self.is_leader
+                logger.info(f"Replica {self.replica_id} {'became' if was_leader else 'lost'} leader")
+            self.stop_event.wait(max(0, started + self.lease_ttl / 3 - time.monotonic()))
     
-    cursor.execute('''
-        INSERT OR REPLACE INTO issue_thread_mapping 
-        (issue_key, channel_id, mattermost_username, channel_name, 
-         team_domain, created_at, issue_url, root_message_id)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (
-        issue_key, channel_id, username, channel_name,
-        team_domain, datetime.now().isoformat(), issue_url, root_message_id
-    ))
+    def _run_jobs(self):
+        while not self.stop_event.is_set():
+            if self.is_leader:
+                self._run_due_jobs()
+            self.stop_event.wait(min(1, self.lease_ttl / 3))
     
-    conn.commit()
-    conn.close()
+    def _run_due_jobs(self):
+        for job in self.jobs:
+            now = time.monotonic()
+            if now < job['next_run']:
+                continue
+            # 前のジョブが長引いて更新が遅れていれば、以降のジョブは実行しない
+            if not self.is_leader:
+                return
+            job['next_run'] = now + job['interval']
+            try:
+                job['fn']()
+            except Exception as e:
+                logger.error(f"Background job {job['name']} failed: {e}")
+    
+    def status(self):
+        return {
+            'replica_id': self.replica_id,
+            'is_leader': self.is_leader,
+            'leader': self.backend.lease_holder(self.LEASE_NAME),
+            'jobs': [job['name'] for job in self.jobs]
+        }
 
-def get_issue_thread_mapping(issue_key):
-    """Issue-スレッドマッピングを取得"""
-    conn = sqlite3.connect('bridge.db')
+leader_scheduler = LeaderScheduler(state_backend, REPLICA_ID, LEADER_LEASE_TTL)
+
+def purge_expired_tokens():
+    """期限切れのユーザートークンを削除（リーダーのみ実行）"""
+    conn = get_db_connection()
     cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT channel_id, mattermost_username, channel_name, team_domain, 
-               created_at, issue_url, root_message_id
-        FROM issue_thread_mapping 
-        WHERE issue_key = ?
-    ''', (issue_key,))
-    
-    result = cursor.fetchone()
+    cursor.execute('DELETE FROM user_tokens WHERE expires_at < ?', (datetime.now(),))
+    deleted_count = cursor.rowcount
+    conn.commit()
     conn.close()
     
-    if result:
-        return {
-            'channel_id': result[0],
-            'username': result[1],
-            'channel_name': result[2],
-            'team_domain': result[3],
-            'created_at': result[4],
-            'issue_url': result[5],
-            'root_message_id': result[6]
-        }
-    return None
+    if deleted_count:
+        logger.info(f"Purged {deleted_count} expired tokens")
+
+leader_scheduler.register('purge_expired_tokens', TOKEN_PURGE_INTERVAL, purge_expired_tokens)
+leader_scheduler.register('send_due_digests', DIGEST_CHECK_INTERVAL, send_due_digests)
+if event_store:
+    leader_scheduler.register('drop_expired_event_partitions', 3600, event_store.drop_expired)
 
 @app.route('/', methods=['GET'])
 def root():
@@ -320,7 +3918,7 @@ def root():
         'message': 'Mattermost-Forgejo OAuth2 Bridge Server',
         'status': 'running',
         'version': '4.0.0-enhanced-auth',
-        'endpoints': ['/webhook', '/auth/connect', '/auth/callback', '/health', '/debug']
+        'endpoints': ['/webhook', '/mattermost/outgoing', '/autocomplete', '/events', '/auth/connect', '/auth/callback', '/health', '/debug']
     })
 
 @app.route('/auth/connect', methods=['GET'])
@@ -333,12 +3931,17 @@ def connect_oauth():
     if not mattermost_user_id or not mattermost_username:
         return jsonify({'error': 'Missing user information'}), 400
     
+    tenant = tenant_registry.get(request.args.get('tenant', DEFAULT_TENANT))
+    if not tenant:
+        return jsonify({'error': 'Unknown tenant'}), 400
+    
     # セッションに保存
     session['mattermost_user_id'] = mattermost_user_id
     session['mattermost_username'] = mattermost_username
+    session['tenant'] = tenant.name
     
     # OAuth2フロー開始
-    oauth = ForgejoOAuth2API(FORGEJO_URL, FORGEJO_CLIENT_ID, FORGEJO_CLIENT_SECRET)
+    oauth = ForgejoOAuth2API(tenant.forgejo_url, tenant.forgejo_client_id, tenant.forgejo_client_secret)
     redirect_uri = url_for('oauth_callback', _external=True)
     state = base64.urlsafe_b64encode(os.urandom(32)).decode('utf-8')
     session['oauth_state'] = state
@@ -363,8 +3966,13 @@ def oauth_callback():
     if state != session.get('oauth_state'):
         return jsonify({'error': 'Invalid state parameter'}), 400
     
+    tenant = tenant_registry.get(session.get('tenant', DEFAULT_TENANT))
+    if not tenant:
+        return jsonify({'error': 'Unknown tenant'}), 400
+    set_current_tenant(tenant)
+    
     # アクセストークンを取得
-    oauth = ForgejoOAuth2API(FORGEJO_URL, FORGEJO_CLIENT_ID, FORGEJO_CLIENT_SECRET)
+    oauth = ForgejoOAuth2API(tenant.forgejo_url, tenant.forgejo_client_id, tenant.forgejo_client_secret)
     redirect_uri = url_for('oauth_callback', _external=True)
     token_data = oauth.exchange_code_for_token(code, redirect_uri)
     
@@ -372,7 +3980,7 @@ def oauth_callback():
         return jsonify({'error': 'Failed to exchange code for token'}), 500
     
     # Forgejoのユーザー情報を取得
-    forgejo_api = ForgejoAPI(FORGEJO_URL, token_data['access_token'])
+    forgejo_api = ForgejoAPI(tenant.forgejo_url, token_data['access_token'])
     user_info = forgejo_api.get_user_info()
     
     if not user_info:
@@ -389,6 +3997,9 @@ def oauth_callback():
         user_info['login']
     )
     
+    # アクセス可能リポジトリの索引をバックグラウンドで作成
+    repo_index.refresh_async(mattermost_user_id, token_data['access_token'])
+    
     # セッションクリア
     session.clear()
     
@@ -398,7 +4009,117 @@ def oauth_callback():
         'mattermost_username': mattermost_username
     })
 
+@app.route('/autocomplete', methods=['GET'])
+def autocomplete():
+    """スラッシュコマンドの動的補完（owner / repo 引数）
+    
+    Forgejoには問い合わせず、ユーザーごとのリポジトリ索引だけで候補を返す。
+    Mattermostの動的リスト取得はヘッダーを指定できないため、FetchURLに補完専用の
+    AUTOCOMPLETE_TOKEN を含めて登録する（漏れても読めるのは補完候補のみ）。
+    """
+    if not AUTOCOMPLETE_TOKEN:
+        return jsonify({'error': 'AUTOCOMPLETE_TOKEN is not configured'}), 403
+    
+    auth_header = request.headers.get('Authorization', '')
+    token = auth_header[len('Bearer '):] if auth_header.startswith('Bearer ') else request.args.get('token', '')
+    if not hmac.compare_digest(token.encode('utf-8'), AUTOCOMPLETE_TOKEN.encode('utf-8')):
+        return jsonify({'error': 'Invalid token'}), 401
+    
+    tenant = tenant_registry.get(request.args.get('tenant', DEFAULT_TENANT))
+    if not tenant:
+        return jsonify({'error': 'Unknown tenant'}), 400
+    set_current_tenant(tenant)
+    
+    # Mattermostサーバーが付与するユーザーIDを優先
+    user_id = request.headers.get('Mattermost-User-Id') or request.args.get('user_id', '')
+    user_input = request.args.get('user_input', '')
+    
+    # "/issue" トリガーを除いて owner / repo 部分を取り出す
+    words = user_input.split(' ')
+    if words and words[0].startswith('/'):
+        words = words[1:]
+    
+    if not repo_index.has_index(user_id):
+        user_token = get_user_token(user_id)
+        if user_token:
+            repo_index.refresh_async(user_id, user_token['access_token'])
+        return jsonify([])
+    
+    if len(words) <= 1:
+        owners = repo_index.complete_owners(user_id, words[0] if words else '', AUTOCOMPLETE_LIMIT)
+        return jsonify([
+            {'Item': owner, 'Hint': '<repo> <title>', 'HelpText': 'Repository owner'}
+            for owner in owners
+        ])
+    
+    if len(words) == 2:
+        owner, repo_prefix = words
+        names = repo_index.complete(user_id, f"{owner}/{repo_prefix}", AUTOCOMPLETE_LIMIT)
+        return jsonify([
+            {'Item': name.split('/', 1)[1], 'Hint': '<title>', 'HelpText': name}
+            for name in names
+        ])
+    
+    return jsonify([])
+
+@app.route('/mattermost/outgoing', methods=['POST'])
+def mattermost_outgoing():
+    """Mattermost Outgoing Webhook（追跡スレッドへの返信をForgejoへ同期）"""
+    if request.is_json:
+        data = request.get_json(silent=True) or {}
+    else:
+        data = request.form.to_dict()
+    
+    tenant = tenant_registry.for_team_domain(data.get('team_domain', ''))
+    set_current_tenant(tenant)
+    
+    # トークン未設定のままだと任意の post_id を送られてコメントが重複するため受け付けない
+    if not tenant.mattermost_outgoing_token:
+        return jsonify({'error': 'MATTERMOST_OUTGOING_TOKEN is not configured'}), 403
+    
+    token = data.get('token', '')
+    if not hmac.compare_digest(token.encode('utf-8'), tenant.mattermost_outgoing_token.encode('utf-8')):
+        logger.error("Invalid outgoing webhook token received")
+        return jsonify({'error': 'Invalid token'}), 401
+    
+    # Outgoing Webhookには root_id が含まれないため投稿本体を取得
+    if data.get('post_id') and tenant.mattermost_api_configured:
+        mattermost = MattermostAPI(tenant.mattermost_api_url, tenant.mattermost_api_token)
+        post = mattermost.get_post(data['post_id'])
+        if post:
+            handle_mattermost_post(post)
+    
+    # 空のレスポンスならMattermostは何も投稿しない
+    return jsonify({})
+
+@app.route('/events', methods=['GET'])
+@require_admin_token
+def events():
+    """保存済みイベントの取得（?repo=owner/repo&since=...&cursor=...&limit=...）"""
+    if not event_store:
+        return jsonify({'error': 'Event store is disabled'}), 404
+    
+    tenant = tenant_registry.get(request.args.get('tenant', DEFAULT_TENANT))
+    if not tenant:
+        return jsonify({'error': 'Unknown tenant'}), 400
+    set_current_tenant(tenant)
+    
+    try:
+        since = parse_since(request.args.get('since'))
+        limit = min(max(int(request.args.get('limit', EVENTS_PAGE_SIZE)), 1), 1000)
+        # 未書き込み分も結果に含める
+        event_store.flush()
+        items, next_cursor = event_store.query(
+            repo=request.args.get('repo'), since=since,
+            cursor=request.args.get('cursor'), limit=limit
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    return jsonify({'events': items, 'next_cursor': next_cursor})
+
 @app.route('/webhook', methods=['GET', 'POST'])
+@trace_request
 def webhook():
     """Webhook エンドポイント"""
     logger.info(f"=== INCOMING REQUEST ===")
@@ -406,32 +4127,56 @@ def webhook():
     logger.info(f"Content-Type: {request.content_type}")
     logger.info(f"========================")
     
+    if webhook_capture_writer:
+        capture_webhook_request(request)
+    
     # Mattermostのスラッシュコマンド処理
     if request.content_type == 'application/x-www-form-urlencoded':
-        data = request.form.to_dict()
+        with trace_span('parse_request'):
+            data = request.form.to_dict()
+        
+        # team_domain からテナントを決定
+        tenant = tenant_registry.for_team_domain(data.get('team_domain', ''))
+        set_current_tenant(tenant)
         
         # トークン検証
         token = data.get('token', '')
-        if MATTERMOST_TOKEN and token != MATTERMOST_TOKEN:
+        if tenant.mattermost_token and token != tenant.mattermost_token:
             logger.error("Invalid token received")
             return jsonify({
                 'response_type': 'ephemeral',
                 'text': '❌ Invalid token'
             }), 401
         
-        return handle_slash_command(data)
+        return lane_scheduler.run('interactive', handle_slash_command, data)
     
     # Forgejo Webhook処理
     elif request.is_json:
-        request_body = request.get_data()
+        with trace_span('parse_request'):
+            request_body = request.get_data()
+            data = request.get_json(silent=True) or {}
+        
+        # ?tenant= またはリポジトリURLから送信元のテナントを決定
+        tenant_name = request.args.get('tenant')
+        tenant = tenant_registry.get(tenant_name) if tenant_name else tenant_registry.for_forgejo_payload(data)
+        if not tenant:
+            return jsonify({'error': 'Unknown tenant'}), 400
+        set_current_tenant(tenant)
         
         # Webhook検証
         if not verify_forgejo_webhook(request.headers, request_body):
             logger.error("Invalid Forgejo webhook secret")
             return jsonify({'error': 'Invalid webhook secret'}), 401
         
-        data = request.get_json()
-        return handle_forgejo_webhook(data)
+        # スプールモードでは追記だけして即座に受理を返す
+        if webhook_spool:
+            webhook_spool.append({'tenant': tenant.name, 'body': request_body.decode('utf-8', errors='replace')})
+            return jsonify({'status': 'queued'}), 202
+        
+        # 同じIssueのイベントは到着順に処理（完了を待たずに受理を返し、Webhookがリクエストスレッドを占有しないようにする）
+        future = event_partitions.submit(webhook_issue_key(data), process_forgejo_webhook, data)
+        future.add_done_callback(_log_webhook_result)
+        return jsonify({'status': 'queued'}), 202
     
     else:
         return jsonify({'error': 'Unsupported content type'}), 400
@@ -452,9 +4197,10 @@ def handle_slash_command(data):
         if text == 'auth' or text == 'login' or text == 'connect':
             # 古いトークンを自動削除
             deleted = delete_user_token(user_id)
+            repo_index.forget(user_id)
             delete_message = "🧹 古いトークンを削除しました。" if deleted else ""
             
-            connect_url = f"{BASE_URL}/auth/connect?user_id={user_id}&username={username}"
+            connect_url = build_connect_url(user_id, username)
             return jsonify({
                 'response_type': 'ephemeral',
                 'text': f'''🔐 **Forgejo認証を開始**
@@ -476,12 +4222,12 @@ def handle_slash_command(data):
             user_token = get_user_token(user_id)
             if user_token:
                 # トークンの有効期限も表示
-                conn = sqlite3.connect('bridge.db')
+                conn = get_db_connection()
                 cursor = conn.cursor()
                 cursor.execute('''
                     SELECT expires_at FROM user_tokens 
                     WHERE mattermost_user_id = ?
-                ''', (user_id,))
+                ''', (current_tenant().scope(user_id),))
                 result = cursor.fetchone()
                 conn.close()
                 
@@ -512,7 +4258,7 @@ def handle_slash_command(data):
 - `/issue status` - 接続状況確認'''
                 })
             else:
-                connect_url = f"{BASE_URL}/auth/connect?user_id={user_id}&username={username}"
+                connect_url = build_connect_url(user_id, username)
                 return jsonify({
                     'response_type': 'ephemeral',
                     'text': f'''❌ **Forgejo未接続**
@@ -527,7 +4273,8 @@ def handle_slash_command(data):
         # 強制再認証コマンド
         if text == 'reset' or text == 'reauth':
             delete_user_token(user_id)
-            connect_url = f"{BASE_URL}/auth/connect?user_id={user_id}&username={username}"
+            repo_index.forget(user_id)
+            connect_url = build_connect_url(user_id, username)
             return jsonify({
                 'response_type': 'ephemeral',
                 'text': f'''🔄 **強制再認証**
@@ -541,7 +4288,7 @@ def handle_slash_command(data):
         # OAuth2認証チェック
         user_token = get_user_token(user_id)
         if not user_token:
-            connect_url = f"{BASE_URL}/auth/connect?user_id={user_id}&username={username}"
+            connect_url = build_connect_url(user_id, username)
             return jsonify({
                 'response_type': 'ephemeral',
                 'text': f'''🔐 **認証が必要です**
@@ -553,6 +4300,18 @@ def handle_slash_command(data):
 認証後、Issue作成コマンドが利用可能になります。'''
             })
         
+        # 既存Issueの一括追跡コマンド
+        if text == 'track' or text.startswith('track '):
+            return handle_track_command(text, user_token, username, channel_id, channel_name, team_domain)
+        
+        # ダイジェスト配信設定
+        if text == 'digest' or text.startswith('digest '):
+            return handle_digest_command(text, user_id, user_token, channel_id)
+        
+        # リポジトリ統計
+        if text == 'stats' or text.startswith('stats '):
+            return handle_stats_command(text, user_id, user_token)
+        
         # ヘルプまたは空のコマンド
         if not text:
             return jsonify({
@@ -565,7 +4324,10 @@ def handle_slash_command(data):
 • `/issue auth` - 認証・再認証
 • `/issue status` - 接続状況・有効期限確認
 • `/issue reset` - 強制再認証
-• `/issue <owner> <repo> <title>` - Issue作成
+• `/issue track <owner>/<repo>` - 既存のオープンIssueをこのチャンネルで追跡
+• `/issue digest <hourly|daily> <owner>/<repo> ...` - 個別通知の代わりに定期サマリーを投稿（`off` で解除）
+• `/issue stats <owner>/<repo>` - オープン/クローズ件数とクローズまでの時間
+• `/issue <owner> <repo> <title>` - Issue作成（似たIssueがあると警告、`--force` で強制作成）
 
 **Issue作成例:**
 ```
@@ -582,6 +4344,11 @@ def handle_slash_command(data):
         lines = text.split('\n')
         first_line = lines[0].strip()
         
+        # --force が付いていれば重複チェックを省略
+        force = first_line.endswith(' --force')
+        if force:
+            first_line = first_line[:-len(' --force')].strip()
+        
         # 最初の行から owner, repo, title を抽出
         parts = first_line.split(' ', 2)
         if len(parts) < 3:
@@ -611,12 +4378,13 @@ Detailed description here...
         user_body = '\n'.join(body_lines).strip()
         
         # 権限チェック
-        forgejo_api = ForgejoAPI(FORGEJO_URL, user_token['access_token'])
-        if not forgejo_api.check_repo_access(owner, repo):
+        tenant = current_tenant()
+        forgejo_api = ForgejoAPI(tenant.forgejo_url, user_token['access_token'])
+        if not has_repo_access(user_id, user_token, owner, repo):
             # デバッグ情報も含める
-            url = f"{FORGEJO_URL}/api/v1/repos/{owner}/{repo}"
+            url = f"{tenant.forgejo_url}/api/v1/repos/{owner}/{repo}"
             headers = {'Authorization': f'Bearer {user_token["access_token"]}'}
-            response = requests.get(url, headers=headers)
+            response = tenant.request('GET', url, headers=headers)
             logger.error(f"Access denied for {user_token['forgejo_username']} to {owner}/{repo}")
             logger.error(f"API Response Status: {response.status_code}")
             
@@ -635,6 +4403,24 @@ Detailed description here...
 3. リポジトリ名・オーナー名のスペルチェック'''
             })
         
+        # 重複候補チェック（ローカル索引のみ、Forgejo検索は行わない）
+        if DUPLICATE_CHECK_ENABLED and not force:
+            duplicates = duplicate_index.find_similar(f"{owner}/{repo}", title)
+            if duplicates:
+                candidates = '\n'.join(
+                    f"- #{d['number']} {d['title']} ({d['similarity']:.0%}) {d['url']}"
+                    for d in duplicates
+                )
+                return jsonify({
+                    'response_type': 'ephemeral',
+                    'text': f'''⚠️ **Possible duplicate issues**
+
+`{owner}/{repo}` に似たIssueがあります:
+{candidates}
+
+それでも作成する場合は、1行目の末尾に `--force` を付けて再実行してください。'''
+                })
+        
         # Issue本文を作成
         body = f"## Issue created from Mattermost\n\n"
         body += f"**Channel:** {channel_name}\n"
@@ -648,11 +4434,18 @@ Detailed description here...
         else:
             body += f"**Description:**\n{title}"
         
+        # 返ってくる opened Webhook でMattermostへ再投稿しない（Webhookが先に届く場合に備え作成前に記録）
+        if echo_suppressor:
+            echo_suppressor.record(f"{owner}/{repo}", 'opened', title)
+        
         # Issue作成
         issue = forgejo_api.create_issue(owner, repo, title, body)
+        if echo_suppressor:
+            echo_suppressor.resolve(f"{owner}/{repo}", 'opened', title, issue['number'] if issue else None)
         
         if issue:
             logger.info(f"Created issue #{issue['number']}: {title}")
+            duplicate_index.add(f"{owner}/{repo}", issue['number'], title, issue['html_url'])
             
             response_text = f'''✅ **Issue Created Successfully!**
 
@@ -663,21 +4456,33 @@ Detailed description here...
 
 *This thread will receive updates when the issue is updated.*'''
             
+            issue_key = f"{owner}/{repo}#{issue['number']}"
+            
+            # ステータスカードモードではルート投稿をカードとして使う
+            card = None
+            if status_cards_enabled():
+                card = build_status_card(issue, f"{datetime.now().strftime('%Y-%m-%d %H:%M')} opened by @{user_token['forgejo_username']}")
+                card['channel_id'] = channel_id
+                response_text = render_status_card(issue_key, card)
+            
             # Mattermostにメッセージを投稿
             root_message_id = None
-            if MATTERMOST_API_URL and MATTERMOST_API_TOKEN:
-                mattermost = MattermostAPI(MATTERMOST_API_URL, MATTERMOST_API_TOKEN)
+            if tenant.mattermost_api_configured:
+                mattermost = MattermostAPI(tenant.mattermost_api_url, tenant.mattermost_api_token)
                 post_result = mattermost.post_message(channel_id, response_text)
                 if post_result:
                     root_message_id = post_result.get('id')
             
             # Issue-スレッドマッピングを保存
-            issue_key = f"{owner}/{repo}#{issue['number']}"
             save_issue_thread_mapping(
                 issue_key, channel_id, username, channel_name,
                 team_domain, issue['html_url'], root_message_id
             )
             
+            if card and root_message_id:
+                card['post_id'] = root_message_id
+                save_status_card(issue_key, card)
+            
             if root_message_id:
                 return jsonify({'text': ''}), 200
             else:
@@ -708,9 +4513,64 @@ Detailed description here...
 3. それでも解決しない場合は管理者にお問い合わせください。'''
         })
 
+def handle_track_command(text, user_token, username, channel_id, channel_name, team_domain):
+    """既存のオープンIssueを一括でスレッド追跡に取り込む"""
+    parts = text.split()
+    if len(parts) != 2 or parts[1].count('/') != 1:
+        return jsonify({
+            'response_type': 'ephemeral',
+            'text': '❌ **Error**: Usage: `/issue track <owner>/<repo>`'
+        })
+    
+    owner, repo = parts[1].split('/')
+    
+    started = time.monotonic()
+    forgejo_api = ForgejoAPI(current_tenant().forgejo_url, user_token['access_token'])
+    issues = forgejo_api.get_all_repo_issues(owner, repo)
+    
+    if issues is None:
+        return jsonify({
+            'response_type': 'ephemeral',
+            'text': f'''❌ **Failed to fetch issues**
+
+リポジトリ `{owner}/{repo}` のIssue一覧を取得できませんでした。
+
+**解決方法:**
+1. `/issue auth` - 再認証
+2. リポジトリのアクセス権限を確認'''
+        })
+    
+    mappings = [{
+        'issue_key': f"{owner}/{repo}#{issue['number']}",
+        'channel_id': channel_id,
+        'username': username,
+        'channel_name': channel_name,
+        'team_domain': team_domain,
+        'issue_url': issue.get('html_url', '')
+    } for issue in issues]
+    inserted_count = save_issue_thread_mappings_bulk(mappings)
+    
+    for issue in issues:
+        duplicate_index.add(f"{owner}/{repo}", issue['number'], issue.get('title', ''), issue.get('html_url', ''))
+    
+    elapsed = time.monotonic() - started
+    logger.info(f"Backfilled {inserted_count}/{len(issues)} issues from {owner}/{repo} into {channel_name} in {elapsed:.2f}s")
+    
+    return jsonify({
+        'response_type': 'ephemeral',
+        'text': f'''✅ **Tracking {owner}/{repo}**
+
+**オープンIssue:** {len(issues)}件
+**新規追跡:** {inserted_count}件（既に追跡中: {len(issues) - inserted_count}件）
+
+このチャンネルにIssueの更新が通知されます。'''
+    })
+
+@traced('verify_signature')
 def verify_forgejo_webhook(request_headers, request_body):
     """Forgejoからのwebhookを検証"""
-    if not WEBHOOK_SECRET:
+    webhook_secret = current_tenant().webhook_secret
+    if not webhook_secret:
         return True
     
     signature_header = request_headers.get('X-Hub-Signature-256')
@@ -722,7 +4582,7 @@ def verify_forgejo_webhook(request_headers, request_body):
     
     received_signature = signature_header[7:]
     expected_signature = hmac.new(
-        WEBHOOK_SECRET.encode('utf-8'),
+        webhook_secret.encode('utf-8'),
         request_body,
         hashlib.sha256
     ).hexdigest()
@@ -734,10 +4594,16 @@ def handle_forgejo_webhook(data):
     try:
         action = data.get('action', '')
         
+        if event_store:
+            event_store.append(data)
+        
+        # ブリッジ自身の操作によるイベントも集計には反映し、Mattermostへの投稿だけを省く
+        echo = bool(echo_suppressor and echo_suppressor.match(data))
+        
         if 'comment' in data and 'issue' in data:
-            return handle_issue_comment_event(data, action)
+            return handle_issue_comment_event(data, action, echo)
         elif 'issue' in data:
-            return handle_issue_event(data, action)
+            return handle_issue_event(data, action, echo)
         elif 'pull_request' in data:
             return handle_pull_request_event(data, action)
         else:
@@ -747,7 +4613,7 @@ def handle_forgejo_webhook(data):
         logger.error(f"Error processing Forgejo webhook: {e}")
         return jsonify({'error': 'Internal server error'}), 500
 
-def handle_issue_comment_event(data, action):
+def handle_issue_comment_event(data, action, echo=False):
     """Issue commentイベントの処理"""
     issue = data.get('issue', {})
     comment = data.get('comment', {})
@@ -760,26 +4626,29 @@ def handle_issue_comment_event(data, action):
     issue_title = issue.get('title', '')
     sender_name = sender.get('login', 'Unknown')
     
-    comment_body = comment.get('body', '')
     comment_url = comment.get('html_url', '')
+    comment_body = render_bounded_markdown(comment.get('body', ''), continue_url=comment_url)
     
     issue_key = f"{owner}/{repo_name}#{issue_number}"
+    
+    # ステータスカードは最終アクティビティのみ更新（コメント自体は返信として残す）
+    if status_cards_enabled():
+        last_activity = f"{datetime.now().strftime('%Y-%m-%d %H:%M')} comment by @{sender_name}"
+        if not update_status_card(issue_key, None, last_activity) and not echo:
+            create_status_card(issue_key, issue, last_activity)
+    
     thread_info = get_issue_thread_mapping(issue_key)
     
     message = f"💬 **New Comment on Issue**\n\n**Repository:** {owner}/{repo_name}\n**Issue #{issue_number}:** {issue_title}\n**Comment by:** @{sender_name}\n\n**Comment:**\n{comment_body}\n\n**URL:** {comment_url}"
     
-    if thread_info and MATTERMOST_API_URL and MATTERMOST_API_TOKEN:
-        mattermost = MattermostAPI(MATTERMOST_API_URL, MATTERMOST_API_TOKEN)
-        root_id = thread_info.get('root_message_id')
-        
-        if root_id:
-            mattermost.post_message(thread_info['channel_id'], message, root_id=root_id)
-        else:
-            mattermost.post_message(thread_info['channel_id'], message)
+    record_digest_event(f"{owner}/{repo_name}", 'issue_commented', issue_number, issue_title, issue.get('html_url', ''))
+    # スレッド返信の同期で投稿したコメントは、元の返信がすでにスレッドにある
+    if not echo:
+        deliver_event_message(message, thread_info, repo=f"{owner}/{repo_name}")
     
     return jsonify({'status': 'processed'}), 200
 
-def handle_issue_event(data, action):
+def handle_issue_event(data, action, echo=False):
     """Issue関連イベントの処理"""
     issue = data.get('issue', {})
     repository = data.get('repository', {})
@@ -793,6 +4662,27 @@ def handle_issue_event(data, action):
     sender_name = sender.get('login', 'Unknown')
     
     issue_key = f"{owner}/{repo_name}#{issue_number}"
+    
+    # 重複候補索引を更新（クローズされたIssueは候補から外す）
+    if action in ('opened', 'edited', 'reopened'):
+        duplicate_index.add(f"{owner}/{repo_name}", issue_number, issue_title, issue_url)
+    elif action == 'closed':
+        duplicate_index.remove(f"{owner}/{repo_name}", issue_number)
+    
+    record_issue_stats(f"{owner}/{repo_name}", action, issue)
+    
+    if action in ('opened', 'closed'):
+        record_digest_event(f"{owner}/{repo_name}", f"issue_{action}", issue_number, issue_title, issue_url)
+    
+    # ステータスカードがあれば返信を投稿せずカードを更新（なければ作成）
+    # /issue で作成したIssueのカードはコマンド側で作るため、エコーでは作成しない
+    if status_cards_enabled():
+        last_activity = f"{datetime.now().strftime('%Y-%m-%d %H:%M')} {action} by @{sender_name}"
+        if update_status_card(issue_key, issue, last_activity):
+            return jsonify({'status': 'processed'}), 200
+        if not echo and create_status_card(issue_key, issue, last_activity):
+            return jsonify({'status': 'processed'}), 200
+    
     thread_info = get_issue_thread_mapping(issue_key)
     
     message = ""
@@ -802,19 +4692,31 @@ def handle_issue_event(data, action):
     elif action == 'reopened':
         message = f"🔄 **Issue Reopened**\n\n**Repository:** {owner}/{repo_name}\n**Issue #{issue_number}:** {issue_title}\n**Reopened by:** @{sender_name}\n**URL:** {issue_url}"
     
-    if message and thread_info and MATTERMOST_API_URL and MATTERMOST_API_TOKEN:
-        mattermost = MattermostAPI(MATTERMOST_API_URL, MATTERMOST_API_TOKEN)
-        root_id = thread_info.get('root_message_id')
-        
-        if root_id:
-            mattermost.post_message(thread_info['channel_id'], message, root_id=root_id)
-        else:
-            mattermost.post_message(thread_info['channel_id'], message)
+    if message:
+        deliver_event_message(message, thread_info, repo=f"{owner}/{repo_name}")
     
     return jsonify({'status': 'processed'}), 200
 
 def handle_pull_request_event(data, action):
     """Pull Request関連イベントの処理"""
+    pull_request = data.get('pull_request', {})
+    if action == 'closed' and pull_request.get('merged'):
+        repository = data.get('repository', {})
+        record_digest_event(
+            f"{repository.get('owner', {}).get('login', '')}/{repository.get('name', '')}", 'pr_merged',
+            pull_request.get('number', ''), pull_request.get('title', ''), pull_request.get('html_url', '')
+        )
+    
+    # PRのステータスカードを更新（最初のイベントでカードを作成）
+    if status_cards_enabled():
+        repository = data.get('repository', {})
+        sender_name = data.get('sender', {}).get('login', 'Unknown')
+        owner = repository.get('owner', {}).get('login', '')
+        issue_key = f"{owner}/{repository.get('name', '')}#{pull_request.get('number', '')}"
+        last_activity = f"{datetime.now().strftime('%Y-%m-%d %H:%M')} {action} by @{sender_name}"
+        if not update_status_card(issue_key, pull_request, last_activity):
+            create_status_card(issue_key, pull_request, last_activity)
+    
     # 既存のPR処理ロジックをそのまま使用
     return jsonify({'status': 'processed'}), 200
 
@@ -831,14 +4733,35 @@ def health():
             'Enhanced authentication',
             'Expiration checking',
             'Status monitoring',
-            'Force re-auth'
+            'Force re-auth',
+            'Parallel fan-out delivery',
+            'Size-bounded comment rendering',
+            'Edit-in-place status cards',
+            'Bulk issue backfill',
+            'Conditional GET caching',
+            'Accessible repo index',
+            'Owner/repo autocomplete',
+            'Duplicate issue detection',
+            'Multi-tenant mode',
+            'Leader-elected background jobs',
+            'Disk-spooled webhook ingestion',
+            'Priority lanes for slash commands',
+            'Per-issue ordered event processing',
+            'Scheduled channel digests',
+            'Partitioned event store',
+            'Incremental repo statistics',
+            'Sampled request tracing',
+            'Group-committed SQLite writes',
+            'Thread replies mirrored to Forgejo',
+            'Mattermost WebSocket event stream',
+            'Echo suppression for bridge-initiated events'
         ]
     })
 
 @app.route('/debug', methods=['GET'])
 def debug():
     """デバッグ情報"""
-    conn = sqlite3.connect('bridge.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     # アクティブなトークン数
@@ -869,17 +4792,54 @@ def debug():
             'forgejo_url': FORGEJO_URL,
             'oauth_configured': bool(FORGEJO_CLIENT_ID and FORGEJO_CLIENT_SECRET),
             'webhook_secret_set': bool(WEBHOOK_SECRET),
-            'mattermost_api_configured': bool(MATTERMOST_API_URL and MATTERMOST_API_TOKEN)
+            'mattermost_api_configured': bool(MATTERMOST_API_URL and MATTERMOST_API_TOKEN),
+            'fanout_channels': len(FANOUT_CHANNEL_IDS),
+            'fanout_max_workers': FANOUT_MAX_WORKERS,
+            'status_card_mode': STATUS_CARD_MODE,
+            'status_card_channel_configured': bool(STATUS_CARD_CHANNEL_ID or FANOUT_CHANNEL_IDS),
+            'webhook_capture_enabled': bool(WEBHOOK_CAPTURE_PATH),
+            'webhook_spool_enabled': bool(SPOOL_DIR),
+            'trace_file': TRACE_FILE,
+            'trace_sample_rate': TRACE_SAMPLE_RATE,
+            'tenants': sorted(tenant_registry.tenants)
+        },
+        'forgejo_cache': forgejo_response_cache.stats(),
+        'repo_index': repo_index.stats(),
+        'duplicate_index': duplicate_index.stats(),
+        'scheduler': leader_scheduler.status(),
+        'webhook_spool': webhook_spool.stats() if webhook_spool else None,
+        'lanes': lane_scheduler.stats() if PRIORITY_LANES_ENABLED else None,
+        'event_partitions': event_partitions.stats(),
+        'event_store': event_store.stats() if event_store else None,
+        'db_write_queue': db_write_queue.stats() if db_write_queue else None,
+        'comment_mirror': comment_mirror_batcher.stats(),
+        'echo_suppression': echo_suppressor.stats() if echo_suppressor else None,
+        'mattermost_websocket': {
+            consumer.tenant.name: consumer.stats() for consumer in mattermost_event_consumers
         }
     })
 
 if __name__ == '__main__':
-    if not FORGEJO_CLIENT_ID or not FORGEJO_CLIENT_SECRET:
+    # python mattermost_forgejo_enhanced_bridge.py migrate でマイグレーションのみ実行
+    if sys.argv[1:] == ['migrate']:
+        schema_version = run_migrations(background=False)
+        logger.info(f"Schema is at version {schema_version}")
+        exit(0)
+    
+    if (not FORGEJO_CLIENT_ID or not FORGEJO_CLIENT_SECRET) and not TENANTS_FILE:
         logger.error("FORGEJO_CLIENT_ID and FORGEJO_CLIENT_SECRET environment variables are required")
         exit(1)
     
     port = int(os.getenv('PORT', 5005))
     debug = os.getenv('DEBUG', 'False').lower() == 'true'
     
+    run_migrations()
+    leader_scheduler.start()
+    if webhook_spool:
+        # 前回の未処理分があれば起動時に処理を再開
+        webhook_spool.start()
+    for consumer in mattermost_event_consumers:
+        consumer.start()
+    
     logger.info(f"Starting OAuth2 bridge server v4.0.0 with enhanced authentication on port {port}")
     app.run(host='0.0.0.0', port=port, debug=debug)
\ No newline at end of file
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+import argparse
+import cProfile
+import glob
+import gzip
+import json
+import os
+import pstats
+import sys
+import time
+import urllib.parse
+
+# 再生時に DB_PATH（既定: カレントディレクトリの bridge.db）へマイグレーションを適用するため、
+# 本番とは別のディレクトリで実行してください。
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import mattermost_forgejo_enhanced_bridge as bridge
+
+
+class NullResponse:
+    """オフライン再生用のダミーHTTPレスポンス"""
+    status_code = 200
+    headers = {}
+    content = b'{}'
+
+    def json(self):
+        return {'id': 'replay', 'number': 0, 'html_url': '', 'login': 'replay'}
+
+    def raise_for_status(self):
+        pass
+
+
+def disable_outbound_http():
+    """外部HTTP呼び出しを無効化し、ブリッジ内部の処理だけを計測できるようにする"""
+    def null_request(*args, **kwargs):
+        return NullResponse()
+
+    bridge.requests.Session.request = null_request
+
+
+def capture_files(path):
+    """ローテーション済みファイルを古い順に並べて返す"""
+    suffixes = [name[len(path) + 1:] for name in glob.glob(f"{path}.*")]
+    indexes = sorted((int(suffix) for suffix in suffixes if suffix.isdigit()), reverse=True)
+    files = [f"{path}.{index}" for index in indexes]
+    if os.path.exists(path):
+        files.append(path)
+    return files
+
+
+def read_capture(path):
+    """キャプチャファイルからレコードを順に読み出す"""
+    for name in capture_files(path):
+        try:
+            with gzip.open(name, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+        except EOFError:
+            # 書き込み中に終了したファイルは末尾が欠けている
+            bridge.logger.warning(f"Capture file {name} is truncated, skipping the rest")
+
+
+def replay_record(record):
+    """1件のキャプチャをハンドラーに直接渡す（署名検証はスキップ）"""
+    body = record.get('body', '')
+
+    if record.get('content_type') == 'application/x-www-form-urlencoded':
+        data = dict(urllib.parse.parse_qsl(body, keep_blank_values=True))
+        bridge.set_current_tenant(bridge.tenant_registry.for_team_domain(data.get('team_domain', '')))
+        return bridge.handle_slash_command(data)
+
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return None
+    bridge.set_current_tenant(bridge.tenant_registry.for_forgejo_payload(data))
+    return bridge.handle_forgejo_webhook(data)
+
+
+def replay(path, limit=None):
+    """キャプチャを最大速度で再生し、処理件数と所要時間を返す"""
+    count = 0
+    started = time.perf_counter()
+
+    with bridge.app.test_request_context('/webhook', method='POST'):
+        for record in read_capture(path):
+            replay_record(record)
+            count += 1
+            if limit and count >= limit:
+                break
+
+    return count, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay captured /webhook traffic in-process')
+    parser.add_argument('capture', help='Capture file (WEBHOOK_CAPTURE_PATH)')
+    parser.add_argument('--limit', type=int, default=None, help='Maximum number of requests to replay')
+    parser.add_argument('--profile', default=None, help='Write cProfile stats to this file')
+    parser.add_argument('--live', action='store_true', help='Allow real HTTP calls to Forgejo/Mattermost')
+    args = parser.parse_args()
+
+    bridge.run_migrations(background=False)
+    
+    if not args.live:
+        disable_outbound_http()
+
+    # 再生中のログ出力は計測のノイズになるため警告以上に絞る
+    bridge.logger.remove()
+    bridge.logger.add(sys.stderr, level='WARNING')
+
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler:
+        profiler.enable()
+
+    count, elapsed = replay(args.capture, args.limit)
+
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
+
+    rate = count / elapsed if elapsed > 0 else 0
+    print(f"Replayed {count} requests in {elapsed:.3f}s ({rate:.1f} req/s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,7 @@ import requests
 import hmac
 import hashlib
 import base64
+import sys
 import urllib.parse
 from flask import Flask, request, jsonify, redirect, session, url_for
 from datetime import datetime, timedelta
@@ -30,11 +31,8 @@ MATTERMOST_API_URL = os.getenv('MATTERMOST_API_URL', '')
 MATTERMOST_API_TOKEN = os.getenv('MATTERMOST_API_TOKEN', '')
 BASE_URL = os.getenv('BASE_URL', 'http://localhost:5005')
 
-# データベース初期化
-def init_db():
-    conn = sqlite3.connect('bridge.db')
-    cursor = conn.cursor()
-    
+# スキーママイグレーション（起動時に明示的に run_migrations() を呼ぶ）
+def _migration_001_initial_schema(cursor):
     # ユーザートークンテーブル
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS user_tokens (
@@ -62,11 +60,45 @@ def init_db():
             root_message_id TEXT
         )
     ''')
-    
-    conn.commit()
-    conn.close()
 
-init_db()
+# (バージョン, 説明, 適用関数)
+MIGRATIONS = [
+    (1, 'initial schema', _migration_001_initial_schema)
+]
+
+def run_migrations():
+    """未適用のマイグレーションを1つずつトランザクションで適用し、現在のバージョンを返す"""
+    conn = sqlite3.connect('bridge.db', timeout=30)
+    try:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT,
+                applied_at TEXT
+            )
+        ''')
+        conn.commit()
+        
+        for version, description, migrate in MIGRATIONS:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                current_version = cursor.execute('SELECT MAX(version) FROM schema_version').fetchone()[0] or 0
+                if current_version >= version:
+                    conn.rollback()
+                    continue
+                migrate(cursor)
+                cursor.execute('INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)',
+                               (version, description, datetime.now().isoformat()))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            logger.info(f"Applied schema migration {version} ({description})")
+        
+        return conn.execute('SELECT MAX(version) FROM schema_version').fetchone()[0] or 0
+    finally:
+        conn.close()
 
 class ForgejoOAuth2API:
     def __init__(self, base_url, client_id, client_secret):
@@ -635,6 +667,11 @@ def health():
     })
 
 if __name__ == '__main__':
+    # python mattermost_forgejo_oauth_bridge.py migrate でマイグレーションのみ実行
+    if sys.argv[1:] == ['migrate']:
+        logger.info(f"Schema is at version {run_migrations()}")
+        exit(0)
+    
     if not FORGEJO_CLIENT_ID or not FORGEJO_CLIENT_SECRET:
         logger.error("FORGEJO_CLIENT_ID and FORGEJO_CLIENT_SECRET environment variables are required")
         exit(1)
@@ -642,5 +679,7 @@ if __name__ == '__main__':
     port = int(os.getenv('PORT', 5000))
     debug = os.getenv('DEBUG', 'False').lower() == 'true'
     
+    run_migrations()
+    
     logger.info(f"Starting OAuth2 bridge server on port {port}")
     app.run(host='0.0.0.0', port=port, debug=debug)
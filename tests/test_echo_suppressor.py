@@ -0,0 +1,57 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'example', 'enhanced_bridge'))
+import mattermost_forgejo_enhanced_bridge as bridge
+
+REPOSITORY = {'full_name': 'MyOrg/MyRepo', 'name': 'MyRepo', 'owner': {'login': 'MyOrg'}}
+
+
+def comment_webhook(comment_id, body):
+    return {'action': 'created', 'issue': {'number': 5}, 'repository': REPOSITORY,
+            'comment': {'id': comment_id, 'body': body}}
+
+
+def opened_webhook(number, title):
+    return {'action': 'opened', 'issue': {'number': number, 'title': title}, 'repository': REPOSITORY}
+
+
+def test_mirrored_comment_is_suppressed_but_later_human_comment_is_not():
+    echo = bridge.EchoSuppressor(60, 100)
+    echo.record('myorg/myrepo#5', 'created', '+1')
+    echo.resolve('myorg/myrepo#5', 'created', '+1', 10)
+
+    assert echo.match(comment_webhook(10, '+1'))
+    # Forgejoの再送はIDで一致する
+    assert echo.match(comment_webhook(10, '+1'))
+    assert not echo.match(comment_webhook(11, '+1'))
+
+
+def test_webhook_arriving_before_api_response_is_suppressed_once():
+    echo = bridge.EchoSuppressor(60, 100)
+    echo.record('myorg/myrepo#5', 'created', '+1')
+
+    assert echo.match(comment_webhook(10, '+1'))
+    echo.resolve('myorg/myrepo#5', 'created', '+1', 10)
+    assert not echo.match(comment_webhook(11, '+1'))
+    assert echo.match(comment_webhook(10, '+1'))
+
+
+def test_concurrent_identical_operations_are_each_suppressed():
+    echo = bridge.EchoSuppressor(60, 100)
+    echo.record('MyOrg/MyRepo', 'opened', 'Crash')
+    echo.record('MyOrg/MyRepo', 'opened', 'Crash')
+
+    assert echo.match(opened_webhook(1, 'Crash'))
+    assert echo.match(opened_webhook(2, 'Crash'))
+    echo.resolve('MyOrg/MyRepo', 'opened', 'Crash', 1)
+    echo.resolve('MyOrg/MyRepo', 'opened', 'Crash', 2)
+    assert not echo.match(opened_webhook(3, 'Crash'))
+
+
+def test_failed_operation_does_not_suppress_human_issue():
+    echo = bridge.EchoSuppressor(60, 100)
+    echo.record('myorg/myrepo', 'opened', 'Crash')
+    echo.resolve('myorg/myrepo', 'opened', 'Crash', None)
+
+    assert not echo.match(opened_webhook(3, 'Crash'))
@@ -0,0 +1,209 @@
+import base64
+import hashlib
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import urllib.parse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'example', 'enhanced_bridge'))
+import mattermost_forgejo_enhanced_bridge as bridge
+
+GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+
+class FakeClient:
+    """ローカルの偽Mattermostサーバー側から見た1接続"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.buffer = b''
+        head = self._read_until(b'\r\n\r\n')
+        request_line, *header_lines = head.decode('latin-1').split('\r\n')
+        self.path = request_line.split(' ')[1]
+        self.headers = {}
+        for line in header_lines:
+            name, _, value = line.partition(':')
+            self.headers[name.strip().lower()] = value.strip()
+        accept = base64.b64encode(hashlib.sha1((self.headers['sec-websocket-key'] + GUID).encode()).digest()).decode()
+        conn.sendall((
+            'HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+            f'Sec-WebSocket-Accept: {accept}\r\n\r\n'
+        ).encode())
+
+    def _read_until(self, marker):
+        while marker not in self.buffer:
+            self.buffer += self.conn.recv(65536)
+        head, _, self.buffer = self.buffer.partition(marker)
+        return head
+
+    def _read_exact(self, size):
+        while len(self.buffer) < size:
+            chunk = self.conn.recv(65536)
+            if not chunk:
+                raise ConnectionError('client closed')
+            self.buffer += chunk
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def send(self, payload, opcode=0x1):
+        if isinstance(payload, dict):
+            payload = json.dumps(payload)
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        header = bytes([0x80 | opcode])
+        if len(payload) < 126:
+            header += bytes([len(payload)])
+        elif len(payload) < 65536:
+            header += bytes([126]) + len(payload).to_bytes(2, 'big')
+        else:
+            header += bytes([127]) + len(payload).to_bytes(8, 'big')
+        self.conn.sendall(header + payload)
+
+    def recv(self):
+        first, second = self._read_exact(2)
+        length = second & 0x7F
+        if length == 126:
+            length = int.from_bytes(self._read_exact(2), 'big')
+        elif length == 127:
+            length = int.from_bytes(self._read_exact(8), 'big')
+        assert second & 0x80, 'client frames must be masked'
+        mask = self._read_exact(4)
+        payload = bytes(b ^ mask[i % 4] for i, b in enumerate(self._read_exact(length)))
+        return first & 0x0F, payload
+
+    def close(self):
+        self.conn.close()
+
+
+class FakeMattermostServer:
+    """接続ごとに handler(FakeClient) を実行するローカルWebSocketサーバー"""
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.port = self.sock.getsockname()[1]
+        self.clients = []
+        self.errors = []
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    @property
+    def url(self):
+        return f"ws://127.0.0.1:{self.port}/api/v4/websocket"
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        try:
+            client = FakeClient(conn)
+            self.clients.append(client)
+            self.handler(client, len(self.clients))
+        except Exception as e:
+            self.errors.append(e)
+
+    def close(self):
+        self.sock.close()
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def test_handshake_extended_frames_and_ping():
+    big_message = 'x' * 70000
+    echoed = []
+
+    def handler(client, index):
+        client.send(big_message)
+        client.send('y' * 300)
+        client.send(b'', 0x9)
+        echoed.append(client.recv())
+        echoed.append(client.recv())
+        client.send(b'', 0xA)
+        echoed.append(client.recv())
+
+    server = FakeMattermostServer(handler)
+    connection = bridge.WebSocketConnection(server.url, {'Authorization': 'Bearer tok'}, timeout=5)
+    try:
+        assert connection.recv() == big_message
+        assert connection.recv() == 'y' * 300
+        connection.send(big_message)
+        # サーバーからのpingにはpongで応答し、pongはNoneとして返る
+        connection.ping()
+        assert connection.recv() is None
+        assert wait_for(lambda: len(echoed) == 3)
+        assert echoed == [(0x1, big_message.encode()), (0x9, b''), (0xA, b'')]
+        assert server.clients[0].headers['authorization'] == 'Bearer tok'
+    finally:
+        connection.close()
+        server.close()
+    assert not server.errors
+
+
+def test_consumer_tracks_sequence_and_resumes_after_server_close(monkeypatch):
+    posts = []
+    second_connected = threading.Event()
+    finished = threading.Event()
+
+    def posted(seq, post_id):
+        return {'event': 'posted', 'seq': seq, 'data': {'post': json.dumps({'id': post_id, 'root_id': 'root'})}}
+
+    def handler(client, index):
+        if index == 1:
+            client.send({'event': 'hello', 'seq': 0, 'data': {'connection_id': 'conn-1'}})
+            client.send(posted(1, 'p1'))
+            client.send({'seq_reply': 1, 'status': 'OK'})
+            time.sleep(0.1)
+            client.close()
+        else:
+            second_connected.set()
+            # 再接続時は同じ connection_id の hello が返り、続きから再送される
+            client.send({'event': 'hello', 'seq': 0, 'data': {'connection_id': 'conn-1'}})
+            client.send(posted(2, 'p2'))
+            finished.wait(5)
+
+    monkeypatch.setattr(bridge.leader_scheduler, 'lease_deadline', float('inf'))
+    monkeypatch.setattr(bridge, 'handle_mattermost_post', lambda post: posts.append(post['id']))
+
+    server = FakeMattermostServer(handler)
+    tenant = bridge.Tenant('ws-test', {
+        'mattermost_api_url': 'http://127.0.0.1', 'mattermost_api_token': 'tok',
+        'mattermost_websocket_url': server.url
+    })
+    consumer = bridge.MattermostEventConsumer(tenant, ping_interval=5, backoff_max=0.1)
+    consumer.start()
+    try:
+        assert second_connected.wait(5)
+        assert wait_for(lambda: posts == ['p1', 'p2'])
+
+        first, second = server.clients
+        assert first.path == '/api/v4/websocket'
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(second.path).query)
+        assert query == {'connection_id': ['conn-1'], 'sequence_number': ['2']}
+        assert second.headers['authorization'] == 'Bearer tok'
+
+        stats = consumer.stats()
+        assert stats['connects'] == 2
+        assert stats['sequence'] == 3
+        assert stats['events'] == 2
+        assert stats['missed'] == 0
+    finally:
+        finished.set()
+        consumer.stop()
+        server.close()
+    assert not server.errors
@@ -0,0 +1,74 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'example', 'enhanced_bridge'))
+import mattermost_forgejo_enhanced_bridge as bridge
+
+
+def first_line(rendered):
+    return rendered.split('\n', 1)[0]
+
+
+def test_short_body_is_unchanged():
+    body = '**bold** and [link](http://example.com)'
+    assert bridge.render_bounded_markdown(body, max_bytes=1000) == body
+
+
+def test_emphasis_is_closed_when_no_safe_boundary():
+    body = '**bold text that keeps on going and going and going for ever**'
+    line = first_line(bridge.render_bounded_markdown(body, max_bytes=45))
+    assert line.startswith('**bold')
+    assert line.endswith('**…')
+    assert line.count('**') == 2
+
+
+def test_cut_prefers_boundary_outside_emphasis():
+    body = 'This is **a very important bold statement that goes on and on** end'
+    line = first_line(bridge.render_bounded_markdown(body, max_bytes=40))
+    assert line == 'This is…'
+
+
+def test_link_is_never_cut_in_half():
+    for body in (
+        'word [link text that is long](http://x.com/a_b_c_d_e_f_g_h_i) z',
+        'word [link text](http://example.com/a/very/long/path/that/is/cut) z',
+    ):
+        line = first_line(bridge.render_bounded_markdown(body, max_bytes=45))
+        assert '[' not in line and '](' not in line
+
+
+def test_inline_code_is_balanced():
+    body = 'a `code span that keeps going and going and going` b'
+    line = first_line(bridge.render_bounded_markdown(body, max_bytes=45))
+    assert line.count('`') % 2 == 0
+
+
+def test_intraword_underscore_is_not_emphasis():
+    body = 'snake_case_names are fine and then some more words here'
+    line = first_line(bridge.render_bounded_markdown(body, max_bytes=40))
+    assert line.startswith('snake_case_names')
+    assert not line.endswith('_…')
+
+
+def test_fence_opened_by_cut_line_is_closed():
+    body = 'intro\n```python-with-a-long-info-string-that-goes-on-and-on-forever'
+    lines = bridge.render_bounded_markdown(body, max_bytes=40).split('\n')
+    assert sum(1 for line in lines if line.startswith('```')) == 2
+
+
+def test_open_code_block_is_closed():
+    body = 'x\n```\n' + '\n'.join(f"code line {i}" for i in range(100))
+    lines = bridge.render_bounded_markdown(body, max_bytes=80).split('\n')
+    assert sum(1 for line in lines if line.startswith('```')) == 2
+
+
+def test_line_limit_and_continue_link():
+    body = '\n'.join(f"line {i}" for i in range(100))
+    rendered = bridge.render_bounded_markdown(body, continue_url='http://f/1', max_lines=3)
+    assert rendered.split('\n')[:3] == ['line 0', 'line 1', 'line 2']
+    assert rendered.endswith('[続きを読む](http://f/1)*')
+
+
+def test_iter_lines_matches_splitlines():
+    for body in ('', 'a', 'a\n', 'a\n\nb', 'a\nb\n'):
+        assert list(bridge._iter_lines(body)) == body.splitlines()
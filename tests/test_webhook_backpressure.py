@@ -0,0 +1,62 @@
+import json
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'example', 'enhanced_bridge'))
+import mattermost_forgejo_enhanced_bridge as bridge
+
+# スレッド数が固定のWSGIサーバー（gunicorn gthreadなど）のリクエストスレッドを模擬
+REQUEST_THREADS = 2
+
+
+def post_webhook(number):
+    payload = {
+        'action': 'opened',
+        'issue': {'number': number, 'title': f'Issue {number}', 'html_url': f'http://forgejo/o/r/issues/{number}'},
+        'repository': {'full_name': 'o/r', 'name': 'r', 'owner': {'login': 'o'}, 'html_url': 'http://forgejo/o/r'},
+        'sender': {'login': 'someone'}
+    }
+    return bridge.app.test_client().post('/webhook', data=json.dumps(payload), content_type='application/json')
+
+
+def post_slash_command(text):
+    return bridge.app.test_client().post('/webhook', data={
+        'text': text, 'user_id': 'u1', 'user_name': 'alice',
+        'channel_id': 'ch1', 'channel_name': 'general', 'team_domain': 'team'
+    })
+
+
+def test_slash_command_is_served_while_webhooks_saturate_the_server(tmp_path, monkeypatch):
+    monkeypatch.setattr(bridge.state_backend, 'path', str(tmp_path / 'bridge.db'))
+    bridge.run_migrations(background=False)
+
+    release = threading.Event()
+    started = threading.Semaphore(0)
+    handled = threading.Semaphore(0)
+
+    def slow_handler(data):
+        started.release()
+        release.wait(10)
+        handled.release()
+        return bridge.jsonify({'status': 'ok'}), 200
+
+    monkeypatch.setattr(bridge, 'handle_forgejo_webhook', slow_handler)
+
+    with ThreadPoolExecutor(max_workers=REQUEST_THREADS) as server:
+        try:
+            webhooks = [server.submit(post_webhook, number) for number in range(1, 21)]
+            for future in webhooks:
+                assert future.result(timeout=5).status_code == 202
+
+            # Webhook処理が詰まっていてもリクエストスレッドは空いている
+            assert started.acquire(timeout=5)
+            response = server.submit(post_slash_command, 'status').result(timeout=5)
+            assert response.status_code == 200
+            assert 'Forgejo' in response.get_json()['text']
+        finally:
+            release.set()
+            # キューに残ったWebhookがモックを戻した後に実行されないよう、全件の完了を待つ
+            for _ in webhooks:
+                assert handled.acquire(timeout=10)